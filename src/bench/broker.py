@@ -0,0 +1,112 @@
+#
+# Minimal in-process AMQP 1.0 topic broker, a stand-in for the platform broker in local benchmarks.
+#
+# Every message published to an address is delivered to all the receivers attached to that address
+# (e.g. "topic://cits-large"). Messages are forwarded as encoded bytes, never decoded, and queued
+# per subscriber; beyond `max_queue` pending messages the oldest ones are dropped and counted.
+# Selectors and other filters are ignored.
+#
+# Usage: python3 broker.py [--url 127.0.0.1:5673]
+
+from __future__ import print_function
+
+import collections
+import optparse
+
+from proton import Delivery
+from proton.handlers import IncomingMessageHandler, MessagingHandler
+from proton.reactor import Container
+
+
+class Subscriber:
+    def __init__(self, link):
+        self.link = link
+        self.pending = collections.deque()
+        self.dropped = 0
+
+
+class TopicBroker(MessagingHandler):
+    def __init__(self, url, max_queue=100000, prefetch=1000):
+        super(TopicBroker, self).__init__(prefetch=prefetch)
+        # Incoming deliveries are forwarded as they are, not decoded into messages
+        self.handlers = [h for h in self.handlers if not isinstance(h, IncomingMessageHandler)]
+        self.url = url
+        self.max_queue = max_queue
+        self.received = 0
+        self.delivered = 0
+        self.acceptor = None
+        self._topics = collections.defaultdict(list)
+        self._tag = 0
+
+    @property
+    def dropped(self):
+        return sum(s.dropped for subscribers in self._topics.values() for s in subscribers)
+
+    def on_start(self, event):
+        self.acceptor = event.container.listen(self.url)
+
+    def on_link_opening(self, event):
+        link = event.link
+        if link.is_sender:
+            address = link.remote_source.address
+            link.source.address = address
+            self._topics[address].append(Subscriber(link))
+        else:
+            link.target.address = link.remote_target.address
+
+    def _unsubscribe(self, link):
+        if link.is_sender:
+            address = link.source.address
+            self._topics[address] = [s for s in self._topics[address] if s.link != link]
+
+    def on_link_closing(self, event):
+        self._unsubscribe(event.link)
+
+    def on_connection_closing(self, event):
+        for subscribers in self._topics.values():
+            for s in list(subscribers):
+                if s.link.connection == event.connection:
+                    self._unsubscribe(s.link)
+
+    def on_disconnected(self, event):
+        self.on_connection_closing(event)
+
+    def on_delivery(self, event):
+        dlv = event.delivery
+        link = dlv.link
+        if link.is_receiver and dlv.readable and not dlv.partial:
+            data = link.recv(dlv.pending)
+            link.advance()
+            dlv.update(Delivery.ACCEPTED)
+            dlv.settle()
+            self.received += 1
+            for s in self._topics.get(link.target.address, ()):
+                if len(s.pending) >= self.max_queue:
+                    s.pending.popleft()
+                    s.dropped += 1
+                s.pending.append(data)
+                self._drain(s)
+
+    def on_sendable(self, event):
+        for s in self._topics.get(event.sender.source.address, ()):
+            if s.link == event.sender:
+                self._drain(s)
+
+    def _drain(self, s):
+        link = s.link
+        while link.credit and s.pending:
+            self._tag += 1
+            link.delivery(str(self._tag))
+            link.stream(s.pending.popleft())
+            link.advance()
+            self.delivered += 1
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-u", "--url", default="127.0.0.1:5673", help="address to listen on (default %default)")
+    opts, args = parser.parse_args()
+    try:
+        Container(TopicBroker(opts.url)).run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,144 @@
+#
+# Throughput of the ccam consumer loop, one record per poll() against batches from consume(), with
+# the full AMQP decode of the payloads and with the property-only decoder.
+#
+# Without --bootstrap the records come from an in-memory consumer holding encoded CAM messages,
+# which measures the cost of the loop itself (AMQP decode, latency accounting, metrics) without
+# the network and the Avro decoding. With --bootstrap the same topic is read from the beginning
+# once per mode, each time with a new consumer group.
+#
+# Usage: python3 bench_consumer.py [--count 200000] [--sizes 100,500,1000]
+#        python3 bench_consumer.py --bootstrap <ip>:31090 --registry http://<ip>:31081 --topic <topic>
+
+from __future__ import print_function
+
+import optparse
+import time
+import uuid
+
+import proton
+
+from records import decode_payload, payload_properties, record_batch, record_message
+# records.py put src/utils on the path
+from latency import LatencyRecorder
+
+
+class Record:
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+
+# Stands for AvroConsumer: poll() and consume() over records already decoded from Avro
+class MemoryConsumer:
+    def __init__(self, payloads):
+        self.records = [Record({'BYTES_PAYLOAD': p}) for p in payloads]
+        self._index = 0
+
+    def poll(self, timeout=None):
+        if self._index >= len(self.records):
+            return None
+        self._index += 1
+        return self.records[self._index - 1]
+
+    def consume(self, num_messages=1, timeout=None):
+        batch = self.records[self._index:self._index + num_messages]
+        self._index += len(batch)
+        return batch
+
+
+def payloads(count):
+    body = '{"header":{"protocolVersion":2,"messageID":2,"stationID":1},"cam":{"generationDeltaTime":0}}' * 10
+    now = time.time()*1000
+    result = []
+    for i in range(count):
+        message = proton.Message(body=body, properties={
+            "dataType": "cits", "dataSubType": "cam", "sourceId": 1, "locationQuadkey": "1202230101110210",
+            "timestamp": now - 50 + i % 20})
+        result.append(message.encode())
+    return result
+
+
+DECODERS = {
+    "full": lambda value: decode_payload(value).properties,
+    "properties": lambda value: payload_properties(value, ("timestamp",)),
+}
+
+
+def run_poll(consumer, count, decoder, value=lambda r: r.value()):
+    recorder = LatencyRecorder(labels=("topic",), registry=None)
+    done = 0
+    started = time.perf_counter()
+    while done < count:
+        msg = consumer.poll(0.1)
+        if msg is None or msg.error():
+            continue
+        record_message(recorder, decoder(value(msg)), "bench")
+        done += 1
+    return time.perf_counter() - started
+
+
+def run_batch(consumer, count, size, decoder, value=lambda r: r.value()):
+    recorder = LatencyRecorder(labels=("topic",), registry=None)
+    done = 0
+    started = time.perf_counter()
+    while done < count:
+        properties = [decoder(value(msg)) for msg in consumer.consume(size, 0.1) if not msg.error()]
+        record_batch(recorder, properties, "bench")
+        done += len(properties)
+    return time.perf_counter() - started
+
+
+def kafka_consumers(opts):
+    from confluent_kafka import Consumer
+    from confluent_kafka.avro import AvroConsumer, CachedSchemaRegistryClient
+    from confluent_kafka.avro.serializer.message_serializer import MessageSerializer
+
+    config = {'bootstrap.servers': opts.bootstrap, 'api.version.request': True, 'auto.offset.reset': 'earliest'}
+    serializer = MessageSerializer(CachedSchemaRegistryClient(opts.registry))
+
+    def poll_consumer():
+        c = AvroConsumer(dict(config, **{'schema.registry.url': opts.registry, 'group.id': 'bench-' + uuid.uuid4().hex}))
+        c.subscribe([opts.topic.upper()])
+        return c, lambda r: r.value()
+
+    def batch_consumer():
+        c = Consumer(dict(config, **{'group.id': 'bench-' + uuid.uuid4().hex}))
+        c.subscribe([opts.topic.upper()])
+        return c, lambda r: serializer.decode_message(r.value(), is_key=False)
+
+    return poll_consumer, batch_consumer
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", type="int", default=200000, help="records per run (default %default)")
+    parser.add_option("-s", "--sizes", default="100,500,1000", help="batch sizes (default %default)")
+    parser.add_option("-b", "--bootstrap", default=None, help="Kafka bootstrap servers, in-memory records if not set")
+    parser.add_option("-r", "--registry", default=None, help="schema registry URL")
+    parser.add_option("-t", "--topic", default=None, help="5GMETA topic to read")
+    opts, args = parser.parse_args()
+
+    if opts.bootstrap:
+        poll_consumer, batch_consumer = kafka_consumers(opts)
+    else:
+        encoded = payloads(opts.count)
+        poll_consumer = lambda: (MemoryConsumer(encoded), lambda r: r.value())
+        batch_consumer = poll_consumer
+
+    print("%-12s %-12s %12s %10s" % ("decode", "mode", "records/s", "speed-up"))
+    baseline = None
+    for name in ("full", "properties"):
+        consumer, value = poll_consumer()
+        rate = opts.count / run_poll(consumer, opts.count, DECODERS[name], value)
+        baseline = baseline or rate
+        print("%-12s %-12s %12.0f %9.1fx" % (name, "poll", rate, rate / baseline))
+        for size in [int(s) for s in opts.sizes.split(",")]:
+            consumer, value = batch_consumer()
+            rate = opts.count / run_batch(consumer, opts.count, size, DECODERS[name], value)
+            print("%-12s %-12s %12.0f %9.1fx" % (name, "batch %d" % size, rate, rate / baseline))
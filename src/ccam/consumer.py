@@ -12,7 +12,8 @@ import logging
 from pprint import pformat
 import time
 from confluent_kafka import KafkaError
-from confluent_kafka.avro import AvroConsumer
+from confluent_kafka.avro import AvroConsumer, CachedSchemaRegistryClient
+from confluent_kafka.avro.serializer.message_serializer import MessageSerializer
 from confluent_kafka.avro.serializer import SerializerError
 from confluent_kafka.cimpl import TopicPartition
 import sys
@@ -23,8 +24,15 @@ import requests
 import proton
 
 import os
-import statistics
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server
+
+# Helpers shared by the demo applications live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from codec import CodecError
+from latency import LatencyRecorder, SharedLatency, SharedLatencyRecorder, SharedRecorder, print_window
+from records import (decode_payload, payload_annotations, payload_properties, property_keys, record_batch,
+                     record_hops, record_message)
+from supervisor import Supervisor
 
 platformaddress = "5gmeta-platform.eu"
 bootstrap_port = "31090"
@@ -47,56 +55,153 @@ dataflowapi_port = "443"
 
 topic = input("Insert 5GMETA topic: ")
 
-c = AvroConsumer({
+registry_url = 'http://'+"<5gmeta-ip>"+':' + registry_port # 'http://192.168.15.44:8081'
+
+consumer_config = {
     'bootstrap.servers': "<5gmeta-ip>"+':' + bootstrap_port,
-    'schema.registry.url':'http://'+"<5gmeta-ip>"+':' + registry_port, # 'http://192.168.15.44:8081',
+    'schema.registry.url': registry_url,
     'group.id': 'group1',
     'api.version.request': True,
     'auto.offset.reset': 'earliest'
-})
-
-c.subscribe([topic.upper()])
-print("Subscribed to topic: " + str(topic))
-print("Running...")
+}
 
 i = 0
 
 monitoring_port = int(os.getenv("MONITORING_PORT", 8080))
-start_http_server(monitoring_port)
-gauge = Gauge(
-    "application_latency",
-    "Application Latency."
-)
-
-latencies = [0,0,0,0,0,0,0,0,0,0]
-def add_latency(value):
-    if len(latencies) >= 10:
-        latencies.pop(0)  # Remove the first element
-    latencies.append(value)
-
-while True:
-    msg = c.poll(0.1)
-
-    if msg is None:
-        #print("Empty msg: " + str(msg) );
-        print(".",  end="", flush=True)
-        continue
-    if msg.error():
-        print("Consumer error: {}".format(msg.error()))
-        continue
-    
-    # The AVRO Message here in mydata
-    mydata = msg.value() # .decode('latin-1') #.replace("'", '"')
-
-    # The QPID proton message: this is the message sent from the S&D to the MEC
-    raw_sd = mydata['BYTES_PAYLOAD']
-    msg_sd = proton.Message()
-    proton.Message.decode(msg_sd, raw_sd)
-
-    # The msg_sd.body contains the data of the sendor
-    latency = time.time()*1000 - msg_sd.properties['timestamp']
-    add_latency(latency)
-    gauge.set(statistics.mean(latencies))
-    print("Latency: "+ str(statistics.mean(latencies)))
-
-c.close()
+
+# Latency distribution per window of LATENCY_WINDOW seconds, optionally split by LATENCY_LABELS
+# (comma separated, among topic, sourceId, quadkey) with quadkeys cut at LATENCY_QUADKEY_ZOOM
+latency_labels = [label for label in os.getenv("LATENCY_LABELS", "topic").split(",") if label]
+latency_window = float(os.getenv("LATENCY_WINDOW", 10))
+quadkey_zoom = int(os.getenv("LATENCY_QUADKEY_ZOOM", 10))
+
+# Records per Consumer.consume call, 0 to poll and handle the records one by one
+batch_size = int(os.getenv("CONSUMER_BATCH", 0))
+
+# properties: read the application properties straight from the payload bytes, the body is not
+# decoded. full: decode the whole AMQP message, as needed to use msg_sd.body
+full_decode = os.getenv("CONSUMER_DECODE", "properties") == "full"
+keys = property_keys(latency_labels)
+
+# Per-hop latency from the stamps of the stages the messages went through, 0 to disable
+hop_latency = os.getenv("HOP_LATENCY", "1") != "0"
+
+# Worker processes in the consumer group, 0 to consume in this process
+workers = int(os.getenv("CONSUMER_WORKERS", 0))
+
+
+def consume(recorder, hop_recorder):
+    # The consumer is created in the process that uses it, librdkafka handles do not survive a fork
+    c = AvroConsumer(consumer_config)
+    c.subscribe([topic.upper()])
+    print("Subscribed to topic: " + str(topic))
+    print("Running...")
+    serializer = MessageSerializer(CachedSchemaRegistryClient(registry_url))
+
+    try:
+        while batch_size:
+            # consume() returns the raw records, their Avro values are decoded here instead of in poll()
+            records = c.consume(batch_size, 0.1)
+            properties = []
+            for msg in records:
+                if msg.error():
+                    print("Consumer error: {}".format(msg.error()))
+                    recorder.error()
+                    continue
+                try:
+                    value = serializer.decode_message(msg.value(), is_key=False)
+                except SerializerError as e:
+                    print("Message deserialization failed: {}".format(e))
+                    recorder.error()
+                    continue
+                if full_decode:
+                    try:
+                        msg_sd = decode_payload(value)
+                    except CodecError as e:
+                        print(e)
+                        recorder.error()
+                        continue
+                    properties.append(msg_sd.properties)
+                    annotations = msg_sd.annotations
+                else:
+                    properties.append(payload_properties(value, keys))
+                    annotations = payload_annotations(value) if hop_latency else None
+                if hop_latency:
+                    record_hops(hop_recorder, annotations, properties[-1])
+            record_batch(recorder, properties, topic, quadkey_zoom)
+
+        while True:
+            msg = c.poll(0.1)
+
+            if msg is None:
+                #print("Empty msg: " + str(msg) );
+                print(".",  end="", flush=True)
+                continue
+            if msg.error():
+                print("Consumer error: {}".format(msg.error()))
+                recorder.error()
+                continue
+
+            # The AVRO Message here in mydata
+            mydata = msg.value() # .decode('latin-1') #.replace("'", '"')
+
+            if not full_decode:
+                properties = payload_properties(mydata, keys)
+                record_message(recorder, properties, topic, quadkey_zoom)
+                if hop_latency:
+                    record_hops(hop_recorder, payload_annotations(mydata), properties)
+                continue
+
+            # The QPID proton message: this is the message sent from the S&D to the MEC
+            try:
+                msg_sd = decode_payload(mydata)
+            except CodecError as e:
+                print(e)
+                recorder.error()
+                continue
+
+            # The msg_sd.body contains the data of the sendor
+            record_message(recorder, msg_sd.properties, topic, quadkey_zoom)
+            if hop_latency:
+                record_hops(hop_recorder, msg_sd.annotations, msg_sd.properties)
+    finally:
+        c.close()
+
+
+if workers:
+    # The workers record in their slot of the shared memory, this process serves the merged metrics
+    shared = SharedLatency(workers, max_series=int(os.getenv("LATENCY_MAX_SERIES", 64)))
+    shared_hops = SharedLatency(workers, max_series=32)
+    recorder = SharedLatencyRecorder(shared, "application_latency", labels=latency_labels,
+                                     window=latency_window, on_window=print_window)
+    hop_recorder = SharedLatencyRecorder(shared_hops, "hop_latency", labels=("hop",), window=latency_window,
+                                         on_window=print_window)
+
+    def tick():
+        recorder.tick()
+        hop_recorder.tick()
+
+    # Only this process serves the metrics, once the workers are forked
+    server = []
+
+    def serve():
+        server.append(start_http_server(monitoring_port))
+
+    def work(slot):
+        # A worker started again later is forked with the listening socket: it closes its copy
+        if server and server[0]:
+            server[0][0].socket.close()
+        consume(SharedRecorder(shared, slot, latency_labels), SharedRecorder(shared_hops, slot, ("hop",)))
+
+    supervisor = Supervisor(workers, work)
+    supervisor.run(tick=tick, on_started=serve)
+else:
+    recorder = LatencyRecorder(
+        "application_latency",
+        labels=latency_labels,
+        window=latency_window,
+        on_window=print_window
+    )
+    hop_recorder = LatencyRecorder("hop_latency", labels=("hop",), window=latency_window, on_window=print_window)
+    start_http_server(monitoring_port)
+    consume(recorder, hop_recorder)
@@ -0,0 +1,88 @@
+#
+# Decoding and latency accounting of the records read from a 5GMETA Kafka topic.
+#
+# Every Kafka record carries, in its BYTES_PAYLOAD Avro field, the AMQP message sent from the S&D
+# to the MEC. The consumer either handles the records one by one (record_message, the historical
+# loop) or a whole batch from Consumer.consume at once (record_batch): the timestamps of the batch
+# are gathered in a NumPy array, the latencies are computed in one vector operation against a single
+# receive time and the histograms are updated once per label set instead of once per record.
+#
+# Only the application properties are needed for the latency, so payload_properties() reads them
+# straight from the encoded payload (see utils/sections.py) without decoding the body; decode_payload()
+# builds the whole proton.Message for the consumers that use the body. The hop stamps of the stages
+# the message went through (see utils/hops.py) are read the same way from the message annotations.
+
+import os
+import sys
+import time
+
+import numpy
+import proton
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from codec import decompress
+from hops import HOPS, segments
+from latency import message_labels
+from sections import application_properties, message_annotations
+
+
+# The AMQP message of a decoded Avro value
+def decode_payload(value):
+    message = proton.Message()
+    message.decode(value['BYTES_PAYLOAD'])
+    return decompress(message)
+
+
+# Application properties of the payload read by the latency accounting
+def property_keys(labels):
+    names = {"quadkey": "locationQuadkey"}
+    return ("timestamp",) + tuple(names.get(label, label) for label in labels if label != "topic")
+
+
+# The application properties of a decoded Avro value, only `keys` if given
+def payload_properties(value, keys=None):
+    return application_properties(value['BYTES_PAYLOAD'], keys)
+
+
+# The hop stamps annotation of a decoded Avro value
+def payload_annotations(value):
+    return message_annotations(value['BYTES_PAYLOAD'], (HOPS,))
+
+
+# Records the time spent between the hop stamps, if the message has some
+def record_hops(recorder, annotations, properties, hop="ccam", now=None):
+    if annotations and HOPS in annotations:
+        for name, duration in segments(hop=hop, now=now, annotations=annotations, properties=properties):
+            recorder.record(duration, (name,))
+
+
+def record_message(recorder, properties, topic, quadkey_zoom=10):
+    latency = time.time()*1000 - properties['timestamp']
+    recorder.record(latency, message_labels(properties, recorder.labels, topic, quadkey_zoom))
+    return latency
+
+
+# Records the latencies of the messages, given by their application properties, received at `now`
+# (ms since epoch)
+def record_batch(recorder, properties, topic, quadkey_zoom=10, now=None):
+    if not properties:
+        return None
+    if now is None:
+        now = time.time()*1000
+    if not recorder.labels or recorder.labels == ("topic",):
+        # Same label set for the whole batch
+        timestamps = numpy.fromiter((p['timestamp'] for p in properties),
+                                    dtype=numpy.float64, count=len(properties))
+        latencies = now - timestamps
+        recorder.record_many(latencies, message_labels({}, recorder.labels, topic, quadkey_zoom))
+        return latencies
+    groups = {}
+    for p in properties:
+        labels = message_labels(p, recorder.labels, topic, quadkey_zoom)
+        groups.setdefault(labels, []).append(p['timestamp'])
+    latencies = []
+    for labels, timestamps in groups.items():
+        values = now - numpy.asarray(timestamps, dtype=numpy.float64)
+        recorder.record_many(values, labels)
+        latencies.append(values)
+    return numpy.concatenate(latencies)
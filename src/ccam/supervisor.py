@@ -0,0 +1,113 @@
+#
+# Supervisor of the partition-parallel ccam consumer.
+#
+# The supervisor forks `workers` processes that run the same consumer in the same consumer group, so
+# Kafka spreads the partitions of the topic among them. Each worker gets a slot number and records
+# its latencies in that slot of a SharedLatency created before the fork; the supervisor serves the
+# merged histograms. A worker that exits is started again in the same slot after `restart_delay`
+# seconds, doubled for every crash in a row up to `max_delay`.
+
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+try:
+    from prometheus_client import Counter
+except ImportError:
+    Counter = None
+
+
+def _exit(signum, frame):
+    raise SystemExit(0)
+
+
+class Supervisor:
+    if Counter is not None:
+        _restarts = Counter("ccam_worker_restarts", "Worker processes started again after they exited.", ["worker"])
+
+    def __init__(self, workers, target, restart_delay=1.0, max_delay=30.0, stable_after=60.0):
+        # target(slot) runs one worker, in the forked process
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_delay = max_delay
+        # A worker that ran that long is not crashing in a loop, its restart delay starts over
+        self.stable_after = stable_after
+        self.restarts = [0] * workers
+        self._context = multiprocessing.get_context("fork")
+        self._processes = [None] * workers
+        self._started = [0.0] * workers
+        self._delays = [restart_delay] * workers
+        self._due = {}
+        self._running = False
+
+    def _spawn(self, slot):
+        process = self._context.Process(target=self._worker, args=(slot,), name="ccam-worker-%d" % slot)
+        process.daemon = True
+        process.start()
+        self._processes[slot] = process
+        self._started[slot] = time.time()
+        print("Worker %d started, pid %d" % (slot, process.pid))
+
+    def _worker(self, slot):
+        # terminate() lets the worker leave the consumer group cleanly
+        signal.signal(signal.SIGTERM, _exit)
+        self.target(slot)
+
+    def _exited(self, slot, now):
+        process = self._processes[slot]
+        process.join()
+        self._processes[slot] = None
+        if now - self._started[slot] >= self.stable_after:
+            self._delays[slot] = self.restart_delay
+        delay = self._delays[slot]
+        self._delays[slot] = min(delay * 2, self.max_delay)
+        self._due[slot] = now + delay
+        print("Worker %d exited with code %s, restart in %.1f s" % (slot, process.exitcode, delay))
+
+    def _stop(self, signum, frame):
+        self._running = False
+
+    # Runs until SIGTERM or SIGINT, calling on_started() once the workers are forked (e.g. to start
+    # threads and servers in this process only) and tick() about every `interval` seconds
+    def run(self, tick=None, interval=1.0, on_started=None):
+        self._running = True
+        previous = signal.signal(signal.SIGTERM, self._stop)
+        try:
+            for slot in range(self.workers):
+                self._spawn(slot)
+            if on_started is not None:
+                on_started()
+            while self._running:
+                sentinels = dict((p.sentinel, slot) for slot, p in enumerate(self._processes) if p is not None)
+                ready = multiprocessing.connection.wait(list(sentinels), timeout=interval)
+                now = time.time()
+                for sentinel in ready:
+                    self._exited(sentinels[sentinel], now)
+                for slot, due in list(self._due.items()):
+                    if now >= due:
+                        del self._due[slot]
+                        self.restarts[slot] += 1
+                        if Counter is not None:
+                            self._restarts.labels(str(slot)).inc()
+                        self._spawn(slot)
+                if tick is not None:
+                    tick()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self.stop()
+
+    def stop(self, timeout=10.0):
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for slot, process in enumerate(self._processes):
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+                self._processes[slot] = None
@@ -1,18 +1,39 @@
 from proton import Url
-from proton.reactor import Container, Selector
+from proton.reactor import ApplicationEvent, Container, EventInjector, Selector
 from proton.handlers import MessagingHandler
 
+import collections
 import os
+import queue
+import sys
+import threading
 import time
-import statistics
 from prometheus_client import start_http_server, Gauge
 
+# Helpers shared by the demo applications live in src/utils (on the PYTHONPATH in the image)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from batch import unpack
+from chunks import Reassembler
+from codec import CodecError, decompress
+from hops import HOPS, segments
+from latency import LatencyRecorder, message_labels
+from selector import quadkey_selector
+
 monitoring_port = int(os.getenv("MONITORING_PORT", 8081))
 start_http_server(monitoring_port)
-gauge = Gauge(
+
+# Latency distribution per window of LATENCY_WINDOW seconds, optionally split by LATENCY_LABELS
+# (comma separated, among topic, sourceId, quadkey) with quadkeys cut at LATENCY_QUADKEY_ZOOM
+recorder = LatencyRecorder(
     "application_latency",
-    "Application Latency."
+    labels=[label for label in os.getenv("LATENCY_LABELS", "topic").split(",") if label],
+    window=float(os.getenv("LATENCY_WINDOW", 10))
 )
+quadkey_zoom = int(os.getenv("LATENCY_QUADKEY_ZOOM", 10))
+
+# Per-hop latency from the stamps of the stages the messages went through, 0 to disable
+hop_latency = os.getenv("HOP_LATENCY", "1") != "0"
+hop_recorder = LatencyRecorder("hop_latency", labels=("hop",), window=float(os.getenv("LATENCY_WINDOW", 10)))
 
 username = os.getenv("AMQP_USER")
 password = os.getenv("AMQP_PASS")
@@ -20,32 +41,190 @@ ip = os.getenv("AMQP_IP", "127.0.0.1")
 port = os.getenv("AMQP_PORT", "5673")
 topic = os.getenv("AMQP_TOPIC", "cits-large")
 
-latencies = [0,0,0,0,0,0,0,0,0,0]
-def add_latency(value):
-    if len(latencies) >= 10:
-        latencies.pop(0)  # Remove the first element
-    latencies.append(value)
+# Broker-side filter: only the messages in the LLCCAM_QUADKEYS tiles (comma separated, any zoom) and
+# of the LLCCAM_DATATYPE / LLCCAM_DATASUBTYPE types (comma separated) are delivered
+selector = quadkey_selector(
+    [tile for tile in os.getenv("LLCCAM_QUADKEYS", "").split(",") if tile],
+    [t for t in os.getenv("LLCCAM_DATATYPE", "").split(",") if t],
+    [t for t in os.getenv("LLCCAM_DATASUBTYPE", "").split(",") if t],
+    max_tiles=int(os.getenv("LLCCAM_MAX_TILES", 32))
+)
+options = Selector(selector) if selector else None
+
+# High-throughput mode: LLCCAM_WORKERS threads process the messages, LLCCAM_PREFETCH is the credit
+# window (a number, or "auto" to adapt it between LLCCAM_MIN_CREDIT and LLCCAM_MAX_CREDIT)
+workers = int(os.getenv("LLCCAM_WORKERS", 0))
+prefetch = os.getenv("LLCCAM_PREFETCH", "10")
+min_credit = int(os.getenv("LLCCAM_MIN_CREDIT", 10))
+max_credit = int(os.getenv("LLCCAM_MAX_CREDIT", 5000))
+
+# Messages sent in chunks (large video frames) are rebuilt before they are processed, the groups not
+# complete after LLCCAM_CHUNK_TIMEOUT seconds are discarded
+reassembler = Reassembler(timeout=float(os.getenv("LLCCAM_CHUNK_TIMEOUT", 5)))
+
+
+# Latency accounting of one message (or of the items of a batch), returns the latencies. A message
+# that cannot be decompressed is counted as an error and skipped
+def process(message):
+    latencies = []
+    message = reassembler.add(message)
+    if message is None:
+        return latencies
+    try:
+        message = decompress(message)
+    except CodecError as e:
+        print(e)
+        recorder.error()
+        return latencies
+    for item in unpack(message):
+        latency = time.time()*1000 - item.properties['timestamp']
+        recorder.record(latency, message_labels(item.properties, recorder.labels, topic, quadkey_zoom))
+        if hop_latency and item.annotations and HOPS in item.annotations:
+            for hop, duration in segments(item, "llccam"):
+                hop_recorder.record(duration, (hop,))
+        latencies.append(latency)
+    return latencies
+
 
 class Recv(MessagingHandler):
-    def __init__(self, url):
-        super(Recv, self).__init__()
+    def __init__(self, url, options=None, **kwargs):
+        super(Recv, self).__init__(**kwargs)
         self.url = Url(url)
+        # Receiver options, e.g. the Selector of the quadkey and data type filter
+        self.options = options
         self.received = 0
 
     def on_start(self, event):
         conn = event.container.connect(self.url)
-        event.container.create_receiver(conn, self.url.path)
+        event.container.create_receiver(conn, self.url.path, options=self.options)
 
     def on_message(self, event):
-        latency = time.time()*1000 - event.message.properties['timestamp']
-        print(latency)
-        add_latency(latency)
-        gauge.set(statistics.mean(latencies))
+        for latency in process(event.message):
+            print(latency)
+
+        self.received += 1
+
+
+# Receive rate over sliding windows and the highest rate sustained over a whole window
+class RateMeter:
+    def __init__(self, window=5.0):
+        self.window = window
+        self.max_sustained = 0.0
+        self._samples = collections.deque()
 
+    # Called about every second with the count of messages processed so far
+    def sample(self, count, now=None):
+        now = now or time.time()
+        self._samples.append((now, count))
+        while now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+        start, first = self._samples[0]
+        if now - start < self.window * 0.8:
+            return 0.0
+        rate = (count - first) / (now - start)
+        self.max_sustained = max(self.max_sustained, rate)
+        return rate
+
+
+# Receiver of the high-throughput mode. The reactor thread only receives: the messages go to a pool
+# of worker threads through a bounded queue, the workers hand the processed deliveries back through
+# an EventInjector and the reactor accepts them in batches and gives as much credit back. The credit
+# window bounds the messages in flight; with prefetch "auto" it doubles while the workers are idle
+# and halves when the queue backs up.
+class PoolRecv(Recv):
+    def __init__(self, url, workers, prefetch="auto", min_credit=10, max_credit=5000, report_interval=1.0,
+                 options=None):
+        super(PoolRecv, self).__init__(url, options, prefetch=0, auto_accept=False)
+        self.adaptive = prefetch == "auto"
+        self.min_credit = min_credit
+        self.max_credit = max_credit
+        self.window = min_credit * 10 if self.adaptive else int(prefetch)
+        self.window = max(min_credit, min(self.window, max_credit))
+        self.report_interval = report_interval
+        self.processed = 0
+        self.meter = RateMeter()
+        self._in_flight = 0
+        self._queue = queue.Queue(max_credit)
+        self._done = collections.deque()
+        self._ack_pending = threading.Event()
+        self._injector = EventInjector()
+        self._receiver = None
+        self._threads = [threading.Thread(target=self._work, name="llccam-worker-%d" % i) for i in range(workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def on_start(self, event):
+        event.container.selectable(self._injector)
+        conn = event.container.connect(self.url)
+        self._receiver = event.container.create_receiver(conn, self.url.path, options=self.options)
+        self._flow()
+        event.container.schedule(self.report_interval, self)
+
+    def _flow(self):
+        credit = self.window - self._in_flight - self._receiver.credit
+        if credit > 0:
+            self._receiver.flow(credit)
+
+    def on_message(self, event):
         self.received += 1
+        self._in_flight += 1
+        self._queue.put_nowait((event.delivery, event.message))
+
+    def _work(self):
+        while True:
+            delivery, message = self._queue.get()
+            try:
+                process(message)
+            except Exception as e:
+                print("Processing failed: %s" % e)
+            self._done.append(delivery)
+            if not self._ack_pending.is_set():
+                self._ack_pending.set()
+                self._injector.trigger(ApplicationEvent("acks"))
+
+    # Deliveries processed by the workers, on the reactor thread
+    def on_acks(self, event):
+        self._ack_pending.clear()
+        count = 0
+        while self._done:
+            self.accept(self._done.popleft())
+            count += 1
+        self._in_flight -= count
+        self.processed += count
+        if self.adaptive:
+            backlog = self._queue.qsize()
+            if backlog < len(self._threads) and self.window < self.max_credit:
+                self.window = min(self.window * 2, self.max_credit)
+            elif backlog > self.window * 3 // 4 and self.window > self.min_credit:
+                self.window = max(self.window // 2, self.min_credit)
+        self._flow()
+
+    def on_timer_task(self, event):
+        rate = self.meter.sample(self.processed)
+        receive_rate.set(rate)
+        max_sustained_rate.set(self.meter.max_sustained)
+        print("Processed %d messages, %.0f msg/s, max sustained %.0f msg/s, credit window %d" % (
+            self.processed, rate, self.meter.max_sustained, self.window))
+        event.container.schedule(self.report_interval, self)
+
+
+receive_rate = Gauge("llccam_receive_rate", "Messages processed per second over the last window.")
+max_sustained_rate = Gauge("llccam_max_sustained_rate", "Highest receive rate sustained over a whole window.")
 
-# Configuration
-url = f'amqp://{username}:{password}@{ip}:{port}/topic://{topic}'  # Replace with your broker URL
+if __name__ == "__main__":
+    if selector:
+        print("Selector: " + selector)
+    # Configuration
+    url = f'amqp://{username}:{password}@{ip}:{port}/topic://{topic}'  # Replace with your broker URL
 
-# Create and run the subscriber
-Container(Recv(url)).run()
+    # Create and run the subscriber
+    if workers:
+        receiver = PoolRecv(url, workers, prefetch, min_credit, max_credit, options=options)
+        try:
+            Container(receiver).run()
+        except KeyboardInterrupt:
+            pass
+        print("Max sustained receive rate: %.0f msg/s" % receiver.meter.max_sustained)
+    else:
+        Container(Recv(url, options, prefetch=10 if prefetch == "auto" else int(prefetch))).run()
@@ -0,0 +1,314 @@
+#
+# asyncio-native sender.
+#
+# Registration, keepalive and publishing of every dataflow run as tasks on a single event loop:
+#   - the registration API is called through one pooled aiohttp session;
+#   - the AMQP connection is the proton engine (Connection/Transport/Collector) driven by asyncio
+#     streams, one connection with one sender link per topic shared by all the dataflows;
+#   - a dataflow publishes only while its send flag is set and waits on it otherwise, so it resumes
+#     as soon as a keepalive flips the flag; backpressure comes from the AMQP link credit.
+#
+# Example: 200 dataflows at 1 CAM/s each from one process
+#   python3 async_sender.py --dataflows 200 --rate 1
+
+from __future__ import print_function
+
+import asyncio
+import copy
+import optparse
+import time
+
+import aiohttp
+from proton import Collector, Connection, Delivery, Event, Link, Transport, Url
+
+import content
+from sender import RateMeter, dataflowmetadata, body, platformaddress, registrationapi_port, amqp_port
+
+
+# Sender link of an AmqpConnection. send() waits while the link has no credit
+class AmqpLink:
+    def __init__(self, link, closed):
+        self.link = link
+        self.closed = closed
+        self.credit = asyncio.Event()
+        self.sent = 0
+        self.accepted = 0
+
+    async def send(self, data):
+        while not self.link.credit:
+            if self.closed.is_set():
+                raise ConnectionError("AMQP connection closed")
+            self.credit.clear()
+            await self.credit.wait()
+        dlv = self.link.delivery(self.link.delivery_tag())
+        self.link.stream(data)
+        self.link.advance()
+        if self.link.snd_settle_mode == Link.SND_SETTLED:
+            dlv.settle()
+        self.sent += 1
+        return dlv
+
+
+# AMQP 1.0 connection on asyncio streams: the proton engine does the protocol, the event loop the I/O
+class AmqpConnection:
+    def __init__(self, url):
+        self.url = Url(url)
+        self.links = {}
+        # Set while there is no open connection
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self._conn = None
+        self._transport = None
+        self._collector = None
+        self._session = None
+        self._writer = None
+        self._tasks = []
+
+    async def open(self):
+        reader, self._writer = await asyncio.open_connection(self.url.host, self.url.port)
+        self._collector = Collector()
+        self._conn = Connection()
+        self._conn.collect(self._collector)
+        self._conn.hostname = self.url.host
+        if self.url.username:
+            self._conn.user = self.url.username
+            self._conn.password = self.url.password
+        self._transport = Transport()
+        self._transport.sasl().allowed_mechs("PLAIN" if self.url.username else "ANONYMOUS")
+        self._transport.bind(self._conn)
+        self._conn.open()
+        self._session = self._conn.session()
+        self._session.open()
+        self.closed.clear()
+        self._tasks = [asyncio.ensure_future(self._read(reader)), asyncio.ensure_future(self._tick())]
+        self._flush()
+
+    def sender(self, address):
+        if address not in self.links:
+            link = self._session.sender(address)
+            link.target.address = address
+            link.open()
+            self.links[address] = AmqpLink(link, self.closed)
+            self._flush()
+        return self.links[address]
+
+    async def send(self, address, data):
+        dlv = await self.sender(address).send(data)
+        self._flush()
+        return dlv
+
+    async def _read(self, reader):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    self._transport.close_tail()
+                    break
+                while data:
+                    capacity = self._transport.capacity()
+                    if capacity < 0:
+                        raise ConnectionError("AMQP transport closed for input")
+                    if capacity == 0:
+                        # Input buffer full: let the transport work through it, keep the rest of `data`
+                        self._process()
+                        self._flush()
+                        await asyncio.sleep(0)
+                        continue
+                    self._transport.push(data[:capacity])
+                    data = data[capacity:]
+                self._process()
+                self._flush()
+        except (ConnectionError, OSError) as err:
+            print("Connection error: " + str(err))
+        finally:
+            self._shutdown()
+
+    async def _tick(self):
+        while not self.closed.is_set():
+            now = time.time()
+            deadline = self._transport.tick(now)
+            self._flush()
+            await asyncio.sleep(min(max(deadline - now, 0.01), 1.0) if deadline else 1.0)
+
+    def _process(self):
+        event = self._collector.peek()
+        while event:
+            if event.type == Event.LINK_FLOW:
+                amqp_link = self.links.get(event.link.target.address)
+                if amqp_link and event.link.credit:
+                    amqp_link.credit.set()
+            elif event.type == Event.DELIVERY:
+                dlv = event.delivery
+                if dlv.updated and dlv.remote_state:
+                    amqp_link = self.links.get(dlv.link.target.address)
+                    if amqp_link and dlv.remote_state == Delivery.ACCEPTED:
+                        amqp_link.accepted += 1
+                    elif dlv.remote_state in (Delivery.REJECTED, Delivery.RELEASED, Delivery.MODIFIED):
+                        print("Message not accepted by the broker: " + str(dlv.remote_state))
+                    dlv.settle()
+            elif event.type in (Event.CONNECTION_REMOTE_CLOSE, Event.LINK_REMOTE_CLOSE):
+                condition = event.context.remote_condition
+                if condition:
+                    print("Closed by the broker: " + str(condition))
+            elif event.type == Event.TRANSPORT_ERROR:
+                print("Transport error: " + str(event.transport.condition))
+            elif event.type == Event.TRANSPORT_CLOSED:
+                self._shutdown()
+            self._collector.pop()
+            event = self._collector.peek()
+
+    def _flush(self):
+        if self._writer is None:
+            return
+        pending = self._transport.pending()
+        if pending > 0:
+            self._writer.write(self._transport.peek(pending))
+            self._transport.pop(pending)
+        elif pending < 0:
+            self._shutdown()
+
+    def _shutdown(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        # Wake up the senders waiting for credit, their next send fails on the closed link
+        for amqp_link in self.links.values():
+            amqp_link.credit.set()
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    async def close(self):
+        if self._conn is not None and not self.closed.is_set():
+            self._conn.close()
+            self._flush()
+        self._shutdown()
+
+
+# A registered dataflow: keeps itself alive and publishes its CAMs while the platform allows it
+class Dataflow:
+    def __init__(self, http, api, metadata, msgbody, rate, keepalive=30.0):
+        self.http = http
+        self.api = api
+        self.metadata = metadata
+        self.rate = rate
+        self.keepalive_interval = keepalive
+        self.id = -1
+        self.topic = None
+        self.sending = asyncio.Event()
+        props = content.message_generator(msgbody).properties
+        props["sourceId"] = metadata["dataSourceInfo"]["sourceId"]
+        self.template = content.MessageTemplate(msgbody, props)
+
+    def _update(self, send):
+        if send:
+            self.sending.set()
+        else:
+            self.sending.clear()
+
+    # True once registered, False if the registration failed
+    async def register(self):
+        try:
+            async with self.http.post(self.api + "/dataflows", json=self.metadata) as r:
+                r.raise_for_status()
+                reply = await r.json()
+            print(reply)
+            self.id = reply["id"]
+            self.topic = reply["topic"]
+            self._update(reply["send"])
+            return True
+        except Exception as err:
+            print("Registration of source %s failed: %s" % (self.metadata["dataSourceInfo"]["sourceId"], err))
+            return False
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                async with self.http.put(self.api + "/dataflows/" + str(self.id), json=self.metadata) as r:
+                    self._update((await r.json())["send"])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                print("Keepalive of dataflow %s failed: %s" % (self.id, err))
+
+    async def publish(self, connection, meter):
+        interval = 1.0 / self.rate
+        deadline = time.time()
+        while True:
+            if not self.sending.is_set():
+                await self.sending.wait()
+                deadline = time.time()
+            if connection.closed.is_set():
+                await asyncio.sleep(1.0)
+                deadline = time.time()
+                continue
+            try:
+                await connection.send("topic://" + self.topic, bytes(self.template.encode()))
+            except ConnectionError:
+                deadline = time.time()
+                continue
+            meter.add()
+            deadline += interval
+            await asyncio.sleep(max(0.0, deadline - time.time()))
+
+
+# Opens the AMQP connection again whenever it drops
+async def maintain(connection, backoff=1.0):
+    while True:
+        try:
+            await connection.open()
+            await connection.closed.wait()
+        except OSError as err:
+            print("Cannot connect to the broker: " + str(err))
+        connection.links.clear()
+        await asyncio.sleep(backoff)
+
+
+async def main(opts):
+    meter = RateMeter()
+    api = "http://" + platformaddress + ":" + registrationapi_port
+    connection = AmqpConnection(opts.url)
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=opts.http_pool)) as http:
+        dataflows = []
+        for i in range(opts.dataflows):
+            metadata = copy.deepcopy(dataflowmetadata)
+            metadata["dataSourceInfo"]["sourceId"] = opts.first_source_id + i
+            dataflows.append(Dataflow(http, api, metadata, body, opts.rate))
+        # The vehicles whose registration failed are left out
+        registered = await asyncio.gather(*[dataflow.register() for dataflow in dataflows])
+        failures = registered.count(False)
+        dataflows = [dataflow for dataflow, ok in zip(dataflows, registered) if ok]
+        if failures:
+            print("%d of %d registrations failed" % (failures, opts.dataflows))
+        if not dataflows:
+            return
+
+        tasks = [asyncio.ensure_future(maintain(connection))]
+        for dataflow in dataflows:
+            tasks.append(asyncio.ensure_future(dataflow.keepalive()))
+            tasks.append(asyncio.ensure_future(dataflow.publish(connection, meter)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            meter.summary()
+            await connection.close()
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--dataflows", type="int", default=1, help="dataflows hosted by this process (default %default)")
+    parser.add_option("-r", "--rate", type="float", default=1.0, help="messages per second per dataflow (default %default)")
+    parser.add_option("--first-source-id", type="int", default=dataflowmetadata["dataSourceInfo"]["sourceId"],
+                      help="sourceId of the first dataflow (default %default)")
+    parser.add_option("--url", default="amqp://<username>:<password>@" + platformaddress + ":" + amqp_port,
+                      help="AMQP broker URL (default %default)")
+    parser.add_option("--http-pool", type="int", default=8, help="pooled HTTP connections to the registration API (default %default)")
+    opts, args = parser.parse_args()
+
+    try:
+        asyncio.run(main(opts))
+    except KeyboardInterrupt:
+        pass
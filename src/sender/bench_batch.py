@@ -0,0 +1,104 @@
+#
+# Benchmark of the batching envelope for the CAM used in sender.py.
+#
+# Without --url: Python cost (encode on the publisher, decode and unpack on the consumer) and
+# wire bytes per CAM, for single messages and for batches of several sizes.
+# With --url: CAM/s through a broker, from one sender link to one receiver link on the address.
+#
+# Usage: python3 bench_batch.py [--url amqp://127.0.0.1:5672/topic://bench] [--count 20000]
+
+from __future__ import print_function
+
+import optparse
+import os
+import sys
+import time
+
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
+
+import content
+from sender import body
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from batch import pack, unpack
+
+
+def envelopes(messages, size):
+    if size <= 1:
+        return messages
+    return [pack(messages[i:i + size]) for i in range(0, len(messages), size)]
+
+
+def python_cost(count, size):
+    messages = [content.message_generator(body) for _ in range(count)]
+    started = time.perf_counter()
+    encoded = [m.encode() for m in envelopes(messages, size)]
+    encode = time.perf_counter() - started
+    started = time.perf_counter()
+    items = 0
+    for data in encoded:
+        m = Message()
+        m.decode(data)
+        items += len(unpack(m))
+    decode = time.perf_counter() - started
+    assert items == count
+    return encode / count * 1e6, decode / count * 1e6, sum(len(d) for d in encoded) / float(count)
+
+
+# Sends the envelopes on one link and counts the CAMs coming back on another link
+class Roundtrip(MessagingHandler):
+    def __init__(self, url, messages, count):
+        super(Roundtrip, self).__init__(prefetch=100)
+        self.url = url
+        self.messages = messages
+        self.count = count
+        self.received = 0
+        self._index = 0
+        self._started = 0
+        self.elapsed = 0
+
+    def on_start(self, event):
+        conn = event.container.connect(self.url)
+        address = self.url.split("/", 3)[3]
+        event.container.create_receiver(conn, address)
+        self.sender = event.container.create_sender(conn, address)
+
+    def on_link_opened(self, event):
+        if event.receiver and not self._started:
+            self._started = time.time()
+
+    def on_sendable(self, event):
+        if not self._started:
+            return
+        while event.sender.credit and self._index < len(self.messages):
+            event.sender.send(self.messages[self._index])
+            self._index += 1
+
+    def on_message(self, event):
+        self.received += len(unpack(event.message))
+        if self.received >= self.count:
+            self.elapsed = time.time() - self._started
+            event.connection.close()
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-u", "--url", default=None, help="broker address for the end-to-end run")
+    parser.add_option("-n", "--count", type="int", default=20000, help="CAMs per run (default %default)")
+    parser.add_option("-s", "--sizes", default="1,10,50,100", help="batch sizes (default %default)")
+    opts, args = parser.parse_args()
+    sizes = [int(s) for s in opts.sizes.split(",")]
+
+    print("%-6s %14s %14s %14s" % ("batch", "encode us/CAM", "decode us/CAM", "bytes/CAM"))
+    for size in sizes:
+        print("%-6d %14.2f %14.2f %14.1f" % ((size,) + python_cost(opts.count, size)))
+
+    if opts.url:
+        print("\n%-6s %10s" % ("batch", "CAM/s"))
+        for size in sizes:
+            messages = [content.message_generator(body) for _ in range(opts.count)]
+            run = Roundtrip(opts.url, envelopes(messages, size), opts.count)
+            Container(run).run()
+            print("%-6d %10.0f" % (size, opts.count / run.elapsed))
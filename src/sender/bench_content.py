@@ -0,0 +1,32 @@
+#
+# Microbenchmark of the per-message encode cost of the CAM used in sender.py:
+#   message_generator + Message.encode   (a new Message for every message)
+#   MessageTemplate.encode               (pre-encoded bytes, timestamp patched in place)
+#
+# Usage: python3 bench_content.py [iterations]
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+import content
+from sender import body
+
+
+def bench(label, fn, number):
+    # Best of 5 repetitions to filter out scheduling noise
+    best = min(timeit.repeat(fn, number=number, repeat=5))
+    print("%-40s %8.2f us/msg %10.0f msg/s" % (label, best / number * 1e6, number / best))
+    return best
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    template = content.MessageTemplate(body)
+    print("CAM body %d bytes, encoded message %d bytes\n" % (len(body), template.size))
+
+    before = bench("message_generator + Message.encode", lambda: content.message_generator(body).encode(), number)
+    after = bench("MessageTemplate.encode", template.encode, number)
+    print("\nSpeed-up: %.1fx" % (before / after))
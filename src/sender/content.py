@@ -1,29 +1,79 @@
 from proton import Message
-from proton import symbol, ulong, PropertyDict
+from proton import symbol, ulong, PropertyDict, Link
 import base64
 import sys
 import random
+import time
+import struct
 
 messages = [Message(subject='s%d' % i, body=u'b%d' % i) for i in range(10)]
 
 
+#
+# This method creates a single CAM message stamped with the current time.
+#
+def message_generator(msgbody):
+    props = {
+                "dataType": "cits", 
+                "dataSubType": "cam", 
+                "dataFormat": "asn1_jer",
+                "sourceId": 1, 
+                "locationQuadkey": "12022301011102", 
+                "timestamp": time.time()*1000,
+                "body_size": str(sys.getsizeof(msgbody))
+                }
+    return Message(body= msgbody, properties=props)
+
+
 def messages_generator(num, msgbody):
     messages.clear()
 
     print("Sender prepare the messages... ")
-    import time
     random.seed(time.time()*1000)
     for i in range(num):        
-        props = {
-                    "dataType": "cits", 
-                    "dataSubType": "cam", 
-                    "dataFormat": "asn1_jer",
-                    "sourceId": 1, 
-                    "locationQuadkey": "12022301011102", 
-                    "timestamp": time.time()*1000,
-                    "body_size": str(sys.getsizeof(msgbody))
-                    }
-        messages.append(Message(body= msgbody, properties=props))
+        messages.append(message_generator(msgbody))
         #print(messages[i])
 
     print("Message array done! \n")
+
+
+#
+# Pre-encoded CAM message. The static parts (body and constant properties) are encoded once and
+# the dynamic properties (AMQP doubles, e.g. the timestamp) are patched in place in a copy of the
+# encoded bytes, so that no Message is built or encoded for every message sent.
+#
+class MessageTemplate:
+    # Distinct placeholders that cannot collide with real values or with the body bytes
+    _sentinels = [-1.0e300 - i * 1.0e285 for i in range(8)]
+
+    def __init__(self, msgbody, properties=None, dynamic=("timestamp",)):
+        props = dict(properties or message_generator(msgbody).properties)
+        for name, sentinel in zip(dynamic, self._sentinels):
+            props[name] = sentinel
+        self._encoded = Message(body=msgbody, properties=props).encode()
+        self.offsets = {}
+        for name, sentinel in zip(dynamic, self._sentinels):
+            # AMQP double: format code 0x82 followed by 8 bytes big endian
+            marker = b"\x82" + struct.pack(">d", sentinel)
+            offset = self._encoded.find(marker)
+            if offset < 0 or self._encoded.find(marker, offset + 1) >= 0:
+                raise ValueError("Cannot locate the encoded value of property " + name)
+            self.offsets[name] = offset + 1
+        self.size = len(self._encoded)
+
+    # Wire bytes of a message, dynamic fields not given default to the current time in ms
+    def encode(self, **values):
+        buf = bytearray(self._encoded)
+        now = time.time()*1000
+        for name, offset in self.offsets.items():
+            struct.pack_into(">d", buf, offset, values.get(name, now))
+        return buf
+
+    # Equivalent of Message.send() for the patched bytes
+    def send(self, sender, tag=None, **values):
+        dlv = sender.delivery(tag or sender.delivery_tag())
+        sender.stream(bytes(self.encode(**values)))
+        sender.advance()
+        if sender.snd_settle_mode == Link.SND_SETTLED:
+            dlv.settle()
+        return dlv
@@ -0,0 +1,379 @@
+#
+# Fleet-scale CAM load generator.
+#
+# Simulates many vehicles from one command. Every vehicle registers its own dataflow (own sourceId
+# and quadkey) and moves along its own trajectory. The vehicles of a worker process are
+# multiplexed over a few shared AMQP connections. Vehicles are sharded across worker processes
+# so that more than one core can be used.
+#
+# Example:
+#   python3 fleet.py --vehicles 2000 --rate 1 --connections 4 --workers 4 --duration 120
+#
+# Every report interval the parent process prints the achieved msg/s, bytes/s and the send-side
+# latency percentiles (time between the transfer and the broker's acceptance).
+
+from __future__ import print_function
+
+import optparse
+import json
+import math
+import multiprocessing
+import queue
+import random
+import sys
+import time
+import copy
+from threading import Thread
+
+import requests
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
+
+from sender import dataflowmetadata, body, platformaddress, registrationapi_port, amqp_port
+
+EARTH_RADIUS = 6378137.0
+# Latitude and longitude of the reference position of the CAM in sender.py
+CENTER = (43.5549160, 10.3036950)
+# Upper bound of latency samples a worker ships to the parent per report interval
+MAX_SAMPLES = 20000
+
+
+# Quadkey of the tile containing (lat, lon) at the given zoom level
+def quadkey(lat, lon, zoom=18):
+    lat = min(max(lat, -85.05112878), 85.05112878)
+    sin_lat = math.sin(math.radians(lat))
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)
+    x = min(max(x, 0), n - 1)
+    y = min(max(y, 0), n - 1)
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return [0.0 for _ in points] + [0.0]
+    values = sorted(values)
+    result = [values[min(len(values) - 1, int(len(values) * p / 100.0))] for p in points]
+    return result + [values[-1]]
+
+
+# One simulated vehicle: its dataflow registration and a simple kinematic model
+class Vehicle:
+    def __init__(self, source_id, rnd, radius=0.05):
+        self.source_id = source_id
+        self.station_id = source_id
+        self.lat = CENTER[0] + rnd.uniform(-radius, radius)
+        self.lon = CENTER[1] + rnd.uniform(-radius, radius)
+        self.heading = rnd.uniform(0, 360)   # degrees
+        self.speed = rnd.uniform(5, 30)      # m/s
+        self.accel = 0.0                     # m/s^2
+        self.yaw_rate = 0.0                  # deg/s
+        self.rnd = rnd
+        self.quadkey = quadkey(self.lat, self.lon)
+        self.dataflow_id = -1
+        self.topic = None
+        self.send = True
+        self.body = json.loads(body)
+
+    def metadata(self):
+        meta = copy.deepcopy(dataflowmetadata)
+        meta["dataSourceInfo"]["sourceId"] = self.source_id
+        meta["dataSourceInfo"]["sourceLocationInfo"]["locationQuadkey"] = self.quadkey
+        return meta
+
+    def move(self, dt):
+        # Random walk on acceleration and yaw rate, kept within plausible road values
+        self.accel = min(max(self.accel + self.rnd.gauss(0, 0.3), -3.0), 2.0)
+        self.yaw_rate = min(max(self.yaw_rate + self.rnd.gauss(0, 1.0), -15.0), 15.0)
+        self.speed = min(max(self.speed + self.accel * dt, 0.0), 40.0)
+        self.heading = (self.heading + self.yaw_rate * dt) % 360.0
+        distance = self.speed * dt
+        heading = math.radians(self.heading)
+        self.lat += math.degrees(distance * math.cos(heading) / EARTH_RADIUS)
+        self.lon += math.degrees(distance * math.sin(heading) / (EARTH_RADIUS * math.cos(math.radians(self.lat))))
+        self.quadkey = quadkey(self.lat, self.lon)
+
+    def cam(self, now):
+        header = self.body["header"]
+        header["stationID"] = self.station_id
+        cam = self.body["cam"]
+        cam["generationDeltaTime"] = int(now * 1000) % 65536
+        basic = cam["camParameters"]["basicContainer"]["referencePosition"]
+        basic["latitude"] = int(round(self.lat * 1e7))
+        basic["longitude"] = int(round(self.lon * 1e7))
+        hf = cam["camParameters"]["highFrequencyContainer"]["basicVehicleContainerHighFrequency"]
+        hf["heading"]["headingValue"] = int(self.heading * 10) % 3600
+        hf["speed"]["speedValue"] = int(self.speed * 100)
+        hf["longitudinalAcceleration"]["longitudinalAccelerationValue"] = int(self.accel * 10)
+        hf["yawRate"]["yawRateValue"] = int(self.yaw_rate * 100)
+        return json.dumps(self.body, separators=(",", ":"))
+
+    def message(self, now):
+        msgbody = self.cam(now)
+        props = {
+                    "dataType": "cits",
+                    "dataSubType": "cam",
+                    "dataFormat": "asn1_jer",
+                    "sourceId": self.source_id,
+                    "locationQuadkey": self.quadkey,
+                    "timestamp": now * 1000,
+                    "body_size": str(sys.getsizeof(msgbody))
+                }
+        return Message(body=msgbody, properties=props)
+
+
+# Registers the dataflows of a set of vehicles and keeps them alive from a single HTTP session
+class Registrar:
+    def __init__(self, api, vehicles, keepalive=30.0):
+        self.api = api
+        self.vehicles = vehicles
+        self.keepalive = keepalive
+        self.session = requests.Session()
+        self.latencies = []
+        self.failures = 0
+
+    def register(self):
+        for vehicle in self.vehicles:
+            start = time.time()
+            try:
+                r = self.session.post(self.api + "/dataflows", json=vehicle.metadata(), timeout=10)
+                r.raise_for_status()
+                reply = r.json()
+                vehicle.dataflow_id = reply["id"]
+                vehicle.topic = reply["topic"]
+                vehicle.send = reply["send"]
+            except Exception as err:
+                print("Registration of source %d failed: %s" % (vehicle.source_id, err))
+                self.failures += 1
+                vehicle.send = False
+                continue
+            # Only the successful registrations are timed, the failures are counted apart
+            self.latencies.append((time.time() - start) * 1000)
+
+    def run(self):
+        while True:
+            time.sleep(self.keepalive)
+            for vehicle in self.vehicles:
+                if vehicle.dataflow_id < 0:
+                    continue
+                try:
+                    r = self.session.put(self.api + "/dataflows/" + str(vehicle.dataflow_id), json=vehicle.metadata(), timeout=10)
+                    vehicle.send = r.json()["send"]
+                except Exception as err:
+                    print("Keepalive of source %d failed: %s" % (vehicle.source_id, err))
+
+
+# Publishes the CAMs of all the vehicles of one worker over a few shared connections
+class FleetSender(MessagingHandler):
+    def __init__(self, url, vehicles, rate, connections, stats, stop, tick=0.01, report_interval=5.0):
+        super(FleetSender, self).__init__()
+        self.url = url
+        self.vehicles = vehicles
+        self.rate = rate
+        self.connections = connections
+        self.stats = stats
+        self.stop = stop
+        self.tick = tick
+        self.report_interval = report_interval
+        self._conns = []
+        self._links = {}
+        self._cursor = 0
+        self._published = 0
+        self._started = 0
+        self._last_report = 0
+        self._reset()
+
+    def _reset(self):
+        self.sent = 0
+        self.bytes = 0
+        self.accepted = 0
+        self.stalls = 0
+        self.latencies = []
+
+    def on_start(self, event):
+        for i in range(self.connections):
+            self._conns.append(event.container.connect(self.url))
+        self._started = self._last_report = time.time()
+        event.container.schedule(self.tick, self)
+
+    # Vehicles are spread round-robin over the connections, one link per connection and topic
+    def _link(self, container, index, topic):
+        conn = self._conns[index % len(self._conns)]
+        key = (id(conn), topic)
+        if key not in self._links:
+            self._links[key] = container.create_sender(conn, "topic://" + topic)
+        return self._links[key]
+
+    def on_timer_task(self, event):
+        now = time.time()
+        if self.stop.is_set():
+            self._report(now)
+            for conn in self._conns:
+                conn.close()
+            return
+
+        # Number of messages due since the start at `rate` per vehicle, each vehicle in turn
+        due = int((now - self._started) * self.rate * len(self.vehicles)) - self._published
+        for _ in range(max(0, min(due, len(self.vehicles)))):
+            index = self._cursor
+            vehicle = self.vehicles[index]
+            self._cursor = (self._cursor + 1) % len(self.vehicles)
+            self._published += 1
+            vehicle.move(1.0 / self.rate)
+            if not vehicle.send or vehicle.topic is None:
+                continue
+            link = self._link(event.container, index, vehicle.topic)
+            if not link.credit:
+                self.stalls += 1
+                continue
+            encoded = vehicle.message(now).encode()
+            dlv = link.delivery(link.delivery_tag())
+            link.stream(encoded)
+            link.advance()
+            dlv.sent_at = now
+            self.sent += 1
+            self.bytes += len(encoded)
+
+        if now - self._last_report >= self.report_interval:
+            self._report(now)
+        event.container.schedule(self.tick, self)
+
+    def on_accepted(self, event):
+        self.accepted += 1
+        if len(self.latencies) < MAX_SAMPLES:
+            self.latencies.append((time.time() - event.delivery.sent_at) * 1000)
+
+    def on_rejected(self, event):
+        print("Message rejected by the broker: " + str(event.delivery.remote.condition))
+
+    def on_transport_error(self, event):
+        print("Transport error: " + str(event.transport.condition))
+
+    def _report(self, now):
+        self.stats.put({
+            "elapsed": now - self._last_report,
+            "sent": self.sent,
+            "bytes": self.bytes,
+            "accepted": self.accepted,
+            "stalls": self.stalls,
+            "latencies": self.latencies,
+        })
+        self._last_report = now
+        self._reset()
+
+
+def worker(index, source_ids, opts, stats, stop):
+    rnd = random.Random(opts.seed + index)
+    vehicles = [Vehicle(source_id, rnd) for source_id in source_ids]
+
+    registrar = Registrar(opts.api, vehicles)
+    if opts.topic:
+        for vehicle in vehicles:
+            vehicle.topic = opts.topic
+    else:
+        registrar.register()
+        thread = Thread(target=registrar.run)
+        thread.daemon = True
+        thread.start()
+    stats.put({"worker": index, "registration": registrar.latencies, "failures": registrar.failures})
+
+    try:
+        Container(FleetSender(opts.amqp, vehicles, opts.rate, opts.connections, stats, stop,
+                              report_interval=opts.report_interval)).run()
+    except KeyboardInterrupt:
+        pass
+
+
+def print_window(label, windows, elapsed):
+    sent = sum(w["sent"] for w in windows)
+    nbytes = sum(w["bytes"] for w in windows)
+    accepted = sum(w["accepted"] for w in windows)
+    stalls = sum(w["stalls"] for w in windows)
+    latencies = [l for w in windows for l in w["latencies"]]
+    p50, p95, p99, pmax = percentiles(latencies)
+    elapsed = max(elapsed, 1e-9)
+    print("%s: %.1f msg/s %.1f KB/s accepted %d credit stalls %d latency ms p50 %.2f p95 %.2f p99 %.2f max %.2f" % (
+        label, sent / elapsed, nbytes / elapsed / 1024, accepted, stalls, p50, p95, p99, pmax))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--vehicles", type="int", default=100, help="number of simulated vehicles (default %default)")
+    parser.add_option("-r", "--rate", type="float", default=1.0, help="CAMs per second per vehicle (default %default)")
+    parser.add_option("-c", "--connections", type="int", default=2, help="AMQP connections per worker (default %default)")
+    parser.add_option("-w", "--workers", type="int", default=1, help="worker processes (default %default)")
+    parser.add_option("-d", "--duration", type="float", default=60.0, help="seconds to run (default %default)")
+    parser.add_option("--first-source-id", type="int", default=100000, help="sourceId of the first vehicle (default %default)")
+    parser.add_option("--topic", default=None, help="publish to this topic instead of registering dataflows")
+    parser.add_option("--api", default="http://" + platformaddress + ":" + registrationapi_port, help="registration API (default %default)")
+    parser.add_option("--amqp", default="amqp://<username>:<password>@" + platformaddress + ":" + amqp_port, help="AMQP broker URL (default %default)")
+    parser.add_option("--report-interval", type="float", default=5.0, help="seconds between reports (default %default)")
+    parser.add_option("--seed", type="int", default=0, help="random seed of the trajectories (default %default)")
+    opts, args = parser.parse_args()
+
+    source_ids = list(range(opts.first_source_id, opts.first_source_id + opts.vehicles))
+    stats = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    workers = []
+    for i in range(opts.workers):
+        p = multiprocessing.Process(target=worker, args=(i, source_ids[i::opts.workers], opts, stats, stop))
+        p.start()
+        workers.append(p)
+
+    # Registration results come first, one per worker. A worker that dies before reporting (import
+    # error, out of memory, exception while registering) counts its vehicles as failures
+    registration = []
+    failures = 0
+    early = []
+    waiting = set(range(opts.workers))
+    while waiting:
+        try:
+            result = stats.get(timeout=1.0)
+        except queue.Empty:
+            for i in sorted(waiting):
+                if not workers[i].is_alive():
+                    print("Worker %d exited with code %s before registering" % (i, workers[i].exitcode))
+                    failures += len(source_ids[i::opts.workers])
+                    waiting.discard(i)
+            continue
+        if "registration" not in result:
+            # Statistics of a worker that finished registering before the others
+            early.append(result)
+            continue
+        waiting.discard(result["worker"])
+        registration.extend(result["registration"])
+        failures += result["failures"]
+    if registration or failures:
+        p50, p95, p99, pmax = percentiles(registration)
+        print("Registered %d dataflows (%d failed): latency ms p50 %.2f p95 %.2f p99 %.2f max %.2f" % (
+            len(registration), failures, p50, p95, p99, pmax))
+
+    started = time.time()
+    totals = early
+    try:
+        while time.time() - started < opts.duration:
+            windows = []
+            deadline = time.time() + opts.report_interval
+            while len(windows) < opts.workers and time.time() < deadline + 1.0:
+                try:
+                    windows.append(stats.get(timeout=0.5))
+                except Exception:
+                    pass
+            if windows:
+                totals.extend(windows)
+                print_window("Window", windows, max(w["elapsed"] for w in windows))
+    except KeyboardInterrupt:
+        pass
+
+    stop.set()
+    for p in workers:
+        p.join(opts.report_interval + 5)
+    while not stats.empty():
+        totals.append(stats.get())
+    print_window("Total", totals, time.time() - started)
@@ -0,0 +1,207 @@
+#
+# Time-accurate replay of recorded CAM traces into an AMQP topic.
+#
+# Supported inputs:
+#   - text captures such as cits-message-quality/src/resource/database.txt (one JER body per line,
+#     separator lines are skipped) and pretty printed *.json files, read lazily line by line;
+#   - binary trace files written by trajectory.py, memory-mapped.
+#
+# The inter-message times of text captures come from the CAM generationDeltaTime, those of binary
+# traces from the record times. Messages are published through a single persistent sender link
+# with the original timing (--speed 1), scaled (--speed 2, --speed 10) or as fast as the link
+# credit allows (--max-rate). At the end the replay reports how late messages were published
+# with respect to their schedule.
+#
+# Example:
+#   python3 replay.py --url amqp://<username>:<password>@<ip>:5673/topic://cits-large --speed 10 database.txt
+
+from __future__ import print_function
+
+import optparse
+import json
+import os
+import sys
+import time
+
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
+
+import trajectory
+from fleet import quadkey
+
+# Helpers shared by the demo applications live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from latency import LatencyHistogram
+
+# A gap larger than this between two generationDeltaTime values is taken as a reordering between
+# stations rather than as a pause, the message is then replayed right after the previous one
+MAX_GAP_MS = 30000
+BLOCK_RECORDS = 4096
+# Time between two chained traces when none of them tells it, the CAM generation period of a
+# vehicle driving straight at constant speed
+DEFAULT_INTERVAL_MS = 1000
+
+
+# (offset in ms, JER body, stationID, latitude, longitude) of every CAM of a text capture
+def read_text(path):
+    offset = 0
+    previous = None
+    buf = ""
+    with open(path) as f:
+        for line in f:
+            if not buf and not line.lstrip().startswith("{"):
+                continue
+            buf += line
+            if not line.rstrip().endswith("}"):
+                continue
+            try:
+                cam = json.loads(buf)
+            except ValueError:
+                # Pretty printed document not complete yet
+                continue
+            msgbody = buf.strip() if "\n" not in buf.strip() else json.dumps(cam, separators=(",", ":"))
+            buf = ""
+
+            gdt = cam["cam"]["generationDeltaTime"]
+            if previous is not None:
+                gap = (gdt - previous) % 65536
+                offset += gap if gap <= MAX_GAP_MS else 0
+            previous = gdt
+            position = cam["cam"]["camParameters"]["basicContainer"]["referencePosition"]
+            yield offset, msgbody, cam["header"]["stationID"], position["latitude"] / 1e7, position["longitude"] / 1e7
+
+
+# Same tuples for a memory-mapped binary trace, rendered block by block
+def read_binary(path):
+    header, records = trajectory.open_trace(path)
+    for start in range(0, len(records), BLOCK_RECORDS):
+        block = records[start:start + BLOCK_RECORDS]
+        bodies = trajectory.to_jer(block, header["start_ms"])
+        for record, msgbody in zip(block.tolist(), bodies):
+            yield record[0], msgbody, record[1], record[2] / 1e7, record[3] / 1e7
+
+
+def read_trace(path):
+    with open(path, "rb") as f:
+        binary = f.read(len(trajectory.MAGIC)) == trajectory.MAGIC
+    return read_binary(path) if binary else read_text(path)
+
+
+# Chains several traces, each one starting one message interval after the end of the previous one.
+# The interval is the mean gap of the previous trace, or of the last one with several messages, so
+# that single-message files (one CAM per .json) are not all replayed at the same time
+def read_traces(paths):
+    base = 0
+    interval = DEFAULT_INTERVAL_MS
+    for path in paths:
+        count = 0
+        last = 0
+        for offset, msgbody, station, lat, lon in read_trace(path):
+            count += 1
+            last = offset
+            yield base + offset, msgbody, station, lat, lon
+        if count > 1 and last > 0:
+            interval = last / float(count - 1)
+        base += last + interval
+
+
+def cam_message(msgbody, station, lat, lon):
+    props = {
+                "dataType": "cits",
+                "dataSubType": "cam",
+                "dataFormat": "asn1_jer",
+                "sourceId": station,
+                "locationQuadkey": quadkey(lat, lon),
+                "timestamp": time.time() * 1000,
+                "body_size": str(sys.getsizeof(msgbody))
+            }
+    return Message(body=msgbody, properties=props)
+
+
+# Publishes the CAMs of a trace on their schedule through one persistent sender link
+class Replayer(MessagingHandler):
+    def __init__(self, url, events, speed=1.0):
+        super(Replayer, self).__init__()
+        self.url = url
+        self.events = iter(events)
+        self.speed = speed          # 0 means as fast as possible
+        self.sender = None
+        # Schedule lateness in ms, in constant memory however long the trace
+        self.lateness = LatencyHistogram()
+        self._next = next(self.events, None)
+        self._timer = None
+        self._started = 0
+        self._finished = 0
+        self._first_offset = self._next[0] if self._next else 0
+        self._last_offset = self._first_offset
+        self._sent_count = 0
+        self._confirmed_count = 0
+
+    def on_start(self, event):
+        self.sender = event.container.create_sender(self.url)
+        self._started = time.time()
+
+    def on_sendable(self, event):
+        self._pump(event.container)
+
+    def on_timer_task(self, event):
+        self._timer = None
+        self._pump(event.container)
+
+    def _due(self, offset):
+        return self._started + (offset - self._first_offset) / 1000.0 / self.speed
+
+    def _pump(self, container):
+        while self._next is not None and self.sender.credit:
+            offset, msgbody, station, lat, lon = self._next
+            now = time.time()
+            if self.speed:
+                due = self._due(offset)
+                if due > now:
+                    if self._timer is None:
+                        self._timer = container.schedule(due - now, self)
+                    return
+                self.lateness.record((now - due) * 1000)
+            self.sender.send(cam_message(msgbody, station, lat, lon))
+            self._sent_count += 1
+            self._last_offset = offset
+            self._next = next(self.events, None)
+        if self._next is None and not self._finished:
+            self._finished = time.time()
+
+    def on_accepted(self, event):
+        self._confirmed_count += 1
+        if self._next is None and self._confirmed_count == self._sent_count:
+            event.connection.close()
+
+    def on_transport_error(self, event):
+        raise Exception(event.transport.condition)
+
+    def report(self):
+        elapsed = (self._finished or time.time()) - self._started
+        scheduled = (self._last_offset - self._first_offset) / 1000.0
+        print("Replayed %d messages in %.2f s: %.1f msg/s" % (self._sent_count, elapsed, self._sent_count / max(elapsed, 1e-9)))
+        if self.speed:
+            p50, p95, p99 = [self.lateness.percentile(q) for q in (0.5, 0.95, 0.99)]
+            pmax = self.lateness.max
+            print("Trace span %.2f s at %gx: expected %.2f s, actual %.2f s" % (scheduled, self.speed, scheduled / self.speed, elapsed))
+            print("Lateness ms p50 %.2f p95 %.2f p99 %.2f max %.2f" % (p50, p95, p99, pmax))
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options] TRACE...")
+    parser.add_option("-u", "--url", default="amqp://127.0.0.1:5673/topic://cits-large", help="AMQP address to publish to (default %default)")
+    parser.add_option("-s", "--speed", type="float", default=1.0, help="replay speed factor, 1 for the original timing (default %default)")
+    parser.add_option("-m", "--max-rate", action="store_true", default=False, help="ignore the timing, publish as fast as the credit allows")
+    parser.add_option("-l", "--loop", type="int", default=1, help="replay the traces this many times (default %default)")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("no trace given")
+
+    replayer = Replayer(opts.url, read_traces(args * opts.loop), 0 if opts.max_rate else opts.speed)
+    try:
+        Container(replayer).run()
+    except KeyboardInterrupt:
+        pass
+    replayer.report()
@@ -26,11 +26,20 @@ from __future__ import print_function
 
 import optparse
 import json
+import os
+import sys
 import time
+from proton import Link, Message
 from proton.handlers import MessagingHandler
 from proton.reactor import Container
 
 import content
+from spool import Spool
+
+# Helpers shared by the demo applications live in src/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from batch import BATCH_SIZE, Batcher, unpack
+from codec import Compressor
 
 import sqlalchemy as db
 import requests
@@ -77,6 +86,148 @@ class Sender(MessagingHandler):
     def on_transport_error(self, event):
         raise Exception(event.transport.condition)
 
+# Counts published messages and prints the achieved rate every `interval` seconds
+class RateMeter:
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.total = 0
+        self._started = time.time()
+        self._window_start = self._started
+        self._window_count = 0
+
+    def add(self, count=1):
+        self.total += count
+        self._window_count += count
+        now = time.time()
+        if now - self._window_start >= self.interval:
+            print("Achieved rate: %.1f msg/s" % (self._window_count / (now - self._window_start)))
+            self._window_start = now
+            self._window_count = 0
+
+    def summary(self):
+        elapsed = time.time() - self._started
+        rate = self.total / elapsed if elapsed > 0 else 0.0
+        print("Sent %d messages in %.1f s: %.1f msg/s" % (self.total, elapsed, rate))
+
+# Keeps a single connection and sender link open for the life of the process and publishes
+# at `rate` messages per second, paced by a reactor timer and bounded by the link credit.
+# With a spool, messages that cannot be published are stored on disk instead of dropped and
+# drained afterwards at `catch_up_rate` transfers per second (default five times `rate`).
+# With a batcher, messages are packed into batch envelopes and sent when the batch is full or
+# its oldest message is old enough. With a compressor, message bodies are compressed
+class StreamingSender(MessagingHandler):
+    def __init__(self, url, msgbody, rate, meter=None, max_backlog=None, spool=None, catch_up_rate=None, batcher=None,
+                 compressor=None):
+        super(StreamingSender, self).__init__()
+        self.url = url
+        self.msgbody = msgbody
+        self.compressor = compressor
+        if compressor is not None:
+            # The body never changes: compress it once into the template
+            message = compressor.compress(content.message_generator(msgbody))
+            self.template = content.MessageTemplate(message.body, message.properties)
+        else:
+            self.template = content.MessageTemplate(msgbody)
+        self.interval = 1.0 / rate
+        self.meter = meter or RateMeter()
+        # Ticks that could not be published for lack of credit are kept up to one second's worth
+        self.max_backlog = max_backlog or max(1, int(rate))
+        self.spool = spool
+        self.catch_up = (catch_up_rate or 5 * rate) * self.interval
+        self.batcher = batcher
+        self.sender = None
+        self._pending = 0
+        self._drain_budget = 0.0
+        self._ticks = 0
+        self._started = 0
+        self._sent_count = 0
+        self._confirmed_count = 0
+
+    def on_start(self, event):
+        self.sender = event.container.create_sender(self.url)
+        self._started = time.time()
+        event.container.schedule(self.interval, self)
+
+    def on_timer_task(self, event):
+        self._ticks += 1
+        if self.spool is not None:
+            self._spool_tick()
+        elif send:
+            self._pending = min(self._pending + 1, self.max_backlog)
+            self._publish(self.sender)
+        else:
+            # Paused by the registration API: keep the link open but drop what was due
+            self._pending = 0
+        # Schedule against the absolute deadline so the pace does not drift with callback latency
+        deadline = self._started + (self._ticks + 1) * self.interval
+        event.container.schedule(max(0.0, deadline - time.time()), self)
+
+    def on_sendable(self, event):
+        if self.spool is not None:
+            self._drain(event.sender)
+        else:
+            self._publish(event.sender)
+
+    # Encoded bytes of the next transfer and the number of messages in it, None while batching
+    def _next_payload(self):
+        if self.batcher is None:
+            return bytes(self.template.encode()), 1
+        message = content.message_generator(self.msgbody)
+        if self.compressor is not None:
+            message = self.compressor.compress(message)
+        envelope = self.batcher.add(message) or self.batcher.poll()
+        if envelope is None:
+            return None
+        return envelope.encode(), envelope.properties[BATCH_SIZE]
+
+    def _transfer(self, sender, data, count):
+        dlv = sender.delivery(sender.delivery_tag())
+        sender.stream(data)
+        sender.advance()
+        if sender.snd_settle_mode == Link.SND_SETTLED:
+            dlv.settle()
+        self._sent_count += 1
+        self.meter.add(count)
+
+    def _publish(self, sender):
+        while send and self._pending and sender.credit:
+            payload = self._next_payload()
+            self._pending -= 1
+            if payload is not None:
+                self._transfer(sender, *payload)
+
+    def _spool_tick(self):
+        payload = self._next_payload()
+        if payload is not None:
+            # The live message goes straight out only when nothing older is waiting in the spool
+            if send and self.sender.credit and not len(self.spool):
+                self._transfer(self.sender, *payload)
+            else:
+                self.spool.append(payload[0])
+        if len(self.spool):
+            self._drain_budget = min(self._drain_budget + self.catch_up, max(1.0, self.catch_up))
+            self._drain(self.sender)
+
+    def _drain(self, sender):
+        while send and sender.credit and self._drain_budget >= 1.0:
+            item = self.spool.pop()
+            if item is None:
+                break
+            count = 1
+            if self.batcher is not None:
+                envelope = Message()
+                envelope.decode(item[1])
+                count = len(unpack(envelope))
+            self._transfer(sender, item[1], count)
+            self._drain_budget -= 1.0
+
+    def on_accepted(self, event):
+        self._confirmed_count += 1
+
+    def on_transport_error(self, event):
+        # The container reconnects on its own, the link is re-attached on the new connection
+        print("Transport error: " + str(event.transport.condition))
+
 
 platformaddress = "130.192.86.35"
 registrationapi_port = "12346"
@@ -114,6 +265,27 @@ body = '{"header":{"protocolVersion":2,"messageID":2,"stationID":3907},"cam":{"g
 
 if __name__ == "__main__":
 
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-m", "--mode", default="single", choices=["single", "stream"],
+                      help="single: one connection per message; stream: one persistent link (default %default)")
+    parser.add_option("-r", "--rate", type="float", default=10.0,
+                      help="messages per second in stream mode (default %default)")
+    parser.add_option("--spool", default=None,
+                      help="stream mode: spool file for the messages that cannot be published")
+    parser.add_option("--spool-size", type="int", default=64,
+                      help="spool size in MB, the oldest messages are evicted beyond it (default %default)")
+    parser.add_option("--spool-age", type="float", default=3600.0,
+                      help="seconds after which spooled messages are discarded (default %default)")
+    parser.add_option("--catch-up-rate", type="float", default=None,
+                      help="transfers per second drained from the spool (default five times --rate)")
+    parser.add_option("--batch", type="int", default=0,
+                      help="stream mode: pack up to this many messages per AMQP message (default no batching)")
+    parser.add_option("--batch-delay", type="float", default=50.0,
+                      help="maximum ms a message waits for its batch to fill (default %default)")
+    parser.add_option("--compress", default=None, choices=["zlib", "zlib-dict", "zstd", "zstd-dict"],
+                      help="stream mode: compress message bodies with this codec (default none)")
+    opts, args = parser.parse_args()
+
     # Url to add a dataflow
     url = "http://"+platformaddress+':'+registrationapi_port+'/dataflows'
 
@@ -131,16 +303,42 @@ if __name__ == "__main__":
 
     #Start sending keepalives
     thread = Thread(target = sendKeepAlive)
+    thread.daemon = True
     thread.start()
 
+    amqp_url = "amqp://<username>:<password>@"+platformaddress+":"+amqp_port+":/topic://"+topic
+    meter = RateMeter()
+
+    # Publish through a single long-lived link until interrupted
+    if opts.mode == "stream":
+        spool = None
+        if opts.spool:
+            spool = Spool(opts.spool, opts.spool_size * 1024 * 1024, opts.spool_age)
+        try:
+            batcher = Batcher(opts.batch, opts.batch_delay / 1000.0) if opts.batch > 1 else None
+            compressor = Compressor(opts.compress) if opts.compress else None
+            Container(StreamingSender(amqp_url, body, opts.rate, meter, spool=spool, catch_up_rate=opts.catch_up_rate,
+                                      batcher=batcher, compressor=compressor)).run()
+        except KeyboardInterrupt:
+            pass
+        meter.summary()
+        if compressor is not None:
+            compressor.stats.summary()
+        if spool is not None:
+            print("Spooled messages left: %d, evicted: %d, expired: %d" % (len(spool), spool.dropped_full, spool.dropped_expired))
+            spool.close()
+        exit()
+
     # Start publishing messages in the received topic
     while(True):
         try:
             #If need to send, send message every second
             if(send):
                 content.messages_generator(1, body)
-                Container(Sender("amqp://<username>:<password>@"+platformaddress+":"+amqp_port+":/topic://"+topic, content.messages)).run()
+                Container(Sender(amqp_url, content.messages)).run()
                 print("Message sent.\n")
+                meter.add()
         except KeyboardInterrupt:
+            meter.summary()
             exit(1)
         time.sleep(0.1)
@@ -0,0 +1,128 @@
+#
+# Disk-backed spool for the sender.
+#
+# A ring buffer in a memory-mapped file where the sender stores encoded messages while it cannot
+# publish (send flag false, broker unreachable or no link credit). The spool is bounded in size
+# (the oldest messages are evicted when it is full) and in age (expired messages are discarded when
+# read). Head and tail offsets live in the file header, so spooled messages survive a restart.
+#
+# File layout: HEADER, then the ring of records, each one RECORD followed by the payload. A record
+# never wraps around the end of the file: when it does not fit, a WRAP marker (or the too short
+# remainder) is skipped and the record starts again at the beginning of the ring.
+
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"5GMSPOOL"
+# magic, capacity, head, tail, used bytes, records
+HEADER = struct.Struct("<8sQQQQQ")
+# payload length, time the message was spooled (seconds since epoch)
+RECORD = struct.Struct("<Id")
+WRAP = 0xFFFFFFFF
+
+
+class Spool:
+    def __init__(self, path, size=64 * 1024 * 1024, max_age=3600.0):
+        self.path = path
+        self.max_age = max_age
+        self.dropped_full = 0
+        self.dropped_expired = 0
+
+        exists = os.path.exists(path) and os.path.getsize(path) == HEADER.size + size
+        self._file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self._file.truncate(HEADER.size + size)
+        self._mm = mmap.mmap(self._file.fileno(), HEADER.size + size)
+        magic, capacity, head, tail, used, count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or capacity != size:
+            # New or foreign file: start empty
+            capacity, head, tail, used, count = size, 0, 0, 0, 0
+        self.capacity = capacity
+        self._head = head
+        self._tail = tail
+        self._used = used
+        self._count = count
+        self._sync()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def used(self):
+        return self._used
+
+    def _sync(self):
+        HEADER.pack_into(self._mm, 0, MAGIC, self.capacity, self._head, self._tail, self._used, self._count)
+
+    # Skips the unused end of the ring when the head reached it
+    def _wrap_head(self):
+        remaining = self.capacity - self._head
+        if self._count and (remaining < RECORD.size or
+                            struct.unpack_from("<I", self._mm, HEADER.size + self._head)[0] == WRAP):
+            self._used -= remaining
+            self._head = 0
+
+    def _drop_head(self):
+        self._wrap_head()
+        length, _ = RECORD.unpack_from(self._mm, HEADER.size + self._head)
+        self._head += RECORD.size + length
+        self._used -= RECORD.size + length
+        self._count -= 1
+        if not self._count:
+            self._head = self._tail = self._used = 0
+
+    # Stores a message, evicting the oldest ones if needed. False if it can never fit
+    def append(self, data, timestamp=None):
+        size = RECORD.size + len(data)
+        if size > self.capacity:
+            self.dropped_full += 1
+            return False
+        waste = self.capacity - self._tail if self._tail + size > self.capacity else 0
+        while self._count and self.capacity - self._used < waste + size:
+            self._drop_head()
+            self.dropped_full += 1
+            waste = self.capacity - self._tail if self._tail + size > self.capacity else 0
+        if not self._count:
+            waste = 0
+        if waste:
+            if waste >= 4:
+                struct.pack_into("<I", self._mm, HEADER.size + self._tail, WRAP)
+            self._tail = 0
+            self._used += waste
+        offset = HEADER.size + self._tail
+        RECORD.pack_into(self._mm, offset, len(data), timestamp or time.time())
+        self._mm[offset + RECORD.size:offset + size] = data
+        self._tail = (self._tail + size) % self.capacity
+        self._used += size
+        self._count += 1
+        self._sync()
+        return True
+
+    # Oldest message that is not expired, as (timestamp, bytes), or None
+    def peek(self):
+        now = time.time()
+        while self._count:
+            self._wrap_head()
+            offset = HEADER.size + self._head
+            length, timestamp = RECORD.unpack_from(self._mm, offset)
+            if now - timestamp <= self.max_age:
+                return timestamp, self._mm[offset + RECORD.size:offset + RECORD.size + length]
+            self._drop_head()
+            self.dropped_expired += 1
+        self._sync()
+        return None
+
+    def pop(self):
+        item = self.peek()
+        if item is not None:
+            self._drop_head()
+            self._sync()
+        return item
+
+    def close(self):
+        self._sync()
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
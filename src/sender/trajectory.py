@@ -0,0 +1,220 @@
+#
+# Vectorized synthetic CAM workload generator.
+#
+# Simulates the kinematics (position, heading, speed, longitudinal acceleration, yaw rate and
+# curvature) of thousands of stations at once with NumPy. Every station drives a sequence of
+# straight and curved road segments with its own target speed. The states are stored as fixed
+# size records in a compact binary trace file that can be memory-mapped and replayed later. JER
+# bodies compatible with its::ITS of cits-message-quality are rendered from the records on demand.
+#
+# Example: one hour of 1000 stations at 10 Hz
+#   python3 trajectory.py --stations 1000 --duration 3600 --rate 10 --output fleet.trace
+#
+# Trace file layout (little endian): a 32 byte header (see HEADER) followed by RECORD entries,
+# ordered by time and then by station.
+
+from __future__ import print_function
+
+import optparse
+import struct
+import sys
+import time
+
+import numpy
+
+EARTH_RADIUS = 6378137.0
+# Latitude and longitude of the reference position of the CAM in sender.py
+CENTER = (43.5549160, 10.3036950)
+
+MAGIC = b"5GMCAMTR"
+VERSION = 1
+# magic, version, record size, stations, rate (Hz), start time (ms since epoch)
+HEADER = struct.Struct("<8sHHIdQ")
+
+RECORD = numpy.dtype([
+    ("time", "<u4"),            # ms since the start of the trace
+    ("station", "<u4"),         # stationID
+    ("latitude", "<i4"),        # 1e-7 degrees
+    ("longitude", "<i4"),       # 1e-7 degrees
+    ("heading", "<u2"),         # 0.1 degrees
+    ("speed", "<u2"),           # 0.01 m/s
+    ("acceleration", "<i2"),    # 0.1 m/s^2
+    ("yaw_rate", "<i2"),        # 0.01 degrees/s
+    ("curvature", "<i2"),       # 1/10000 m^-1
+    ("station_type", "u1"),
+    ("reserved", "u1"),
+])
+
+# JER body with the same layout as the CAM in sender.py, see its::ITS for the parsed fields
+CAM_JER = ('{"header":{"protocolVersion":2,"messageID":2,"stationID":%d},"cam":{"generationDeltaTime":%d,'
+           '"camParameters":{"basicContainer":{"stationType":%d,"referencePosition":{"latitude":%d,"longitude":%d,'
+           '"positionConfidenceEllipse":{"semiMajorConfidence":4095,"semiMinorConfidence":4095,"semiMajorOrientation":3601},'
+           '"altitude":{"altitudeValue":0,"altitudeConfidence":"unavailable"}}},'
+           '"highFrequencyContainer":{"basicVehicleContainerHighFrequency":{"heading":{"headingValue":%d,"headingConfidence":127},'
+           '"speed":{"speedValue":%d,"speedConfidence":127},"driveDirection":"forward",'
+           '"vehicleLength":{"vehicleLengthValue":42,"vehicleLengthConfidenceIndication":"unavailable"},"vehicleWidth":20,'
+           '"longitudinalAcceleration":{"longitudinalAccelerationValue":%d,"longitudinalAccelerationConfidence":102},'
+           '"curvature":{"curvatureValue":%d,"curvatureConfidence":"unavailable"},"curvatureCalculationMode":"yawRateUsed",'
+           '"yawRate":{"yawRateValue":%d,"yawRateConfidence":"unavailable"},"accelerationControl":"00","lanePosition":-1}}}}}')
+
+
+# Kinematic state of a fleet of stations, advanced one time step at a time for all of them
+class Fleet:
+    def __init__(self, stations, rate=10.0, first_station_id=1, center=CENTER, radius=0.05,
+                 segment_length=20.0, seed=0):
+        self.rng = numpy.random.default_rng(seed)
+        self.n = stations
+        self.dt = 1.0 / rate
+        # Probability that a station starts a new road segment in a step
+        self.p_switch = min(1.0, self.dt / segment_length)
+        self.station = numpy.arange(first_station_id, first_station_id + stations, dtype=numpy.uint32)
+        self.station_type = numpy.where(self.rng.random(stations) < 0.9, 5, 6).astype(numpy.uint8)  # cars, buses
+        self.lat = center[0] + self.rng.uniform(-radius, radius, stations)
+        self.lon = center[1] + self.rng.uniform(-radius, radius, stations)
+        self.heading = self.rng.uniform(0, 360, stations)
+        self.speed = self.rng.uniform(5, 30, stations)
+        self.accel = numpy.zeros(stations)
+        self.yaw_rate = numpy.zeros(stations)
+        self.target_speed = self.rng.uniform(8, 35, stations)
+        self.target_yaw = numpy.zeros(stations)
+        self.elapsed_ms = 0
+
+    def _new_segments(self, switch):
+        count = int(switch.sum())
+        if not count:
+            return
+        # 70% straight roads, the rest bends of 3 to 12 degrees/s either way
+        bend = self.rng.random(count) < 0.3
+        yaw = self.rng.uniform(3, 12, count) * self.rng.choice((-1.0, 1.0), count)
+        self.target_yaw[switch] = numpy.where(bend, yaw, 0.0)
+        self.target_speed[switch] = numpy.where(bend, self.rng.uniform(8, 15, count), self.rng.uniform(12, 35, count))
+
+    # Advance `steps` time steps and return them as RECORD entries
+    def block(self, steps):
+        n, dt = self.n, self.dt
+        lat = numpy.empty((steps, n))
+        lon = numpy.empty((steps, n))
+        heading = numpy.empty((steps, n))
+        speed = numpy.empty((steps, n))
+        accel = numpy.empty((steps, n))
+        yaw_rate = numpy.empty((steps, n))
+        switches = self.rng.random((steps, n)) < self.p_switch
+        cos_lat = numpy.cos(numpy.radians(self.lat))
+
+        for i in range(steps):
+            self._new_segments(switches[i])
+            # First order response towards the segment targets, bounded to plausible values
+            self.yaw_rate += (self.target_yaw - self.yaw_rate) * min(1.0, dt)
+            numpy.clip((self.target_speed - self.speed) / 4.0, -3.0, 2.0, out=self.accel)
+            self.speed += self.accel * dt
+            numpy.clip(self.speed, 0.0, 45.0, out=self.speed)
+            self.heading += self.yaw_rate * dt
+            self.heading %= 360.0
+            rad = numpy.radians(self.heading)
+            distance = self.speed * dt
+            self.lat += numpy.degrees(distance * numpy.cos(rad) / EARTH_RADIUS)
+            self.lon += numpy.degrees(distance * numpy.sin(rad) / (EARTH_RADIUS * cos_lat))
+            lat[i] = self.lat
+            lon[i] = self.lon
+            heading[i] = self.heading
+            speed[i] = self.speed
+            accel[i] = self.accel
+            yaw_rate[i] = self.yaw_rate
+
+        records = numpy.empty((steps, n), dtype=RECORD)
+        offsets = self.elapsed_ms + numpy.round(numpy.arange(1, steps + 1) * dt * 1000).astype(numpy.uint64)
+        records["time"] = offsets[:, None]
+        records["station"] = self.station
+        records["latitude"] = numpy.round(lat * 1e7)
+        records["longitude"] = numpy.round(lon * 1e7)
+        records["heading"] = numpy.round(heading * 10) % 3600
+        records["speed"] = numpy.round(speed * 100)
+        records["acceleration"] = numpy.round(accel * 10)
+        records["yaw_rate"] = numpy.round(yaw_rate * 100)
+        # Curvature is yaw rate over speed, unavailable (1023) when standing still
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            curvature = numpy.radians(yaw_rate) / speed * 10000
+        records["curvature"] = numpy.where(speed > 0.1, numpy.clip(numpy.round(curvature), -1023, 1022), 1023)
+        records["station_type"] = self.station_type
+        records["reserved"] = 0
+        self.elapsed_ms = int(offsets[-1])
+        return records.reshape(-1)
+
+
+def write_trace(path, fleet, duration, start_ms=None, block_steps=600):
+    if start_ms is None:
+        start_ms = int(time.time() * 1000)
+    steps = int(round(duration / fleet.dt))
+    written = 0
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize, fleet.n, 1.0 / fleet.dt, start_ms))
+        while written < steps:
+            block = fleet.block(min(block_steps, steps - written))
+            block.tofile(f)
+            written += len(block) // fleet.n
+    return steps * fleet.n
+
+
+# Header fields and memory-mapped records of a trace file
+def open_trace(path):
+    with open(path, "rb") as f:
+        magic, version, record_size, stations, rate, start_ms = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or record_size != RECORD.itemsize:
+        raise ValueError("%s is not a CAM trace file" % path)
+    header = {"stations": stations, "rate": rate, "start_ms": start_ms}
+    return header, numpy.memmap(path, dtype=RECORD, mode="r", offset=HEADER.size)
+
+
+# JER bodies of the records, generationDeltaTime derived from the absolute time
+def to_jer(records, start_ms=0):
+    fields = zip(records["station"].tolist(),
+                 ((records["time"].astype(numpy.uint64) + start_ms) % 65536).tolist(),
+                 records["station_type"].tolist(),
+                 records["latitude"].tolist(),
+                 records["longitude"].tolist(),
+                 records["heading"].tolist(),
+                 records["speed"].tolist(),
+                 records["acceleration"].tolist(),
+                 records["curvature"].tolist(),
+                 records["yaw_rate"].tolist())
+    for values in fields:
+        yield CAM_JER % values
+
+
+# Quadkeys at `zoom` of the positions of the records, as a NumPy bytes array
+def quadkeys(records, zoom=18):
+    lat = numpy.clip(records["latitude"] / 1e7, -85.05112878, 85.05112878)
+    lon = records["longitude"] / 1e7
+    sin_lat = numpy.sin(numpy.radians(lat))
+    size = 1 << zoom
+    x = numpy.clip(((lon + 180.0) / 360.0 * size).astype(numpy.int64), 0, size - 1)
+    y = numpy.clip(((0.5 - numpy.log((1 + sin_lat) / (1 - sin_lat)) / (4 * numpy.pi)) * size).astype(numpy.int64), 0, size - 1)
+    shifts = numpy.arange(zoom - 1, -1, -1)
+    digits = ((x[:, None] >> shifts) & 1) + 2 * ((y[:, None] >> shifts) & 1) + ord("0")
+    return numpy.ascontiguousarray(digits.astype(numpy.uint8)).view("S%d" % zoom).reshape(-1)
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--stations", type="int", default=1000, help="number of stations (default %default)")
+    parser.add_option("-d", "--duration", type="float", default=3600.0, help="seconds of simulated traffic (default %default)")
+    parser.add_option("-r", "--rate", type="float", default=10.0, help="CAMs per second per station (default %default)")
+    parser.add_option("-o", "--output", default="fleet.trace", help="trace file (default %default)")
+    parser.add_option("--first-station-id", type="int", default=1, help="stationID of the first station (default %default)")
+    parser.add_option("--seed", type="int", default=0, help="random seed (default %default)")
+    parser.add_option("--jer", default=None, help="also write the first --jer-count JER bodies to this file, one per line")
+    parser.add_option("--jer-count", type="int", default=1000, help="JER bodies written with --jer (default %default)")
+    opts, args = parser.parse_args()
+
+    fleet = Fleet(opts.stations, opts.rate, opts.first_station_id, seed=opts.seed)
+    started = time.time()
+    count = write_trace(opts.output, fleet, opts.duration)
+    elapsed = time.time() - started
+    print("Generated %d CAMs (%d stations, %.0f s at %.1f Hz) in %.2f s: %.0f CAM/s, %.1f MB" % (
+        count, opts.stations, opts.duration, opts.rate, elapsed, count / elapsed, count * RECORD.itemsize / 1e6))
+
+    if opts.jer:
+        header, records = open_trace(opts.output)
+        with open(opts.jer, "w") as f:
+            for line in to_jer(records[:opts.jer_count], header["start_ms"]):
+                f.write(line + "\n")
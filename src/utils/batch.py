@@ -0,0 +1,91 @@
+#
+# Multi-message batching envelope.
+#
+# Small messages (e.g. CAMs of 1-2 KB) can be packed into one AMQP message so that they share a
+# transfer, a delivery and a disposition. The envelope carries an AMQP sequence body, one
+# [properties, body] pair per item, and the application property BATCH_SIZE. Its other
+# properties are those of the first item, so broker-side routing and selectors keep working on
+# dataType, sourceId, locationQuadkey, etc.
+#
+# Publisher side:  batcher = Batcher(50, 0.05); envelope = batcher.add(message) or batcher.poll()
+# Consumer side:   decorate on_message with @unbatched to receive one call per item.
+
+import functools
+import time
+
+from proton import Message
+
+BATCH_SIZE = "batchSize"
+
+
+def is_batch(message):
+    return bool(message.properties) and BATCH_SIZE in message.properties
+
+
+# One envelope for a list of messages
+def pack(messages):
+    props = dict(messages[0].properties or {})
+    props[BATCH_SIZE] = len(messages)
+    envelope = Message(body=[[m.properties or {}, m.body] for m in messages], properties=props)
+    # Lists are sent as an AMQP sequence section instead of a single AMQP value
+    envelope.inferred = True
+    return envelope
+
+
+# The messages of an envelope, or the message itself if it is not a batch
+def unpack(message):
+    if not is_batch(message):
+        return [message]
+    # Annotations added on the way (e.g. hop stamps) belong to every item
+    return [Message(body=item[1], properties=item[0], annotations=message.annotations) for item in message.body]
+
+
+# Collects messages until `max_messages` are pending or the oldest one waited `max_delay` seconds
+class Batcher:
+    def __init__(self, max_messages=50, max_delay=0.05):
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self._pending = []
+        self._oldest = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    # Adds a message, returns the envelope if the batch is full
+    def add(self, message):
+        if not self._pending:
+            self._oldest = time.time()
+        self._pending.append(message)
+        if len(self._pending) >= self.max_messages:
+            return self.flush()
+        return None
+
+    # The envelope if the oldest pending message waited long enough
+    def poll(self, now=None):
+        if self._pending and (now or time.time()) - self._oldest >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._pending:
+            return None
+        envelope = pack(self._pending)
+        self._pending = []
+        return envelope
+
+
+# Decorator for MessagingHandler.on_message: batches are delivered item by item, the envelope is
+# still settled once by the handler
+def unbatched(on_message):
+    @functools.wraps(on_message)
+    def wrapper(self, event):
+        envelope = event.message
+        if not is_batch(envelope):
+            return on_message(self, event)
+        try:
+            for item in unpack(envelope):
+                event.message = item
+                on_message(self, event)
+        finally:
+            event.message = envelope
+    return wrapper
@@ -0,0 +1,138 @@
+#
+# Chunked transfer of large messages (video keyframes of several MB).
+#
+# A large body is split into chunks of `chunk_size` bytes, each one an AMQP message of its own with
+# the group_id of the whole body and its index as group_sequence. Every chunk carries the
+# application properties of the original message (so broker-side routing and selectors keep
+# working) plus GROUP_SIZE (chunks in the group), GROUP_BYTES (body size) and CHUNK_SIZE, so the
+# consumer can place any chunk in the body without waiting for the others. Chunks of a few tens of
+# KB keep the broker and the links free for small messages (CAM, DENM) while a frame is in transit.
+#
+# Publisher side:  for message, data in chunker.chunks(message, frame): send(encode_frame(message, data))
+# Consumer side:   message = reassembler.add(message)  # None until the group is complete
+#
+# The Reassembler preallocates the body of a group at its first chunk and drops the groups not
+# completed within `timeout` seconds, as well as the oldest ones beyond `max_groups` or `max_bytes`.
+
+import collections
+import threading
+import time
+import uuid
+
+from proton import Message
+
+GROUP_SIZE = "groupSize"
+GROUP_BYTES = "groupBytes"
+CHUNK_SIZE = "chunkSize"
+CHUNK_PROPERTIES = (GROUP_SIZE, GROUP_BYTES, CHUNK_SIZE)
+
+
+def is_chunk(message):
+    return message.group_id is not None and bool(message.properties) and GROUP_SIZE in message.properties
+
+
+class Chunker:
+    def __init__(self, chunk_size=64 * 1024, prefix=None):
+        self.chunk_size = chunk_size
+        # Group ids stay unique across restarts of the publisher
+        self.prefix = prefix or uuid.uuid4().hex[:12]
+        self._groups = 0
+
+    def needed(self, data):
+        return len(data) > self.chunk_size
+
+    # (chunk message without body, chunk data) for each chunk of `data`, views of it when `data` is a
+    # memoryview
+    def chunks(self, message, data):
+        self._groups += 1
+        group_id = "%s-%d" % (self.prefix, self._groups)
+        size = len(data)
+        count = (size + self.chunk_size - 1) // self.chunk_size
+        properties = dict(message.properties or {})
+        properties.update({GROUP_SIZE: count, GROUP_BYTES: size, CHUNK_SIZE: self.chunk_size})
+        for sequence in range(count):
+            chunk = Message(properties=properties, annotations=message.annotations)
+            chunk.group_id = group_id
+            chunk.group_sequence = sequence
+            start = sequence * self.chunk_size
+            yield chunk, data[start:start + self.chunk_size]
+
+
+class _Group:
+    def __init__(self, count, size, deadline):
+        self.body = bytearray(size)
+        self.missing = set(range(count))
+        self.deadline = deadline
+
+
+# Rebuilds the messages sent in chunks, passes the others through. Safe to share between threads
+class Reassembler:
+    def __init__(self, timeout=5.0, max_groups=16, max_bytes=256 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_groups = max_groups
+        self.max_bytes = max_bytes
+        self.completed = 0
+        self.discarded = 0
+        self.discarded_bytes = 0
+        self.invalid = 0
+        self._groups = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._groups)
+
+    # The complete message, `message` itself if it is not a chunk, None while its group is incomplete
+    def add(self, message, now=None):
+        if not is_chunk(message):
+            return message
+        now = now or time.time()
+        properties = message.properties
+        count, size, chunk_size = properties[GROUP_SIZE], properties[GROUP_BYTES], properties[CHUNK_SIZE]
+        sequence = message.group_sequence
+        data = message.body
+        start = sequence * chunk_size
+        if not 0 <= sequence < count or start + len(data) > size or len(data) > chunk_size:
+            self.invalid += 1
+            return None
+        with self._lock:
+            self._expire(now)
+            group = self._groups.get(message.group_id)
+            if group is None:
+                group = _Group(count, size, now + self.timeout)
+                self._groups[message.group_id] = group
+                self._bytes += size
+                while len(self._groups) > self.max_groups or (self._bytes > self.max_bytes and len(self._groups) > 1):
+                    self._discard(next(iter(self._groups)))
+                if message.group_id not in self._groups:
+                    return None
+            if sequence not in group.missing:
+                return None
+            group.body[start:start + len(data)] = data
+            group.missing.discard(sequence)
+            if group.missing:
+                return None
+            del self._groups[message.group_id]
+            self._bytes -= size
+            self.completed += 1
+        properties = dict((k, v) for k, v in properties.items() if k not in CHUNK_PROPERTIES)
+        # The annotations (e.g. hop stamps) of the chunk that completed the group
+        return Message(body=group.body, properties=properties, annotations=message.annotations)
+
+    # Drops the groups past their deadline
+    def expire(self, now=None):
+        with self._lock:
+            self._expire(now or time.time())
+
+    def _expire(self, now):
+        while self._groups:
+            group_id, group = next(iter(self._groups.items()))
+            if group.deadline > now:
+                break
+            self._discard(group_id)
+
+    def _discard(self, group_id):
+        group = self._groups.pop(group_id)
+        self._bytes -= len(group.body)
+        self.discarded += 1
+        self.discarded_bytes += len(group.body)
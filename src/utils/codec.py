@@ -0,0 +1,289 @@
+#
+# Optional payload compression negotiated through message properties.
+#
+# The publisher compresses the body of a message and marks the codec in the application
+# properties (CODEC, plus CODEC_DICT for dictionary codecs and CODEC_CHARSET for text bodies),
+# consumers decompress any message carrying CODEC and leave the others untouched.
+#
+# Codecs:
+#   zlib        deflate from the standard library
+#   zlib-dict   deflate with a preset dictionary (CAM_DICTIONARY unless another one is given)
+#   zstd        Zstandard, needs the zstandard package
+#   zstd-dict   Zstandard with a dictionary (raw CAM_DICTIONARY or one from train_dictionary)
+#
+# Messages whose dataType or dataType/dataSubType is in `skip_types` (by default H.264 and H.265
+# video, which are already compressed), smaller than `min_size` or that would not shrink by at
+# least `min_saving` are sent as they are. Bytes in/out, CPU time, skipped messages and messages
+# that could not be decompressed are counted per dataType in CodecStats and, when prometheus_client
+# is installed, in the amqp_codec_* Prometheus counters. decompress() raises CodecError for an
+# unknown codec or dictionary and for corrupt data, the consumers skip those messages.
+#
+# Codecs, Compressor, decompress() and CodecStats can be shared by several threads (e.g. the llccam
+# workers): the Zstandard objects, which are not thread-safe, are kept per thread.
+
+import functools
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from prometheus_client import Counter
+except ImportError:
+    Counter = None
+
+CODEC = "codec"
+CODEC_DICT = "codecDict"
+CODEC_CHARSET = "codecCharset"
+
+
+# A compressed message that cannot be restored
+class CodecError(ValueError):
+    pass
+
+# Skeleton of a JER CAM: the keys and constant values shared by every CAM body
+CAM_DICTIONARY = (
+    '{"header":{"protocolVersion":2,"messageID":2,"stationID":},"cam":{"generationDeltaTime":,'
+    '"camParameters":{"basicContainer":{"stationType":5,"referencePosition":{"latitude":,"longitude":,'
+    '"positionConfidenceEllipse":{"semiMajorConfidence":4095,"semiMinorConfidence":4095,"semiMajorOrientation":3601},'
+    '"altitude":{"altitudeValue":,"altitudeConfidence":"unavailable"}}},'
+    '"highFrequencyContainer":{"basicVehicleContainerHighFrequency":{"heading":{"headingValue":,"headingConfidence":127},'
+    '"speed":{"speedValue":,"speedConfidence":127},"driveDirection":"unavailable","driveDirection":"forward",'
+    '"vehicleLength":{"vehicleLengthValue":,"vehicleLengthConfidenceIndication":"unavailable"},"vehicleWidth":,'
+    '"longitudinalAcceleration":{"longitudinalAccelerationValue":,"longitudinalAccelerationConfidence":102},'
+    '"curvature":{"curvatureValue":,"curvatureConfidence":"unavailable"},"curvatureCalculationMode":"yawRateUsed",'
+    '"yawRate":{"yawRateValue":,"yawRateConfidence":"unavailable"},"accelerationControl":"00","lanePosition":-1,'
+    '"lateralAcceleration":{"lateralAccelerationValue":,"lateralAccelerationConfidence":102}}},'
+    '"lowFrequencyContainer":{"basicVehicleContainerLowFrequency":{"vehicleRole":"default","exteriorLights":"00",'
+    '"pathHistory":[{"pathPosition":{"deltaLatitude":,"deltaLongitude":,"deltaAltitude":},"pathDeltaTime":}]}}}}}'
+).encode()
+
+# Dictionaries known to this process by id, both ends must have the dictionary of a message
+_dictionaries = {}
+
+
+def register_dictionary(data):
+    dict_id = "%08x" % (zlib.crc32(data) & 0xffffffff)
+    _dictionaries[dict_id] = data
+    return dict_id
+
+
+def load_dictionary(path):
+    with open(path, "rb") as f:
+        return register_dictionary(f.read())
+
+
+CAM_DICTIONARY_ID = register_dictionary(CAM_DICTIONARY)
+
+
+# Dictionary trained on sample bodies: Zstandard training if available, otherwise the most recent
+# samples up to the size (zlib only looks at the last 32 KB of a preset dictionary)
+def train_dictionary(samples, size=16384):
+    samples = [s.encode() if isinstance(s, str) else bytes(s) for s in samples]
+    if zstandard is not None:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    data = b"".join(samples)
+    return data[-min(size, 32768):]
+
+
+class ZlibCodec:
+    def __init__(self, level=6, dictionary=None):
+        self.level = level
+        self.dictionary = dictionary
+
+    def compress(self, data):
+        if self.dictionary is None:
+            return zlib.compress(data, self.level)
+        c = zlib.compressobj(self.level, zdict=self.dictionary)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        if self.dictionary is None:
+            return zlib.decompress(data)
+        d = zlib.decompressobj(zdict=self.dictionary)
+        return d.decompress(data) + d.flush()
+
+
+class ZstdCodec:
+    def __init__(self, level=3, dictionary=None):
+        if zstandard is None:
+            raise ImportError("the zstd codecs need the zstandard package")
+        self.level = level
+        self._zdict = None
+        if dictionary is not None:
+            self._zdict = zstandard.ZstdCompressionDict(dictionary)
+        # Compressor and decompressor of each thread
+        self._local = threading.local()
+
+    def compress(self, data):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._zdict)
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self._zdict)
+        return decompressor.decompress(data)
+
+
+def get_codec(name, dict_id=None, level=None):
+    dictionary = None
+    if name.endswith("-dict"):
+        dictionary = _dictionaries[dict_id or CAM_DICTIONARY_ID]
+    if name.startswith("zlib"):
+        return ZlibCodec(6 if level is None else level, dictionary)
+    if name.startswith("zstd"):
+        return ZstdCodec(3 if level is None else level, dictionary)
+    raise ValueError("Unknown codec " + name)
+
+
+# Per dataType counters of the compression work
+class CodecStats:
+    if Counter is not None:
+        _bytes_in = Counter("amqp_codec_bytes_in", "Body bytes before compression.", ["direction", "data_type"])
+        _bytes_out = Counter("amqp_codec_bytes_out", "Body bytes after compression.", ["direction", "data_type"])
+        _cpu = Counter("amqp_codec_cpu_seconds", "CPU time spent in the codec.", ["direction", "data_type"])
+        _skipped = Counter("amqp_codec_skipped", "Messages sent uncompressed.", ["data_type"])
+        _errors = Counter("amqp_codec_errors", "Messages that could not be decompressed.", ["data_type"])
+
+    def __init__(self):
+        self.types = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, direction, data_type):
+        key = (direction, data_type)
+        if key not in self.types:
+            self.types[key] = {"messages": 0, "skipped": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "cpu": 0.0}
+        return self.types[key]
+
+    def add(self, direction, data_type, bytes_in, bytes_out, cpu):
+        with self._lock:
+            entry = self._entry(direction, data_type)
+            entry["messages"] += 1
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+            entry["cpu"] += cpu
+        if Counter is not None:
+            self._bytes_in.labels(direction, data_type).inc(bytes_in)
+            self._bytes_out.labels(direction, data_type).inc(bytes_out)
+            self._cpu.labels(direction, data_type).inc(cpu)
+
+    def skip(self, data_type):
+        with self._lock:
+            self._entry("compress", data_type)["skipped"] += 1
+        if Counter is not None:
+            self._skipped.labels(data_type).inc()
+
+    def error(self, data_type):
+        with self._lock:
+            self._entry("decompress", data_type)["errors"] += 1
+        if Counter is not None:
+            self._errors.labels(data_type).inc()
+
+    def summary(self):
+        with self._lock:
+            types = sorted((key, dict(e)) for key, e in self.types.items())
+        for (direction, data_type), e in types:
+            ratio = e["bytes_out"] / float(e["bytes_in"]) if e["bytes_in"] else 1.0
+            cpu = e["cpu"] / e["messages"] * 1e6 if e["messages"] else 0.0
+            print("%s %s: %d messages, %d skipped, %d errors, ratio %.3f, %.1f us CPU per message" % (
+                direction, data_type or "-", e["messages"], e["skipped"], e["errors"], ratio, cpu))
+
+
+stats = CodecStats()
+
+
+def _body_bytes(body):
+    if isinstance(body, str):
+        return body.encode("utf-8"), "utf-8"
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return bytes(body), None
+    return None, None
+
+
+# Compresses message bodies in place according to the skip rules
+class Compressor:
+    def __init__(self, codec="zlib", level=None, dict_id=None, min_size=128, min_saving=0.05,
+                 skip_types=("video/h264", "video/h265"), stats=stats):
+        self.name = codec
+        self.dict_id = (dict_id or CAM_DICTIONARY_ID) if codec.endswith("-dict") else None
+        self.codec = get_codec(codec, self.dict_id, level)
+        self.min_size = min_size
+        self.min_saving = min_saving
+        self.skip_types = skip_types
+        self.stats = stats
+
+    def compress(self, message):
+        props = message.properties or {}
+        data_type = str(props.get("dataType", ""))
+        full_type = data_type + "/" + str(props.get("dataSubType", ""))
+        data, charset = _body_bytes(message.body)
+        if data is None or data_type in self.skip_types or full_type in self.skip_types \
+                or len(data) < self.min_size or CODEC in props:
+            self.stats.skip(data_type)
+            return message
+        started = time.thread_time()
+        compressed = self.codec.compress(data)
+        cpu = time.thread_time() - started
+        if len(compressed) > len(data) * (1.0 - self.min_saving):
+            self.stats.skip(data_type)
+            return message
+        self.stats.add("compress", data_type, len(data), len(compressed), cpu)
+        props[CODEC] = self.name
+        if self.dict_id:
+            props[CODEC_DICT] = self.dict_id
+        if charset:
+            props[CODEC_CHARSET] = charset
+        message.properties = props
+        message.body = compressed
+        return message
+
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+
+# Restores the body of a compressed message in place, other messages are returned untouched. Raises
+# CodecError (counted in `stats`) when the message cannot be restored
+def decompress(message, stats=stats):
+    props = message.properties
+    if not props or CODEC not in props:
+        return message
+    data_type = str(props.get("dataType", ""))
+    key = (props[CODEC], props.get(CODEC_DICT))
+    try:
+        codec = _codecs.get(key)
+        if codec is None:
+            with _codecs_lock:
+                codec = _codecs.setdefault(key, get_codec(*key))
+        started = time.thread_time()
+        data = codec.decompress(bytes(message.body))
+        cpu = time.thread_time() - started
+        charset = props.get(CODEC_CHARSET)
+        body = data.decode(charset) if charset else data
+    except Exception as err:
+        stats.error(data_type)
+        raise CodecError("Cannot decompress a %s message (codec %s, dictionary %s): %s" % (
+            data_type or "-", key[0], key[1], err))
+    stats.add("decompress", data_type, len(data), len(message.body), cpu)
+    charset = props.pop(CODEC_CHARSET, None)
+    props.pop(CODEC, None)
+    props.pop(CODEC_DICT, None)
+    message.properties = props
+    message.body = body
+    return message
+
+
+# Decorator for MessagingHandler.on_message: the handler always sees decompressed messages
+def decompressed(on_message):
+    @functools.wraps(on_message)
+    def wrapper(self, event):
+        decompress(event.message)
+        return on_message(self, event)
+    return wrapper
@@ -0,0 +1,71 @@
+#
+# Per-hop latency stamps.
+#
+# Every stage of the data path that receives or forwards a message appends a stamp (stage name, in
+# or out, time in ms since epoch) to the HOPS message annotation, a binary of a few bytes per stamp:
+#   name length (1 byte), name, kind (b"i" received, b"o" forwarded), time (double)
+# Message annotations travel with the message through the brokers and, as part of the encoded
+# message, through the Kafka bridge. The `timestamp` application property set by the sources counts
+# as the first stamp ("source" out), so a sender adds nothing to its messages.
+#
+# The consumers turn the stamps into segments, e.g. "source.out>video-broker.in" or
+# "video-broker.out>llccam.in", and record their durations in a LatencyRecorder labelled by "hop":
+#
+#   stamp(message, "video-broker", RECEIVED, received_at)
+#   stamp(message, "video-broker", FORWARDED)
+#   for hop, duration in segments(message, "llccam"): hop_recorder.record(duration, (hop,))
+
+import struct
+import time
+
+from proton import symbol
+
+HOPS = symbol("x-opt-hops")
+SOURCE = "source"
+RECEIVED = b"i"
+FORWARDED = b"o"
+
+_STAMP = struct.Struct(">cd")
+_KINDS = {RECEIVED: "in", FORWARDED: "out"}
+
+
+def encode_stamp(hop, kind=FORWARDED, now=None):
+    name = hop.encode("utf-8")[:255]
+    return bytes((len(name),)) + name + _STAMP.pack(kind, time.time()*1000 if now is None else now)
+
+
+def stamp(message, hop, kind=FORWARDED, now=None):
+    annotations = message.annotations or {}
+    annotations[HOPS] = bytes(annotations.get(HOPS, b"")) + encode_stamp(hop, kind, now)
+    message.annotations = annotations
+    return message
+
+
+# The stamps of a HOPS annotation as (hop, kind, time)
+def decode_stamps(data):
+    data = memoryview(data or b"")
+    result = []
+    pos = 0
+    while pos < len(data):
+        end = pos + 1 + data[pos]
+        kind, now = _STAMP.unpack_from(data, end)
+        result.append((str(data[pos + 1:end], "utf-8"), kind, now))
+        pos = end + _STAMP.size
+    return result
+
+
+# (hop, duration in ms) between consecutive stamps, from the `timestamp` property to the reception
+# by `hop` at `now`. `annotations` and `properties` default to those of `message`
+def segments(message=None, hop="consumer", now=None, annotations=None, properties=None):
+    if annotations is None:
+        annotations = message.annotations or {}
+    if properties is None:
+        properties = message.properties or {}
+    points = decode_stamps(annotations.get(HOPS))
+    if "timestamp" in properties:
+        points.insert(0, (SOURCE, FORWARDED, float(properties["timestamp"])))
+    points.append((hop, RECEIVED, time.time()*1000 if now is None else now))
+    result = []
+    for (hop_a, kind_a, a), (hop_b, kind_b, b) in zip(points, points[1:]):
+        result.append(("%s.%s>%s.%s" % (hop_a, _KINDS.get(kind_a, "?"), hop_b, _KINDS.get(kind_b, "?")), b - a))
+    return result
@@ -0,0 +1,429 @@
+#
+# Streaming latency recording shared by the consumers (ccam, llccam).
+#
+# LatencyHistogram is an HDR-style histogram: every power of two is split in SUB_BUCKETS linear
+# sub-buckets, so values keep about 1.5% relative precision from 1 us to more than one hour with
+# a fixed number of counters. Recording is O(1) and memory does not grow with the message rate.
+#
+# LatencyRecorder keeps, for every label set (e.g. topic, sourceId, quadkey prefix), a cumulative
+# histogram and a histogram of the current time window. When a window ends its p50/p95/p99/max
+# are published and it starts again empty. The recorder is a Prometheus collector that exports:
+#   <name>                             gauge, mean of the last window (the former mean gauge)
+#   <name>_milliseconds                histogram since start, `buckets` as boundaries
+#   <name>_window_milliseconds         gauge per quantile (0.5, 0.95, 0.99, 1 = max) of the last window
+#   <name>_errors                      counter of the records that could not be decoded
+#
+# SharedLatency, SharedRecorder and SharedLatencyRecorder do the same for several worker processes
+# that record in shared memory and one supervisor process that exports the merged histograms. The
+# windows and the export are LatencyCollector, the base of LatencyRecorder and SharedLatencyRecorder:
+# only LatencyRecorder (in-process) and SharedRecorder (workers) have a recording API.
+
+import math
+import mmap
+import os
+import threading
+import time
+
+try:
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily, REGISTRY
+except ImportError:
+    REGISTRY = None
+
+SUB_BUCKETS = 64
+MIN_EXP = -10          # 2^-10 ms, about 1 us
+MAX_EXP = 22           # 2^22 ms, about 70 minutes
+NUM_BUCKETS = (MAX_EXP - MIN_EXP) * SUB_BUCKETS
+
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def bucket_index(value):
+    if value <= 2.0 ** MIN_EXP:
+        return 0
+    mantissa, exp = math.frexp(value)
+    if exp > MAX_EXP:
+        return NUM_BUCKETS - 1
+    return (exp - 1 - MIN_EXP) * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS)
+
+
+# Bounds of the values counted in bucket `index`
+def bucket_lower(index):
+    octave, sub = divmod(index, SUB_BUCKETS)
+    return (1.0 + float(sub) / SUB_BUCKETS) * 2.0 ** (octave + MIN_EXP)
+
+
+def bucket_upper(index):
+    return bucket_lower(index + 1)
+
+
+# bucket_index of every value of a NumPy array
+def bucket_indexes(values):
+    import numpy
+
+    mantissa, exp = numpy.frexp(values)
+    index = (exp - 1 - MIN_EXP) * SUB_BUCKETS + ((mantissa * 2 - 1) * SUB_BUCKETS).astype(numpy.int64)
+    index[values <= 2.0 ** MIN_EXP] = 0
+    return numpy.clip(index, 0, NUM_BUCKETS - 1)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.negative = 0   # negative latencies (clock skew), counted in the first bucket
+
+    def record(self, value):
+        if value < 0:
+            self.negative += 1
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Many values at once from a NumPy array
+    def record_many(self, values):
+        import numpy
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(values):
+            return
+        index = bucket_indexes(values)
+        for i, n in zip(*numpy.unique(index, return_counts=True)):
+            self.counts[i] += int(n)
+        self.negative += int((values < 0).sum())
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            if n:
+                self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.negative += other.negative
+        self.max = max(self.max, other.max)
+
+    # Histogram of the values recorded since `base`, an earlier copy of this histogram. The max of the
+    # difference is the upper bound of its highest bucket
+    def difference(self, base):
+        result = LatencyHistogram()
+        if base is None:
+            base = result
+        result.counts = [n - b for n, b in zip(self.counts, base.counts)]
+        result.count = self.count - base.count
+        result.total = self.total - base.total
+        result.negative = self.negative - base.negative
+        for i in range(NUM_BUCKETS - 1, -1, -1):
+            if result.counts[i]:
+                result.max = min(bucket_upper(i), self.max)
+                break
+        return result
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bucket_upper(i), self.max)
+        return self.max
+
+    # Cumulative counts at the given upper bounds, for a Prometheus histogram. A bucket straddling a
+    # bound is counted below it, which overestimates by at most the bucket precision
+    def cumulative(self, bounds):
+        result = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            while i < NUM_BUCKETS and bucket_lower(i) <= bound:
+                seen += self.counts[i]
+                i += 1
+            result.append(seen)
+        return result
+
+
+# Label values of a message: topic, sourceId and quadkey prefix at `quadkey_zoom`
+def message_labels(properties, names, topic="", quadkey_zoom=10):
+    values = []
+    for name in names:
+        if name == "topic":
+            values.append(topic)
+        elif name == "quadkey":
+            values.append(str(properties.get("locationQuadkey", ""))[:quadkey_zoom])
+        elif name == "sourceId":
+            source = properties.get("sourceId", "")
+            values.append(str(int(float(source))) if source != "" else "")
+        else:
+            values.append(str(properties.get(name, "")))
+    return tuple(values)
+
+
+# Windows and Prometheus export of the histograms by labels: `cumulative` since start and `current`
+# for the window, filled in by the subclasses
+class LatencyCollector:
+    def __init__(self, name="application_latency", labels=(), window=10.0, buckets=DEFAULT_BUCKETS,
+                 on_window=None, registry=REGISTRY):
+        self.name = name
+        self.labels = tuple(labels)
+        self.window = window
+        self.buckets = tuple(buckets)
+        # Called with the snapshot of every window that ends
+        self.on_window = on_window
+        self.errors = 0
+        self.cumulative = {}
+        self.current = {}
+        self.snapshot = {}
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    # Ends the current window if it is over, for the processes that do not record all the time
+    def tick(self):
+        with self._lock:
+            self._maybe_rotate(time.time())
+
+    def _maybe_rotate(self, now):
+        if now - self._window_start < self.window:
+            return
+        snapshot = {}
+        for labels, histogram in self.current.items():
+            if histogram.count:
+                snapshot[labels] = {
+                    "count": histogram.count,
+                    "mean": histogram.mean(),
+                    "p50": histogram.percentile(0.5),
+                    "p95": histogram.percentile(0.95),
+                    "p99": histogram.percentile(0.99),
+                    "max": histogram.max,
+                }
+        self.snapshot = snapshot
+        self.current = {}
+        self._window_start = now
+        if self.on_window is not None and snapshot:
+            self.on_window(snapshot)
+
+    def collect(self):
+        with self._lock:
+            self._maybe_rotate(time.time())
+            mean = GaugeMetricFamily(self.name, "Application Latency.", labels=self.labels)
+            window = GaugeMetricFamily(self.name + "_window_milliseconds",
+                                       "Application latency quantiles over the last window.",
+                                       labels=self.labels + ("quantile",))
+            for labels, s in self.snapshot.items():
+                mean.add_metric(labels, s["mean"])
+                for q, key in zip(QUANTILES + (1.0,), ("p50", "p95", "p99", "max")):
+                    window.add_metric(labels + (str(q),), s[key])
+            histogram = HistogramMetricFamily(self.name + "_milliseconds", "Application latency.",
+                                              labels=self.labels)
+            for labels, h in self.cumulative.items():
+                counts = h.cumulative(self.buckets)
+                buckets = [(str(b), c) for b, c in zip(self.buckets, counts)] + [("+Inf", h.count)]
+                histogram.add_metric(labels, buckets, h.total)
+        yield mean
+        yield window
+        yield histogram
+        yield CounterMetricFamily(self.name + "_errors", "Records that could not be decoded.", value=self.errors)
+
+
+# Latencies recorded in this process, in at most `max_series` label sets (then "other")
+class LatencyRecorder(LatencyCollector):
+    def __init__(self, name="application_latency", labels=(), window=10.0, buckets=DEFAULT_BUCKETS,
+                 max_series=1000, on_window=None, registry=REGISTRY):
+        self.max_series = max_series
+        self._overflow = tuple("other" for _ in labels)
+        super(LatencyRecorder, self).__init__(name, labels, window, buckets, on_window, registry)
+
+    def _series(self, labels):
+        if labels not in self.cumulative:
+            if len(self.cumulative) >= self.max_series:
+                labels = self._overflow
+            if labels not in self.cumulative:
+                self.cumulative[labels] = LatencyHistogram()
+        if labels not in self.current:
+            self.current[labels] = LatencyHistogram()
+        return labels
+
+    def record(self, value, labels=()):
+        with self._lock:
+            self._maybe_rotate(time.time())
+            labels = self._series(labels)
+            self.cumulative[labels].record(value)
+            self.current[labels].record(value)
+
+    def record_many(self, values, labels=()):
+        with self._lock:
+            self._maybe_rotate(time.time())
+            labels = self._series(labels)
+            self.cumulative[labels].record_many(values)
+            self.current[labels].record_many(values)
+
+    # Records that could not be decoded
+    def error(self):
+        self.errors += 1
+
+
+# Cumulative histograms of several worker processes in shared memory.
+#
+# The memory is an anonymous shared mapping created before the workers are forked. Every worker
+# owns a slot (its series, their labels and its counters) and is the only writer of that slot, so
+# recording takes no lock. The supervisor reads all the slots and merges the series by labels; a
+# series becomes visible once its labels are written and the series count of the slot is raised.
+# A worker restarted in the same slot goes on from the counts of the previous one.
+class SharedLatency:
+    # Counters of a slot
+    SERIES, ERRORS, PID = range(3)
+
+    def __init__(self, workers, max_series=64, label_size=256):
+        import numpy
+
+        self.workers = workers
+        self.max_series = max_series
+        self.label_size = label_size
+        shapes = [
+            ("counts", numpy.int64, (workers, max_series, NUM_BUCKETS)),
+            ("totals", numpy.int64, (workers, max_series, 2)),       # count, negative
+            ("floats", numpy.float64, (workers, max_series, 2)),     # total, max
+            ("slots", numpy.int64, (workers, 3)),
+            ("labels", numpy.uint8, (workers, max_series, label_size)),
+        ]
+        size = sum(numpy.dtype(dtype).itemsize * int(numpy.prod(shape)) for _, dtype, shape in shapes)
+        self._mm = mmap.mmap(-1, size)
+        offset = 0
+        for name, dtype, shape in shapes:
+            array = numpy.frombuffer(self._mm, dtype=dtype, count=int(numpy.prod(shape)), offset=offset)
+            setattr(self, name, array.reshape(shape))
+            offset += array.nbytes
+
+    def series_labels(self, slot, series):
+        data = self.labels[slot, series].tobytes().rstrip(b"\0")
+        return tuple(data.decode("utf-8").split("\x1f")) if data else ()
+
+    # The series of every slot merged by labels, as LatencyHistogram
+    def merged(self):
+        result = {}
+        for slot in range(self.workers):
+            for series in range(int(self.slots[slot, self.SERIES])):
+                labels = self.series_labels(slot, series)
+                h = LatencyHistogram()
+                h.counts = self.counts[slot, series].tolist()
+                h.count, h.negative = (int(n) for n in self.totals[slot, series])
+                h.total, h.max = (float(x) for x in self.floats[slot, series])
+                if labels in result:
+                    result[labels].merge(h)
+                else:
+                    result[labels] = h
+        return result
+
+
+# Worker side of SharedLatency, records in the slot of the worker like a LatencyRecorder
+class SharedRecorder:
+    def __init__(self, shared, slot, labels=()):
+        self.shared = shared
+        self.slot = slot
+        self.labels = tuple(labels)
+        self._overflow = tuple("other" for _ in self.labels)
+        self._counts = shared.counts[slot]
+        self._totals = shared.totals[slot]
+        self._floats = shared.floats[slot]
+        self._slot = shared.slots[slot]
+        self._slot[SharedLatency.PID] = os.getpid()
+        # Series left by a previous worker of the slot
+        self._series_index = dict((shared.series_labels(slot, i), i) for i in range(int(self._slot[SharedLatency.SERIES])))
+
+    def _series(self, labels):
+        index = self._series_index.get(labels)
+        if index is not None:
+            return index
+        count = int(self._slot[SharedLatency.SERIES])
+        if count >= self.shared.max_series - 1 and labels != self._overflow:
+            return self._series(self._overflow)
+        import numpy
+
+        data = "\x1f".join(labels).encode("utf-8")[:self.shared.label_size]
+        self.shared.labels[self.slot, count, :len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+        # Published after its labels
+        self._slot[SharedLatency.SERIES] = count + 1
+        self._series_index[labels] = count
+        return count
+
+    def record(self, value, labels=()):
+        series = self._series(labels)
+        self._counts[series, bucket_index(value)] += 1
+        totals = self._totals[series]
+        totals[0] += 1
+        if value < 0:
+            totals[1] += 1
+        floats = self._floats[series]
+        floats[0] += value
+        if value > floats[1]:
+            floats[1] = value
+
+    def record_many(self, values, labels=()):
+        import numpy
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(values):
+            return
+        series = self._series(labels)
+        self._counts[series] += numpy.bincount(bucket_indexes(values), minlength=NUM_BUCKETS)
+        totals = self._totals[series]
+        totals[0] += len(values)
+        totals[1] += int((values < 0).sum())
+        floats = self._floats[series]
+        floats[0] += float(values.sum())
+        floats[1] = max(floats[1], float(values.max()))
+
+    def error(self):
+        self._slot[SharedLatency.ERRORS] += 1
+
+    def tick(self):
+        pass
+
+
+# Supervisor side of SharedLatency: exports the merged series of the workers like a LatencyRecorder,
+# the windows being differences between two readings of the cumulative histograms
+class SharedLatencyRecorder(LatencyCollector):
+    def __init__(self, shared, name="application_latency", labels=(), window=10.0, buckets=DEFAULT_BUCKETS,
+                 on_window=None, registry=REGISTRY):
+        self.shared = shared
+        self._base = {}
+        super(SharedLatencyRecorder, self).__init__(name, labels, window, buckets, on_window, registry)
+
+    def _maybe_rotate(self, now):
+        self.cumulative = self.shared.merged()
+        self.current = dict((labels, h.difference(self._base.get(labels)))
+                            for labels, h in self.cumulative.items())
+        self.errors = int(self.shared.slots[:, SharedLatency.ERRORS].sum())
+        if now - self._window_start >= self.window:
+            self._base = self.cumulative
+        super(SharedLatencyRecorder, self)._maybe_rotate(now)
+
+    def collect(self):
+        for metric in super(SharedLatencyRecorder, self).collect():
+            yield metric
+        records = CounterMetricFamily(self.name + "_worker_records", "Records handled by each worker.",
+                                      labels=["worker"])
+        errors = CounterMetricFamily(self.name + "_worker_errors", "Records that a worker could not decode.",
+                                     labels=["worker"])
+        for slot in range(self.shared.workers):
+            records.add_metric([str(slot)], int(self.shared.totals[slot, :, 0].sum()))
+            errors.add_metric([str(slot)], int(self.shared.slots[slot, SharedLatency.ERRORS]))
+        yield records
+        yield errors
+
+
+def print_window(snapshot):
+    for labels, s in snapshot.items():
+        print("Latency%s: n %d mean %.2f p50 %.2f p95 %.2f p99 %.2f max %.2f ms" % (
+            (" " + "/".join(labels)) if labels else "", s["count"], s["mean"], s["p50"], s["p95"], s["p99"], s["max"]))
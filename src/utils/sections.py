@@ -0,0 +1,231 @@
+#
+# Lightweight decoder of the sections of an encoded AMQP 1.0 message.
+#
+# proton.Message.decode builds every section as Python objects, the body included, while most
+# consumers of the Kafka payloads only read a few application properties (timestamp, sourceId,
+# locationQuadkey...). application_properties() walks the encoded sections on a memoryview of the
+# bytes: header, annotations and properties are skipped by their size, the application-properties
+# map is decoded (all of it or only the given keys) and the body is never looked at.
+#
+#   props = application_properties(payload)                    # same dict as Message.properties
+#   ts = application_properties(payload, ("timestamp",)).get("timestamp")
+#   hops = message_annotations(payload, ("x-opt-hops",))       # the same way for the annotations
+#
+# Numbers, booleans, strings, symbols, binaries, UUIDs, lists, maps and arrays are decoded to the
+# types proton gives (symbol, ulong, timestamp, char, float32, Array...), binaries to bytes rather
+# than memoryview; decimals and described values, which applications do not put in their
+# properties, raise ValueError.
+
+import struct
+import uuid
+
+from proton import (UNDESCRIBED, Array, Data, byte, char, float32, int32, short, symbol, timestamp, ubyte, uint,
+                    ulong, ushort)
+
+HEADER = 0x70
+DELIVERY_ANNOTATIONS = 0x71
+MESSAGE_ANNOTATIONS = 0x72
+PROPERTIES = 0x73
+APPLICATION_PROPERTIES = 0x74
+
+_UINT32 = struct.Struct(">I")
+
+
+# Width of the encoded value after its constructor, as (bytes of the size field, fixed width)
+def _width(code):
+    category = code >> 4
+    if category == 0x4:
+        return 0, 0
+    if category == 0x5:
+        return 0, 1
+    if category == 0x6:
+        return 0, 2
+    if category == 0x7:
+        return 0, 4
+    if category == 0x8:
+        return 0, 8
+    if category == 0x9:
+        return 0, 16
+    if category in (0xa, 0xc, 0xe):
+        return 1, 0
+    if category in (0xb, 0xd, 0xf):
+        return 4, 0
+    raise ValueError("Invalid AMQP type code 0x%02x" % code)
+
+
+def _size(buf, pos, size_bytes):
+    if size_bytes == 1:
+        return buf[pos]
+    return _UINT32.unpack_from(buf, pos)[0]
+
+
+# Position after the value whose constructor is at `pos`
+def skip(buf, pos):
+    code = buf[pos]
+    pos += 1
+    if code == 0x00:
+        # Described value: descriptor then value
+        return skip(buf, skip(buf, pos))
+    size_bytes, fixed = _width(code)
+    if size_bytes:
+        return pos + size_bytes + _size(buf, pos, size_bytes)
+    return pos + fixed
+
+
+def _constant(value):
+    return lambda buf, pos: (value, pos)
+
+
+def _fixed(fmt, convert=None):
+    unpack_from = struct.Struct(fmt).unpack_from
+    size = struct.calcsize(fmt)
+    if convert is None:
+        return lambda buf, pos: (unpack_from(buf, pos)[0], pos + size)
+    return lambda buf, pos: (convert(unpack_from(buf, pos)[0]), pos + size)
+
+
+def _variable(size_bytes, convert):
+    def decode_variable(buf, pos):
+        size = buf[pos] if size_bytes == 1 else _UINT32.unpack_from(buf, pos)[0]
+        start = pos + size_bytes
+        return convert(buf[start:start + size]), start + size
+    return decode_variable
+
+
+def _compound(size_bytes, is_map):
+    def decode_compound(buf, pos):
+        end = pos + size_bytes + _size(buf, pos, size_bytes)
+        count = _size(buf, pos + size_bytes, size_bytes)
+        pos += 2 * size_bytes
+        items = []
+        for _ in range(count):
+            code = buf[pos]
+            value, pos = _DECODERS[code](buf, pos + 1) if code in _DECODERS else _unsupported(code)
+            items.append(value)
+        if is_map:
+            return dict(zip(items[::2], items[1::2])), end
+        return items, end
+    return decode_compound
+
+
+def _array(size_bytes):
+    def decode_array(buf, pos):
+        end = pos + size_bytes + _size(buf, pos, size_bytes)
+        count = _size(buf, pos + size_bytes, size_bytes)
+        pos += 2 * size_bytes
+        element = buf[pos]
+        decode_element = _DECODERS[element] if element in _DECODERS else _unsupported(element)
+        pos += 1
+        items = []
+        for _ in range(count):
+            value, pos = decode_element(buf, pos)
+            items.append(value)
+        return Array(UNDESCRIBED, _ARRAY_TYPES[element], *items), end
+    return decode_array
+
+
+def _unsupported(code):
+    raise ValueError("Unsupported AMQP type code 0x%02x" % code)
+
+
+# Decoder of every type code: (buf, position after the constructor) -> (value, position after it)
+_DECODERS = {
+    0x40: _constant(None), 0x41: _constant(True), 0x42: _constant(False),
+    0x43: _constant(uint(0)), 0x44: _constant(ulong(0)), 0x45: lambda buf, pos: ([], pos),
+    0x50: _fixed(">B", ubyte), 0x51: _fixed(">b", byte), 0x52: _fixed(">B", uint), 0x53: _fixed(">B", ulong),
+    0x54: _fixed(">b", int32), 0x55: _fixed(">b"), 0x56: lambda buf, pos: (bool(buf[pos]), pos + 1),
+    0x60: _fixed(">H", ushort), 0x61: _fixed(">h", short),
+    0x70: _fixed(">I", uint), 0x71: _fixed(">i", int32), 0x72: _fixed(">f", float32),
+    0x73: lambda buf, pos: (char(chr(_UINT32.unpack_from(buf, pos)[0])), pos + 4),
+    0x80: _fixed(">Q", ulong), 0x81: _fixed(">q"), 0x82: _fixed(">d"), 0x83: _fixed(">q", timestamp),
+    0x98: lambda buf, pos: (uuid.UUID(bytes=bytes(buf[pos:pos + 16])), pos + 16),
+    0xa0: _variable(1, bytes), 0xb0: _variable(4, bytes),
+    0xa1: _variable(1, lambda data: str(data, "utf-8")), 0xb1: _variable(4, lambda data: str(data, "utf-8")),
+    0xa3: _variable(1, lambda data: symbol(str(data, "ascii"))),
+    0xb3: _variable(4, lambda data: symbol(str(data, "ascii"))),
+    0xc0: _compound(1, False), 0xd0: _compound(4, False),
+    0xc1: _compound(1, True), 0xd1: _compound(4, True),
+    0xe0: _array(1), 0xf0: _array(4),
+}
+
+# proton Data type of the elements of an array, by their type code
+_ARRAY_TYPES = {
+    0x40: Data.NULL, 0x41: Data.BOOL, 0x42: Data.BOOL, 0x56: Data.BOOL,
+    0x43: Data.UINT, 0x52: Data.UINT, 0x70: Data.UINT, 0x44: Data.ULONG, 0x53: Data.ULONG, 0x80: Data.ULONG,
+    0x50: Data.UBYTE, 0x51: Data.BYTE, 0x60: Data.USHORT, 0x61: Data.SHORT,
+    0x54: Data.INT, 0x71: Data.INT, 0x55: Data.LONG, 0x81: Data.LONG,
+    0x72: Data.FLOAT, 0x82: Data.DOUBLE, 0x73: Data.CHAR, 0x83: Data.TIMESTAMP, 0x98: Data.UUID,
+    0xa0: Data.BINARY, 0xb0: Data.BINARY, 0xa1: Data.STRING, 0xb1: Data.STRING, 0xa3: Data.SYMBOL, 0xb3: Data.SYMBOL,
+    0x45: Data.LIST, 0xc0: Data.LIST, 0xd0: Data.LIST, 0xc1: Data.MAP, 0xd1: Data.MAP, 0xe0: Data.ARRAY,
+    0xf0: Data.ARRAY,
+}
+
+
+# Decodes the value whose constructor is at `pos`, returns (value, position after it)
+def decode(buf, pos=0):
+    code = buf[pos]
+    if code not in _DECODERS:
+        _unsupported(code)
+    return _DECODERS[code](buf, pos + 1)
+
+
+# Section descriptor code at `pos` and the position of the section value
+def _section(buf, pos):
+    if buf[pos] != 0x00:
+        raise ValueError("AMQP section expected at %d" % pos)
+    code = buf[pos + 1]
+    if code == 0x53:
+        return buf[pos + 2], pos + 3
+    if code == 0x80:
+        return struct.unpack_from(">Q", buf, pos + 2)[0], pos + 10
+    # Symbolic descriptors are not used by proton for the standard sections
+    return None, skip(buf, pos + 1)
+
+
+# Application properties of an encoded message, only `keys` if given. Empty if there are none
+def application_properties(data, keys=None):
+    return _map_section(data, APPLICATION_PROPERTIES, keys)
+
+
+# Message annotations of an encoded message (symbol keys, as Message.annotations), only `keys` if given
+def message_annotations(data, keys=None):
+    return _map_section(data, MESSAGE_ANNOTATIONS, keys)
+
+
+def _map_section(data, wanted, keys):
+    buf = memoryview(data)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        code, pos = _section(buf, pos)
+        if code is None or code < wanted:
+            pos = skip(buf, pos)
+            continue
+        if code != wanted:
+            # Sections come in order: the wanted one is not there
+            break
+        if keys is None:
+            return decode(buf, pos)[0]
+        return _select(buf, pos, keys)
+    return {}
+
+
+# Decodes the values of the given keys only, the others are skipped
+def _select(buf, pos, keys):
+    code = buf[pos]
+    if code not in (0xc1, 0xd1):
+        raise ValueError("section is not a map")
+    size_bytes = 1 if code == 0xc1 else 4
+    count = _size(buf, pos + 1 + size_bytes, size_bytes)
+    pos += 1 + 2 * size_bytes
+    wanted = set(keys)
+    result = {}
+    for _ in range(count // 2):
+        key, pos = decode(buf, pos)
+        if key in wanted:
+            result[key], pos = decode(buf, pos)
+            if len(result) == len(wanted):
+                break
+        else:
+            pos = skip(buf, pos)
+    return result
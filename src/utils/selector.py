@@ -0,0 +1,80 @@
+#
+# Broker-side filtering of the MEC topics by area and data type.
+#
+# quadkey_selector() turns a set of quadkey tiles (any zoom) and the wanted dataType/dataSubType into
+# a JMS selector on the locationQuadkey, dataType and dataSubType application properties, e.g.
+#   (locationQuadkey LIKE '0313331%' OR locationQuadkey LIKE '03133320%') AND dataType = 'cits'
+# JMS selectors only compare strings for equality, so a tile becomes a LIKE on its prefix. To keep
+# the selector small, tiles covered by another tile are dropped, four sibling tiles are merged into
+# their parent and, beyond `max_tiles` prefixes, the deepest tiles are replaced by their parent (the
+# filter then lets through a little more than asked, never less).
+#
+#   options = selector_options(["0313331", "03133320"], data_type="cits", data_subtype="cam")
+#   container.create_receiver(conn, address, options=options)
+
+from proton.reactor import Selector
+
+
+# Minimal set of prefixes covering the same area as `tiles`
+def merge_tiles(tiles):
+    tiles = set(str(t) for t in tiles if t is not None)
+    if "" in tiles:
+        return [""]
+    changed = True
+    while changed:
+        changed = False
+        for tile in sorted(tiles, key=len, reverse=True):
+            parent = tile[:-1]
+            siblings = set(parent + c for c in "0123")
+            if tile in tiles and siblings <= tiles:
+                tiles -= siblings
+                tiles.add(parent)
+                changed = True
+    # Drop the tiles inside another one
+    result = []
+    for tile in sorted(tiles):
+        if not result or not tile.startswith(result[-1]):
+            result.append(tile)
+    return result
+
+
+# Merged tiles, coarsened to their parents, deepest first, until there are at most `max_tiles`
+def coarsen_tiles(tiles, max_tiles=32):
+    tiles = merge_tiles(tiles)
+    while len(tiles) > max_tiles:
+        depth = max(len(t) for t in tiles)
+        tiles = merge_tiles(t[:-1] if len(t) == depth else t for t in tiles)
+    return tiles
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _in(name, values):
+    if isinstance(values, str):
+        values = [values]
+    values = list(values)
+    if len(values) == 1:
+        return "%s = %s" % (name, _quote(values[0]))
+    return "%s IN (%s)" % (name, ", ".join(_quote(v) for v in values))
+
+
+# JMS selector for the tiles and data types, None if it would select everything
+def quadkey_selector(tiles=(), data_type=None, data_subtype=None, max_tiles=32, prop="locationQuadkey"):
+    terms = []
+    tiles = coarsen_tiles(tiles, max_tiles) if tiles else []
+    if tiles and tiles != [""]:
+        likes = ["%s LIKE %s" % (prop, _quote(t + "%")) for t in tiles]
+        terms.append(likes[0] if len(likes) == 1 else "(" + " OR ".join(likes) + ")")
+    if data_type:
+        terms.append(_in("dataType", data_type))
+    if data_subtype:
+        terms.append(_in("dataSubType", data_subtype))
+    return " AND ".join(terms) or None
+
+
+# Receiver options filtering on the tiles and data types, None if there is nothing to filter
+def selector_options(tiles=(), data_type=None, data_subtype=None, max_tiles=32):
+    selector = quadkey_selector(tiles, data_type, data_subtype, max_tiles)
+    return Selector(selector) if selector else None
@@ -1,23 +1,219 @@
-from logging import raiseExceptions
+import collections
+import concurrent.futures
 import signal
+import socket
 import subprocess
 import sys
 from datetime import datetime
 import time, os, json
 
-import string
-
 import threading
 from proton.reactor import ApplicationEvent, Container, EventInjector
 from proton.handlers import MessagingHandler, TransactionHandler
 
-from udpvideo2amqp import UDP2AMQP
+from udpvideo2amqp import UDP2AMQP, chunk_size, keyframes
+from chunks import Chunker
+from keyframes import KeyframeServer
+
+# Stream states: STARTING until the receiver and the parser run, RUNNING, DRAINING while they stop
+STARTING = "starting"
+RUNNING = "running"
+DRAINING = "draining"
+STOPPED = "stopped"
+
+
+# UDP ports for the streams forwarded by webrtcRX, handed out once at a time. Ports still bound by
+# another process are skipped
+class PortAllocator:
+    def __init__(self, first=5000, last=5999):
+        self._free = collections.deque(range(first, last + 1))
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            for _ in range(len(self._free)):
+                port = self._free.popleft()
+                if self._available(port):
+                    return port
+                self._free.append(port)
+        raise RuntimeError("No free UDP port for a new video stream")
+
+    def release(self, port):
+        with self._lock:
+            self._free.append(port)
+
+    @staticmethod
+    def _available(port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
+        finally:
+            s.close()
+
+
+class Stream:
+    def __init__(self, source_id, port, framerate, tile):
+        self.source_id = source_id
+        self.port = port
+        self.framerate = framerate
+        self.tile = tile
+        self.state = STARTING
+        self.parser = None
+        self.proxy = None
+        # Held while the stream is started or stopped
+        self.lock = threading.Lock()
+
+
+# Video streams by sourceId. start() and stop() return at once: the receivers and parsers are
+# started and stopped by a pool of threads, so that the reactor keeps handling the other streams.
+# With ingest "udp" each stream is a webrtcRX process forwarding RTP over UDP to a UDP2AMQP, with
+# "webrtc" a WebRTC2AMQP (webrtc_ingest.py) terminates the WebRTC session in its own pipeline.
+# A stream is RUNNING once its receiver has lived for `start_grace` seconds. A receiver that exits
+# (checked every `poll_interval` seconds) or a pipeline that stops on its own stops its stream,
+# which can then be started again
+class StreamRegistry:
+    def __init__(self, ports=None, workers=8, stop_timeout=5.0, ingest="udp", start_grace=0.5, poll_interval=1.0):
+        self.ports = ports or PortAllocator()
+        self.ingest = ingest
+        self.stop_timeout = stop_timeout
+        self.start_grace = start_grace
+        self.poll_interval = poll_interval
+        self.streams = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="stream")
+        self._watcher = None
+
+    # sourceId as sent by the sources, e.g. 7, 7.0 or "7"
+    @staticmethod
+    def key(source_id):
+        return int(float(source_id))
+
+    def state(self, source_id):
+        stream = self.streams.get(self.key(source_id))
+        return stream.state if stream is not None else STOPPED
+
+    def start(self, source_id, framerate, tile):
+        with self._lock:
+            stream = self.streams.get(self.key(source_id))
+            if stream is not None:
+                print("Stream %s already %s" % (source_id, stream.state))
+                return None
+            port = self.ports.allocate() if self.ingest == "udp" else None
+            stream = Stream(source_id, port, framerate, tile)
+            self.streams[self.key(source_id)] = stream
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="stream-watcher")
+                self._watcher.daemon = True
+                self._watcher.start()
+        self._executor.submit(self._start, stream)
+        return stream
+
+    def stop(self, source_id):
+        with self._lock:
+            stream = self.streams.get(self.key(source_id))
+        return self._drain(stream)
+
+    # Stops `stream` unless it is already stopping
+    def _drain(self, stream):
+        with self._lock:
+            if stream is None or stream.state in (DRAINING, STOPPED):
+                return None
+            stream.state = DRAINING
+        self._executor.submit(self._stop, stream)
+        return stream
+
+    # Stops the streams whose receiver exited
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                streams = list(self.streams.values())
+            for stream in streams:
+                proxy = stream.proxy
+                if stream.state == RUNNING and proxy is not None and proxy.poll() is not None:
+                    print("Stream %s: receiver exited with code %s" % (stream.source_id, proxy.returncode))
+                    self._drain(stream)
+
+    # The pipeline of the stream stopped on its own
+    def _parser_stopped(self, stream):
+        print("Stream %s: pipeline stopped" % stream.source_id)
+        self._drain(stream)
+
+    def _start(self, stream):
+        with stream.lock:
+            # Stopped before it could start
+            if stream.state != STARTING:
+                return
+            try:
+                if self.ingest == "webrtc":
+                    from webrtc_ingest import WebRTC2AMQP
+
+                    # Receive the WebRTC call and push the frames into AMQP messages in one pipeline
+                    stream.parser = WebRTC2AMQP(stream.source_id, stream.framerate, stream.tile)
+                    stream.parser.on_stopped = lambda parser: self._parser_stopped(stream)
+                    stream.parser.start()
+                else:
+                    # Push the UDP into AMQP messages (1 message per frame), listening before the receiver sends
+                    stream.parser = UDP2AMQP(stream.source_id, stream.port, stream.framerate, stream.tile)
+                    stream.parser.on_stopped = lambda parser: self._parser_stopped(stream)
+                    stream.parser.start()
+                    # Launch the receiver, in its own process group to be stopped with its children
+                    command = './webrtcRX --self-id=%s --report-period=0 --disable-ssl --server="ws://localhost:8443" --udp=%i' %("peer"+str(stream.source_id), stream.port)
+                    print('command: '+command)
+                    stream.proxy = subprocess.Popen(command, shell=True, start_new_session=True)
+                    # A receiver that cannot start (missing binary, bad arguments) exits at once
+                    try:
+                        stream.proxy.wait(self.start_grace)
+                    except subprocess.TimeoutExpired:
+                        pass
+                    else:
+                        raise RuntimeError("receiver exited with code %s" % stream.proxy.returncode)
+            except Exception as e:
+                print("Stream %s failed to start: %s" % (stream.source_id, e))
+                stream.state = DRAINING
+            else:
+                self._running(stream)
+        if stream.state == DRAINING:
+            self._stop(stream)
+
+    def _running(self, stream):
+        with self._lock:
+            if stream.state == STARTING:
+                stream.state = RUNNING
+        print("Stream %s running (%s)" % (stream.source_id, "port %d" % stream.port if stream.port else self.ingest))
+
+    def _stop(self, stream):
+        with stream.lock:
+            if stream.state == STOPPED:
+                return
+            if stream.parser is not None:
+                stream.parser.kill()
+            if stream.proxy is not None:
+                try:
+                    os.killpg(stream.proxy.pid, signal.SIGTERM)
+                    stream.proxy.wait(self.stop_timeout)
+                except subprocess.TimeoutExpired:
+                    os.killpg(stream.proxy.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            with self._lock:
+                stream.state = STOPPED
+                if self.streams.get(self.key(stream.source_id)) is stream:
+                    del self.streams[self.key(stream.source_id)]
+                if stream.port is not None:
+                    self.ports.release(stream.port)
+            # No keyframe of a stream that is gone
+            if keyframes is not None:
+                keyframes.remove(stream.source_id)
+        print("Stream %s stopped" % stream.source_id)
+
+
+# VIDEO_INGEST: "udp" (webrtcRX processes) or "webrtc" (in-process webrtcbin)
+registry = StreamRegistry(ingest=os.getenv("VIDEO_INGEST", "udp"))
 
-ids = []
-ports = []
-framerates = []
-prxs = []
-parsers = []
 
 # Received messages will trigger the generation of a peer to receive the WebRTC video or to retire the peer and stop the session
 class Receiver(MessagingHandler):
@@ -33,11 +229,6 @@ class Receiver(MessagingHandler):
         event.container.create_receiver(self.url + self.topic)
 
     def on_message(self, event):
-        global ids
-        global prxs
-        global ports
-        global parsers
-
         if self._stopping:
             return
 
@@ -48,29 +239,10 @@ class Receiver(MessagingHandler):
 
             # Check that the video format is H.264 (other formats could be extended)
             if ((event.message.properties['dataType'] == "video") and (event.message.properties['dataSubType'] == "h264")):
-                # Forward received UDP + H.264 stream into a UDP stream in the 5000-5999 port range
-                port = ( int(float(event.message.properties['sourceId'])) % 1000 ) + 5000
-                # Launch the receiver
-                command = './webrtcRX --self-id=%s --report-period=0 --disable-ssl --server="ws://localhost:8443" --udp=%i' %("peer"+str(event.message.properties['sourceId']), port)
-
-                # Get the FPS attribute
-                framerate = event.message.properties['dataSampleRate']
-                # Push the UDP into AMQP messages (1 message per frame)
-                parser = UDP2AMQP(event.message.properties['sourceId'], port, framerate, event.message.properties['locationQuadkey'])
-                parsers.append(parser)
-
-                # Store the objects to manage them later
-                print('command: '+command)      
-                prx = subprocess.Popen(command,shell=True)
-                ids.append(event.message.properties['sourceId'])
-                ports.append(port)
-                prxs.append(prx)
-                framerates.append(framerate)
-                
-                print("Completed!")
-                time.sleep(1)
-                parser.start()
-                time.sleep(1)
+                # Forward received UDP + H.264 stream into a UDP stream on a port of its own, the FPS
+                # attribute is the frame rate of the stream
+                registry.start(event.message.properties['sourceId'], event.message.properties['dataSampleRate'],
+                               event.message.properties['locationQuadkey'])
 
             self._messages_actually_received += 1
         #event.connection.close()
@@ -82,22 +254,7 @@ class Receiver(MessagingHandler):
 
             # Check that the video format is H.264 (other formats could be extended)
             if ((event.message.properties['dataType'] == "video") and (event.message.properties['dataSubType'] == "h264")):
-                port = ( int(float(event.message.properties['sourceId'])) % 1000 ) + 5000
-                index = ids.index(event.message.properties['sourceId'])
-
-                parsers[index].kill()
-                time.sleep(1)
-
-                # Remove the objects for the specific video stream to retire
-                try:
-                    del parsers[index]
-                    #os.killpg(os.getpgid(prxs[index].pid), signal.SIGINT)
-                    del ids[index]
-                    del prxs[index]
-                    del ports[index]
-                    del framerates[index]
-                except KeyboardInterrupt:
-                    sys.exit()
+                registry.stop(event.message.properties['sourceId'])
 
             self._messages_actually_received += 1
         #event.connection.close()
@@ -137,6 +294,15 @@ class AMQP:
         thread1.daemon=True
         thread1.start()
 
+        # Serve the last keyframe of the streams to the consumers joining them
+        if keyframes is not None and param.get('keyframeURL'):
+            print("Container KEYFRAME SERVER")
+            reactor2 = Container(KeyframeServer(param['keyframeURL'], keyframes,
+                                                Chunker(chunk_size) if chunk_size else None))
+            thread2 = threading.Thread(target=reactor2.run)
+            thread2.daemon=True
+            thread2.start()
+
         while True:
             time.sleep(1.0)
 
@@ -0,0 +1,101 @@
+#
+# Cost of turning a video frame out of the GStreamer pipeline into an encoded AMQP message, with the
+# copying path (extract_dup, NumPy array, tobytes, Message with the frame as body, encode) against
+# the mapped path (read-only map of the Gst.Buffer, body section written from the memoryview).
+#
+# The frames are random bytes of 1080p keyframe sizes. With GStreamer installed they are real
+# Gst.Buffers and the mapped path is udpvideo2amqp.MappedFrame, without it the buffers are emulated
+# (extract_dup copies, map returns a view) and the numbers only cover the Python side.
+#
+# Usage: python3 bench_frames.py [--sizes 150000,400000,1500000] [--count 200]
+
+from __future__ import print_function
+
+import optparse
+import os
+import time
+
+import numpy
+from proton import Message
+
+import content
+
+try:
+    from gi.repository import Gst
+    import udpvideo2amqp
+    Gst.init(None)
+except (ImportError, ValueError):
+    Gst = None
+
+
+# Stands for a Gst.Buffer without GStreamer
+class EmulatedBuffer:
+    def __init__(self, data):
+        self._data = data
+
+    def get_size(self):
+        return len(self._data)
+
+    def extract_dup(self, offset, size):
+        return self._data[offset:offset + size]
+
+
+# Stands for udpvideo2amqp.MappedFrame without GStreamer
+class EmulatedFrame:
+    def __init__(self, buffer):
+        self.data = memoryview(buffer._data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def release(self):
+        self.data.release()
+
+
+def make_buffer(data):
+    if Gst is not None:
+        return Gst.Buffer.new_wrapped(data)
+    return EmulatedBuffer(data)
+
+
+# The frame path before the mapped frames
+def copying(buffer):
+    size = buffer.get_size()
+    array = numpy.ndarray((size, 1, 1), buffer=buffer.extract_dup(0, size), dtype=numpy.uint8)
+    message = Message(body=array.tobytes(), properties={"sourceId": 1, "body_size": str(size)})
+    return message.encode()
+
+
+def mapped(buffer):
+    frame = udpvideo2amqp.MappedFrame(buffer) if Gst is not None else EmulatedFrame(buffer)
+    message = content.frame_message(1, 30, "0313331", len(frame))
+    data = content.encode_frame(message, frame.data)
+    frame.release()
+    return data
+
+
+def run(path, buffer, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        path(buffer)
+    return (time.perf_counter() - started) / count
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-s", "--sizes", default="150000,400000,1500000",
+                      help="frame sizes in bytes, comma separated (default %default)")
+    parser.add_option("-n", "--count", type="int", default=200, help="frames per measure (default %default)")
+    opts, args = parser.parse_args()
+
+    print("Buffers: " + ("GStreamer" if Gst is not None else "emulated"))
+    print("%10s %14s %14s %10s" % ("bytes", "copying ms", "mapped ms", "speed-up"))
+    for size in [int(s) for s in opts.sizes.split(",")]:
+        buffer = make_buffer(os.urandom(size))
+        # Same message on the wire
+        check = Message()
+        check.decode(bytes(mapped(buffer)))
+        assert bytes(check.body) == bytes(buffer.extract_dup(0, size))
+        before = run(copying, buffer, opts.count)
+        after = run(mapped, buffer, opts.count)
+        print("%10d %14.3f %14.3f %9.1fx" % (size, before * 1000, after * 1000, before / after))
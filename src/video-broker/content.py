@@ -3,10 +3,14 @@
 from proton import Message
 from proton import symbol, ulong, PropertyDict
 import base64
-import sys
+import struct
+import time
 
 message = Message(subject='s1', body=u'b1')
 
+# Body section of a binary body: described type (0x00), data descriptor (smallulong 0x75), vbin32
+_FRAME_BODY = struct.Struct(">BBBBI")
+
 #
 # This method creates a list of messages that will be sent to the Message Broker.
 #
@@ -17,17 +21,41 @@ def message_generator(vid, fps, tile, msgbody=None ):
     if(msgbody==None):
         return
     
-    print("Size of the image: " + str(sys.getsizeof(msgbody)))
+    # Attributes of the messages to be sent (marshaling UDP into AMQP messages) and received (new and terminated video streams),
+    # the same as the frames encoded by encode_frame()
+    message = frame_message(vid, fps, tile, len(msgbody))
+    message.body = msgbody
+    #print("Message ready! \n")
+    return message
+
 
-    # Attributes of the messages to be sent (marshaling UDP into AMQP messages) and received (new and terminated video streams)
+#
+# Message of a video frame without its body: encode_frame() adds the frame when the message is sent.
+# Its timestamp (ms since epoch, now by default) is the time the frame entered the video broker.
+#
+def frame_message(vid, fps, tile, size, timestamp=None):
     props = {
-                "dataType": "video", 
-                "dataSubType": "h264", 
+                "dataType": "video",
+                "dataSubType": "h264",
                 "dataSampleRate": fps,
-                "sourceId": vid, 
+                "sourceId": vid,
                 "locationQuadkey": tile,
-                "body_size": str(sys.getsizeof(msgbody))
+                "body_size": str(size),
+                "timestamp": time.time()*1000 if timestamp is None else timestamp
             }
+    return Message(properties=props)
 
-    message = Message(body=msgbody, properties=props) 
-    #print("Message ready! \n")
+
+#
+# Encoded message with `frame` (any buffer, e.g. a memoryview of a mapped Gst.Buffer) as its binary
+# body. Proton encodes the properties and annotations, the body section is written after them with
+# the frame copied once, straight into the transfer buffer.
+#
+def encode_frame(message, frame):
+    head = message.encode()
+    size = len(frame)
+    data = bytearray(len(head) + _FRAME_BODY.size + size)
+    data[:len(head)] = head
+    _FRAME_BODY.pack_into(data, len(head), 0x00, 0x53, 0x75, 0xb0, size)
+    data[len(head) + _FRAME_BODY.size:] = frame
+    return data
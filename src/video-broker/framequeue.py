@@ -0,0 +1,173 @@
+#
+# Bounded send queue of an H.264 stream that drops frames by their place in the GOP.
+#
+# Frames are H.264 access units in byte-stream format (Annex B, as out of h264parse with
+# alignment=au). frame_kind() reads the NAL unit headers at the start of a frame:
+#   KEY         IDR slice, SPS or PPS (or nothing recognizable): never dropped while anything else can be
+#   REFERENCE   non-IDR slice other frames are predicted from (nal_ref_idc != 0): P and reference B
+#   DISPOSABLE  non-IDR slice with nal_ref_idc == 0: nothing depends on it
+# When the queue is over `max_frames` or `max_bytes`, the oldest disposable frame goes first. Without
+# one, a reference frame goes with the frames queued after it up to the next key frame (none of them
+# could be decoded any more, while the frames before it still can): the last one of an older GOP if
+# a newer key frame is queued, else the newest one. In the latter case the frames that arrive are
+# dropped as well until a key frame does, and the stream resumes cleanly at the next GOP. Only a
+# queue of key frames loses its oldest key frame.
+#
+# Dropped frames and bytes (by kind) and the queue depth are counted on the queue and, when
+# prometheus_client is installed, in the video_queue_* metrics labelled by stream.
+
+import collections
+import threading
+
+try:
+    from prometheus_client import Counter, Gauge
+except ImportError:
+    Counter = None
+
+KEY = "key"
+REFERENCE = "reference"
+DISPOSABLE = "disposable"
+
+# NAL unit types
+NON_IDR_SLICE = 1
+IDR_SLICE = 5
+SPS = 7
+PPS = 8
+
+Entry = collections.namedtuple("Entry", "kind size item")
+
+
+# NAL unit headers (type, nal_ref_idc) found in `data`
+def nal_headers(data):
+    data = bytes(data)
+    result = []
+    pos = data.find(b"\x00\x00\x01")
+    while pos >= 0 and pos + 3 < len(data):
+        header = data[pos + 3]
+        result.append((header & 0x1f, header >> 5 & 0x3))
+        pos = data.find(b"\x00\x00\x01", pos + 3)
+    return result
+
+
+# Kind of the access unit `data`, from the headers in its first `scan` bytes (the parameter sets
+# and SEI come before the first slice), or in the whole frame if no slice starts there, and the NAL
+# unit types of the headers it was told from
+def scan_frame(data, scan=4096):
+    headers = nal_headers(data[:scan])
+    types = [nal_type for nal_type, _ in headers]
+    for nal_type, ref_idc in headers:
+        if nal_type in (IDR_SLICE, SPS, PPS):
+            return KEY, types
+        if nal_type == NON_IDR_SLICE:
+            return (REFERENCE if ref_idc else DISPOSABLE), types
+    if len(data) > scan:
+        return scan_frame(data, len(data))
+    return KEY, types
+
+
+def frame_kind(data, scan=4096):
+    return scan_frame(data, scan)[0]
+
+
+class FrameQueue:
+    if Counter is not None:
+        _dropped_frames = Counter("video_queue_dropped_frames", "Frames dropped from the send queue.",
+                                  ["stream", "kind"])
+        _dropped_bytes = Counter("video_queue_dropped_bytes", "Bytes of the frames dropped from the send queue.",
+                                 ["stream"])
+        _depth = Gauge("video_queue_depth", "Frames waiting in the send queue.", ["stream"])
+
+    def __init__(self, max_frames=30, max_bytes=None, name=""):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.name = str(name)
+        self.bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.dropped = {KEY: 0, REFERENCE: 0, DISPOSABLE: 0}
+        self._entries = collections.deque()
+        self._waiting_for_key = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _full(self):
+        return len(self._entries) > self.max_frames or (self.max_bytes is not None and self.bytes > self.max_bytes
+                                                         and len(self._entries) > 1)
+
+    # Queues `item`, returns the items dropped to make room for it (or `item` itself)
+    def push(self, item, kind, size):
+        entry = Entry(kind, size, item)
+        with self._lock:
+            if kind == KEY:
+                self._waiting_for_key = False
+            elif self._waiting_for_key:
+                self._count([entry])
+                return [item]
+            self._entries.append(entry)
+            self.bytes += size
+            dropped = []
+            while self._full():
+                dropped.extend(self._shed())
+            self._count(dropped)
+            return [e.item for e in dropped]
+
+    # Oldest queued item, None if there is none
+    def pop(self):
+        with self._lock:
+            if not self._entries:
+                return None
+            entry = self._entries.popleft()
+            self.bytes -= entry.size
+            self._update_depth()
+            return entry.item
+
+    # Empties the queue, returns the items dropped
+    def clear(self):
+        with self._lock:
+            dropped = list(self._entries)
+            self._entries.clear()
+            self.bytes = 0
+            self._count(dropped)
+            return [e.item for e in dropped]
+
+    # Removes the entries to drop first
+    def _shed(self):
+        entries = list(self._entries)
+        for i, entry in enumerate(entries):
+            if entry.kind == DISPOSABLE:
+                return self._remove(i, i + 1)
+        keys = [i for i, entry in enumerate(entries) if entry.kind == KEY]
+        # The tail of the GOP before the newest key frame, then the newest frames
+        last_key = keys[-1] if keys else 0
+        for i in list(range(last_key - 1, -1, -1)) + list(range(len(entries) - 1, last_key - 1, -1)):
+            if entries[i].kind == REFERENCE:
+                end = i + 1
+                while end < len(entries) and entries[end].kind != KEY:
+                    end += 1
+                if end == len(entries):
+                    self._waiting_for_key = True
+                return self._remove(i, end)
+        return self._remove(0, 1)
+
+    def _remove(self, start, end):
+        entries = list(self._entries)
+        removed = entries[start:end]
+        self._entries = collections.deque(entries[:start] + entries[end:])
+        self.bytes -= sum(e.size for e in removed)
+        return removed
+
+    def _count(self, dropped):
+        for entry in dropped:
+            self.dropped_frames += 1
+            self.dropped_bytes += entry.size
+            self.dropped[entry.kind] += 1
+            if Counter is not None:
+                self._dropped_frames.labels(self.name, entry.kind).inc()
+                self._dropped_bytes.labels(self.name).inc(entry.size)
+        self._update_depth()
+
+    def _update_depth(self):
+        if Counter is not None:
+            self._depth.labels(self.name).set(len(self._entries))
@@ -0,0 +1,200 @@
+#
+# Last keyframe of every video stream, for the consumers that join a stream in mid-GOP.
+#
+# The StreamSender of each stream puts its key frames (H.264 access units with an IDR slice) in the
+# KeyframeCache, under the sourceId. An access unit without its SPS/PPS gets the last parameter sets
+# seen on the stream in front of it, so a cached keyframe can always be decoded on its own. The
+# cache holds at most `max_bytes` of keyframes: beyond it, the streams whose keyframe was least
+# recently stored or served lose theirs first.
+#
+# The KeyframeServer answers the requests sent to its address (VIDEO_KEYFRAME_ADDRESS) with the
+# cached keyframes, as video frame messages with the properties of the live ones plus
+# CACHED_KEYFRAME, sent to the reply_to address of the request with its message id (or correlation
+# id) as correlation_id. A request with a sourceId property gets the keyframe of that stream, one
+# without it those of all the streams. When nothing is cached for the stream, the reply has no body
+# and CACHED_KEYFRAME is False. The replies go out as the relay link has credit, at most
+# `max_in_flight` unsettled; the requests that come while `max_pending` replies wait are rejected.
+# A consumer joins without waiting for the next GOP by attaching to the video topic first and then
+# sending its request: the keyframe comes on its reply address, followed by the live frames on the
+# topic.
+
+import collections
+import threading
+import time
+
+from proton import Message, Url
+from proton.handlers import MessagingHandler
+
+import content
+from framequeue import IDR_SLICE, PPS, SPS, nal_headers
+
+CACHED_KEYFRAME = "cachedKeyframe"
+
+Keyframe = collections.namedtuple("Keyframe", "properties data time")
+
+
+class KeyframeCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, scan=4096):
+        self.max_bytes = max_bytes
+        self.scan = scan
+        self.bytes = 0
+        self.evicted = 0
+        self._keyframes = collections.OrderedDict()
+        # Last SPS/PPS access unit of each stream
+        self._parameters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keyframes)
+
+    # sourceId as sent by the sources, e.g. 7, 7.0 or "7"
+    @staticmethod
+    def key(source_id):
+        return int(float(source_id))
+
+    # Keeps `data` (an access unit of the stream, any buffer) if it is a keyframe. `types` are the NAL
+    # unit types at its start when the caller already has them (framequeue.scan_frame)
+    def put(self, source_id, properties, data, types=None):
+        if types is None:
+            types = [nal_type for nal_type, _ in nal_headers(data[:self.scan])]
+        key = self.key(source_id)
+        if IDR_SLICE not in types:
+            if SPS in types or PPS in types:
+                with self._lock:
+                    self._parameters[key] = bytes(data)
+            return False
+        data = bytes(data)
+        with self._lock:
+            if SPS not in types and key in self._parameters:
+                data = self._parameters[key] + data
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return False
+            self._keyframes[key] = Keyframe(dict(properties or {}), data, time.time())
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._keyframes)))
+                self.evicted += 1
+        return True
+
+    # Cached keyframe of the stream, None if there is none
+    def get(self, source_id):
+        key = self.key(source_id)
+        with self._lock:
+            keyframe = self._keyframes.get(key)
+            if keyframe is not None:
+                self._keyframes.move_to_end(key)
+            return keyframe
+
+    # Cached keyframes of all the streams, least recently used first
+    def all(self):
+        with self._lock:
+            return list(self._keyframes.values())
+
+    # Forgets the stream, e.g. when it stops
+    def remove(self, source_id):
+        key = self.key(source_id)
+        with self._lock:
+            self._remove(key)
+            self._parameters.pop(key, None)
+
+    def _remove(self, key):
+        keyframe = self._keyframes.pop(key, None)
+        if keyframe is not None:
+            self.bytes -= len(keyframe.data)
+
+
+# Serves the cached keyframes on request, through an anonymous sender to the reply addresses. Large
+# keyframes go out in chunks with a `chunker` (see chunks.py), as the live frames do
+class KeyframeServer(MessagingHandler):
+    def __init__(self, url, cache, chunker=None, max_in_flight=4, max_pending=256):
+        super(KeyframeServer, self).__init__()
+        self.url = Url(url)
+        self.cache = cache
+        self.chunker = chunker
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.relay = None
+        # Replies waiting for credit, as (message, keyframe data or None), and the chunks left of the
+        # one being sent
+        self._pending = collections.deque()
+        self._chunks = None
+        self._served = 0
+
+    def on_start(self, event):
+        print("Keyframe server Created")
+        conn = event.container.connect(self.url)
+        event.container.create_receiver(conn, self.url.path)
+        self.relay = event.container.create_sender(conn, None)
+
+    def on_message(self, event):
+        request = event.message
+        if request.reply_to is None:
+            print("Keyframe request without reply address")
+            return
+        if len(self._pending) >= self.max_pending:
+            print("Keyframe request rejected, %d replies waiting" % len(self._pending))
+            self.reject(event.delivery)
+            return
+        correlation_id = request.id if request.id is not None else request.correlation_id
+        properties = request.properties or {}
+        if "sourceId" in properties:
+            keyframe = self.cache.get(properties["sourceId"])
+            keyframes = [keyframe] if keyframe is not None else []
+        else:
+            keyframes = self.cache.all()
+        for keyframe in keyframes:
+            reply = Message(properties=dict(keyframe.properties, **{CACHED_KEYFRAME: True}))
+            self._queue(reply, request.reply_to, correlation_id, keyframe.data)
+        if not keyframes:
+            reply = Message(properties={"sourceId": properties.get("sourceId"), CACHED_KEYFRAME: False})
+            self._queue(reply, request.reply_to, correlation_id)
+        self._send()
+
+    def on_sendable(self, event):
+        self._send()
+
+    def on_settled(self, event):
+        self._send()
+
+    def _queue(self, message, address, correlation_id, data=None):
+        message.address = address
+        message.correlation_id = correlation_id
+        self._pending.append((message, data))
+
+    def _send(self):
+        while self.relay.credit and self.relay.unsettled < self.max_in_flight:
+            if self._chunks is not None:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    self._chunks = None
+                    self._served += 1
+                    continue
+                message, part = chunk
+                self._transfer(content.encode_frame(message, part))
+                continue
+            if not self._pending:
+                break
+            message, data = self._pending.popleft()
+            if data is None:
+                self.relay.send(message)
+            elif self.chunker is not None and self.chunker.needed(data):
+                self._chunks = self._chunked(message, data)
+            else:
+                self._transfer(content.encode_frame(message, data))
+                self._served += 1
+
+    # Chunks of a reply, addressed as the reply
+    def _chunked(self, message, data):
+        for chunk, part in self.chunker.chunks(message, data):
+            chunk.address = message.address
+            chunk.correlation_id = message.correlation_id
+            yield chunk, part
+
+    def _transfer(self, data):
+        self.relay.delivery(self.relay.delivery_tag())
+        self.relay.stream(data)
+        self.relay.advance()
+
+    def on_transport_error(self, event):
+        print("Transport error: " + str(event.transport.condition))
@@ -5,28 +5,31 @@
 from __future__ import print_function
 
 import os
-import optparse
-import json
 import time
 from proton.handlers import MessagingHandler
-from proton.reactor import Container
+from proton.reactor import ApplicationEvent, Container, EventInjector
 
 import threading
 
 import sys
-import numpy
 
 import gi
 
 gi.require_version('GLib', '2.0')
-gi.require_version('GObject', '2.0')
 gi.require_version('Gst', '1.0')
 gi.require_version('GstApp', '1.0')
 gi.require_version('GstVideo', '1.0')
 
-from gi.repository import Gst, GObject, GLib, GstApp, GstVideo
+from gi.repository import Gst, GLib, GstApp, GstVideo
 
 import content
+from framequeue import DISPOSABLE, KEY, REFERENCE, FrameQueue, scan_frame
+from keyframes import KeyframeCache
+
+# Helpers shared by the demo applications live in src/utils (on the PYTHONPATH in the image)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from chunks import Chunker
+from hops import FORWARDED, RECEIVED, stamp
 
 # Environment parameters
 broker_ip=os.getenv("AMQP_IP") 
@@ -34,47 +37,158 @@ broker_port=os.getenv('AMQP_PORT')
 topic="video"
 user=os.getenv('AMQP_USER')
 passwd=os.getenv('AMQP_PASS')
-
-# Class to send video frames as messages into AMQP
-class Sender(MessagingHandler):
-    def __init__(self, url, message):
-        super(Sender, self).__init__()
+# Frames waiting for the AMQP link per stream (VIDEO_MAX_QUEUE frames, VIDEO_MAX_QUEUE_MB if set),
+# dropped GOP-aware beyond it, and frames sent but not yet acknowledged (VIDEO_MAX_IN_FLIGHT)
+max_queue=int(os.getenv("VIDEO_MAX_QUEUE", 30))
+max_queue_bytes=int(float(os.getenv("VIDEO_MAX_QUEUE_MB")) * 1024 * 1024) if os.getenv("VIDEO_MAX_QUEUE_MB") else None
+max_in_flight=int(os.getenv("VIDEO_MAX_IN_FLIGHT", 4))
+# Frames larger than VIDEO_CHUNK_SIZE bytes are sent in chunks of that size (0: whole frames)
+chunk_size=int(os.getenv("VIDEO_CHUNK_SIZE", 0))
+# Last keyframe of every stream, within VIDEO_KEYFRAME_CACHE_MB for all of them (0: no cache)
+keyframe_cache_bytes=int(float(os.getenv("VIDEO_KEYFRAME_CACHE_MB", 64)) * 1024 * 1024)
+keyframes=KeyframeCache(keyframe_cache_bytes) if keyframe_cache_bytes else None
+
+# Long-lived sender of one video stream, run by its own reactor thread. The GStreamer thread hands
+# the frames over with submit(): they wait in a FrameQueue (which drops frames GOP-aware when the
+# link cannot keep up) and an EventInjector wakes the reactor up to send them. At most
+# `max_in_flight` frames are on the link unacknowledged, so the backlog builds up in the queue
+# rather than in the connection buffers. The container reconnects on its own and the link is
+# re-attached. A frame submitted with a MappedFrame is encoded straight from the mapped buffer,
+# which is released as soon as it is encoded (or dropped).
+# With a `chunk_size`, larger frames go out as groups of chunks (see chunks.py), one chunk at a time
+# within the same in-flight limit, so that other messages are not held behind a whole keyframe.
+# With a KeyframeCache, the key frames are kept in it under the stream `name` as they are submitted.
+class StreamSender(MessagingHandler):
+    def __init__(self, url, max_queue=30, max_in_flight=4, max_queue_bytes=None, name="", chunk_size=0,
+                 keyframes=None):
+        super(StreamSender, self).__init__()
         self.url = url
-        self._message = message
+        self.sender = None
+        self.max_in_flight = max_in_flight
+        self.name = name
+        self.keyframes = keyframes
+        self.queue = FrameQueue(max_queue, max_queue_bytes, name)
+        self.chunker = Chunker(chunk_size) if chunk_size else None
+        # Chunks left of the frame being sent, and the frame
+        self._chunks = None
+        self._chunked = None
+        self._wakeup_pending = threading.Event()
+        self._injector = EventInjector()
+        self._closing = False
         self._sent_count = 0
         self._confirmed_count = 0
 
+    @property
+    def dropped(self):
+        return self.queue.dropped_frames
+
     def on_start(self, event):
         print("Sender Created")
-        event.container.create_sender(self.url)
+        event.container.selectable(self._injector)
+        self.sender = event.container.create_sender(self.url)
+
+    # Called from the GStreamer thread
+    def submit(self, message, frame=None):
+        data = frame.data if frame is not None else message.body
+        kind, types = scan_frame(data)
+        if kind == KEY and self.keyframes is not None:
+            self.keyframes.put(self.name, message.properties, data, types)
+        for item in self.queue.push((message, frame), kind, len(data)):
+            self._release(item)
+        if not self._wakeup_pending.is_set():
+            self._wakeup_pending.set()
+            self._injector.trigger(ApplicationEvent("frames"))
+
+    # Sends what the link takes, drops the rest, then closes the connection and ends the reactor thread
+    def close(self):
+        self._closing = True
+        self._injector.trigger(ApplicationEvent("frames"))
+
+    def on_frames(self, event):
+        self._wakeup_pending.clear()
+        self._send()
+        if self._closing:
+            for item in self.queue.clear():
+                self._release(item)
+            if self._chunks is not None:
+                self._release(self._chunked)
+                self._chunks = None
+            self.sender.connection.close()
+            self._injector.close()
 
     def on_sendable(self, event):
-        message = self._message
-        #print("Send to "+ self.url +": \n\t" )#+ str(message))
-        event.sender.send(message)
-        self._sent_count += 1
-        event.sender.close()
+        self._send()
+
+    def on_settled(self, event):
+        self._send()
+
+    def _send(self):
+        while self.sender.credit and self.sender.unsettled < self.max_in_flight:
+            if self._chunks is not None:
+                self._send_chunk()
+                continue
+            item = self.queue.pop()
+            if item is None:
+                break
+            message, frame = item
+            # Hop stamp: frame handed to the AMQP link
+            stamp(message, "video-broker", FORWARDED)
+            data = frame.data if frame is not None else message.body
+            if self.chunker is not None and self.chunker.needed(data):
+                self._chunks = self.chunker.chunks(message, data)
+                self._chunked = item
+                continue
+            if frame is None:
+                self.sender.send(message)
+            else:
+                self._transfer(content.encode_frame(message, frame.data))
+                frame.release()
+            self._sent_count += 1
+
+    def _send_chunk(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._release(self._chunked)
+            self._chunks = None
+            self._sent_count += 1
+            return
+        message, data = chunk
+        self._transfer(content.encode_frame(message, data))
+
+    def _transfer(self, data):
+        self.sender.delivery(self.sender.delivery_tag())
+        self.sender.stream(data)
+        self.sender.advance()
+
+    def _release(self, item):
+        if item[1] is not None:
+            item[1].release()
 
     def on_accepted(self, event):
         self._confirmed_count += 1
-        event.connection.close()
 
     def on_transport_error(self, event):
-        raise Exception(event.transport.condition)
-
+        print("Transport error: " + str(event.transport.condition))
 
-# Get video frame from a GST Buffer
-def extract_buffer(sample):
-    """Extracts Gst.Buffer from Gst.Sample and converts to np.ndarray"""
 
-    buffer = sample.get_buffer()  # Gst.Buffer
+# Video frame of a GST Buffer, mapped read-only: `data` is a memoryview of the frame, valid until
+# release() unmaps the buffer
+class MappedFrame:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        ok, self.info = buffer.map(Gst.MapFlags.READ)
+        if not ok:
+            raise ValueError("Unable to map the buffer")
+        self.data = memoryview(self.info.data)
 
-    caps = sample.get_caps()  # Gst.Caps
+    def __len__(self):
+        return len(self.data)
 
-    buffer_size = buffer.get_size()
-    array = numpy.ndarray((buffer_size, 1, 1), buffer=buffer.extract_dup(0, buffer_size), dtype=numpy.uint8)
-
-    return array  # remove single dimension if exists
+    def release(self):
+        if self.info is not None:
+            self.data.release()
+            self.buffer.unmap(self.info)
+            self.info = None
 
 # Callback gets GST Buffer from a UDP stream
 def on_buffer(sink, data):
@@ -83,45 +197,86 @@ def on_buffer(sink, data):
     # https://lazka.github.io/pgi-docs/GstApp-1.0/classes/AppSink.html#GstApp.AppSink.signals.pull_sample
 
     sample = sink.emit("pull-sample")  # Gst.Sample
-
-    # Prepare AMQP config
-    server_url="amqp://"+user+":"+passwd+"@"+broker_ip+":"+str(broker_port)+"/topic://"+topic
+    received = time.time()*1000
 
     if isinstance(sample, Gst.Sample):
-        array = extract_buffer(sample)
-        print(
-            "Received {type} with shape {shape} of type {dtype}".format(type=type(array),
-                                                                        shape=array.shape,
-                                                                        dtype=array.dtype))
-        # Prepare message with the video frame
-        content.message_generator(data.id, data.fps, data.tile, array.tobytes())
-        # Send message (video frame) to AMQP
-        Container(Sender(server_url, content.message)).run()
+        frame = MappedFrame(sample.get_buffer())
+        # Prepare message for the video frame, encoded with it when it is sent
+        message = content.frame_message(data.id, data.fps, data.tile, len(frame), received)
+        # Hop stamp: frame out of the GStreamer pipeline
+        stamp(message, "video-broker", RECEIVED, received)
+        # Queue the message (video frame) for the stream's AMQP sender
+        data.sender.submit(message, frame)
         return Gst.FlowReturn.OK
 
     return Gst.FlowReturn.ERROR
 
 
-class UDP2AMQP(threading.Thread):
-    
-    def __init__(self, id, port, fps, tile) :
-        super().__init__()
-        self._kill = threading.Event()
+# One GLib main loop, run by one thread, hosts the pipelines of all the streams: their bus watches
+# are dispatched by it and the streams are added and removed on it, from any thread, with call().
+# (The appsink callbacks run on the GStreamer streaming threads of each pipeline.)
+class PipelineLoop:
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                # initialize GStreamer
+                Gst.init(sys.argv[1:])
+                self.loop = GLib.MainLoop()
+                self._thread = threading.Thread(target=self.loop.run, name="gst-main-loop")
+                self._thread.daemon = True
+                self._thread.start()
+
+    # Runs function(*args) on the loop thread
+    def call(self, function, *args):
+        self._ensure_started()
+
+        def once():
+            function(*args)
+            return False
+        GLib.idle_add(once)
+
+
+pipelines = PipelineLoop()
+
 
+# UDP video stream pushed into AMQP, one message (or group of chunks) per frame. start() and kill()
+# can be called from any thread, the pipeline lives on the shared PipelineLoop. When the pipeline
+# stops on its own (error, end of stream), on_stopped(stream) is called on the loop thread
+class UDP2AMQP:
+
+    def __init__(self, id, port, fps, tile) :
         self.id = id
         self.port = port
         self.fps = fps
         self.tile = tile
 
-        self.msg = None
         self.pipeline = None
         self.bus = None
         self.appsink = None
+        self.sender = None
+        self.on_stopped = None
+        self._killed = False
+
+    def start(self):
+        # One AMQP connection and sender link for the whole stream
+        server_url="amqp://"+user+":"+passwd+"@"+broker_ip+":"+str(broker_port)+"/topic://"+topic
+        self.sender = StreamSender(server_url, max_queue, max_in_flight, max_queue_bytes, self.id, chunk_size,
+                                   keyframes)
+        reactor = threading.Thread(target=Container(self.sender).run, name="amqp-sender-%s" % self.id)
+        reactor.daemon = True
+        reactor.start()
+        pipelines.call(self._start)
 
-    def run(self):
-        # initialize GStreamer
-        Gst.init(sys.argv[1:])
+    def kill(self):
+        self._killed = True
+        pipelines.call(self._stop)
 
+    def _start(self):
         print ("\n\n\t\tRUN!\n\n")
 
         # build the pipeline to receive UDP video stream
@@ -133,39 +288,47 @@ class UDP2AMQP(threading.Thread):
         # subscribe to <new-sample> signal
         self.appsink.connect("new-sample", on_buffer, self)
 
+        # bus messages are dispatched by the main loop until EOS or error
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_watch(GLib.PRIORITY_DEFAULT, self._on_message)
+
         # start playing
         ret = self.pipeline.set_state(Gst.State.PLAYING)
         if ret == Gst.StateChangeReturn.FAILURE:
             print("Unable to set the pipeline to the playing state.")
-            exit(-1)
-
-        # wait until EOS or error
-        self.bus = self.pipeline.get_bus()
-
-        # Main loop
-        while True:
-            self.msg = self.bus.timed_pop_filtered(10000, Gst.MessageType.ANY)
-            if self.msg:
-                if self.msg.type == Gst.MessageType.ERROR:
-                    err, debug = self.msg.parse_error()
-                    print(("Error received from element %s: %s" % (
-                        self.msg.src.get_name(), err)))
-                    print(("Debugging information: %s" % debug))
-                    break
-                elif self.msg.type == Gst.MessageType.EOS:
-                    print("End-Of-Stream reached.")
-                    break
-                elif self.msg.type == Gst.MessageType.STATE_CHANGED:
-                    if isinstance(self.msg.src, Gst.Pipeline):
-                        old_state, new_state, pending_state = msg.parse_state_changed()
-                        print(("Pipeline state changed from %s to %s." %
-                            (old_state.value_nick, new_state.value_nick)))
-                else:
-                    print("Unexpected message received.")
-            time.sleep(1.0/float(self.fps))
-
+            self._stop()
+
+    def _on_message(self, bus, msg):
+        if msg.type == Gst.MessageType.ERROR:
+            err, debug = msg.parse_error()
+            print(("Error received from element %s: %s" % (
+                msg.src.get_name(), err)))
+            print(("Debugging information: %s" % debug))
+            # _stop() removes the watch: returning False would remove it twice
+            self._stop()
+            return True
+        elif msg.type == Gst.MessageType.EOS:
+            print("End-Of-Stream reached.")
+            self._stop()
+            return True
+        elif msg.type == Gst.MessageType.STATE_CHANGED:
+            if msg.src == self.pipeline:
+                old_state, new_state, pending_state = msg.parse_state_changed()
+                print(("Pipeline state changed from %s to %s." %
+                    (old_state.value_nick, new_state.value_nick)))
+        return True
+
+    def _stop(self):
+        if self.pipeline is None:
+            return
         # free resources
+        self.bus.remove_watch()
         self.pipeline.set_state(Gst.State.NULL)
-
-    def kill(self):
-        self._kill.set()
+        self.pipeline = None
+        self.sender.close()
+        queue = self.sender.queue
+        print("Stream %s: %d frames sent, %d dropped (%d key, %d reference, %d disposable), %d bytes dropped" % (
+            self.id, self.sender._sent_count, queue.dropped_frames, queue.dropped[KEY], queue.dropped[REFERENCE],
+            queue.dropped[DISPOSABLE], queue.dropped_bytes))
+        if not self._killed and self.on_stopped is not None:
+            self.on_stopped(self)
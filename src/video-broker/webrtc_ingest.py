@@ -0,0 +1,219 @@
+# In-process WebRTC ingestion: a stream is received by a webrtcbin in the same GStreamer pipeline as
+# the appsink feeding its AMQP sender, instead of a webrtcRX process forwarding the RTP over UDP to
+# the pipeline of a UDP2AMQP (one process, one UDP hop and one jitter buffer less per stream).
+#
+# The signalling is the simple_server.py protocol as spoken by webrtcRX: the stream registers as
+# "peer<sourceId>" (HELLO), the vehicle calls it (SESSION) and sends its SDP offer, or asks for one
+# with OFFER_REQUEST. SDP and ICE candidates are exchanged as JSON:
+#   {"sdp": {"type": "offer" | "answer", "sdp": "..."}}
+#   {"ice": {"candidate": "...", "sdpMLineIndex": 0}}
+# The websockets of all the streams are served by one asyncio loop thread, the pipelines live on
+# the shared GLib loop of udpvideo2amqp. A lost or refused signalling connection is opened again,
+# after 1 s then twice as long each time up to WEBRTC_MAX_BACKOFF seconds, for as long as the stream
+# runs; the media of a call keeps flowing meanwhile, and a new call after it gets a new webrtcbin. The H.264 pads of webrtcbin are depayloaded, parsed into
+# access units and handed to the AMQP sender by the same appsink callback as UDP2AMQP.
+
+import asyncio
+import json
+import os
+import threading
+
+import websockets
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstSdp', '1.0')
+gi.require_version('GstWebRTC', '1.0')
+
+from gi.repository import GLib, Gst, GstSdp, GstWebRTC
+
+from udpvideo2amqp import UDP2AMQP, on_buffer, pipelines
+
+# Environment parameters
+signalling_server = os.getenv("WEBRTC_SIGNALLING", "ws://localhost:8443")
+stun_server = os.getenv("WEBRTC_STUN")
+max_backoff = float(os.getenv("WEBRTC_MAX_BACKOFF", 30))
+
+H264_CAPS = "application/x-rtp, media=video, encoding-name=H264, payload=96, clock-rate=90000"
+DEPAY = ("rtph264depay ! h264parse config-interval=-1 ! video/x-h264, stream-format=byte-stream, alignment=au"
+         " ! appsink emit-signals=true name=appsink")
+
+
+# One asyncio loop, run by one thread, for the signalling connections of all the streams
+class SignallingLoop:
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def submit(self, coroutine):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name="webrtc-signalling")
+                thread.daemon = True
+                thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+signalling = SignallingLoop()
+
+
+# WebRTC video stream pushed into AMQP, one message (or group of chunks) per frame
+class WebRTC2AMQP(UDP2AMQP):
+
+    def __init__(self, id, fps, tile, server=signalling_server):
+        super().__init__(id, None, fps, tile)
+        self.server = server
+        self.peer_id = "peer" + str(id)
+        self.webrtc = None
+        self._ws = None
+        self._closed = False
+        # The webrtcbin has taken part in a call
+        self._negotiated = False
+
+    # On the GLib loop
+    def _start(self):
+        print("Stream %s: waiting for the WebRTC call of %s" % (self.id, self.peer_id))
+        if self._build():
+            signalling.submit(self._signalling())
+
+    # Pipeline with a new webrtcbin, playing
+    def _build(self):
+        self._negotiated = False
+        self.pipeline = Gst.Pipeline.new("webrtc-%s" % self.id)
+        self.webrtc = Gst.ElementFactory.make("webrtcbin", "recv")
+        self.webrtc.set_property("bundle-policy", GstWebRTC.WebRTCBundlePolicy.MAX_BUNDLE)
+        if stun_server:
+            self.webrtc.set_property("stun-server", stun_server)
+        self.webrtc.connect("on-ice-candidate", self._on_ice_candidate)
+        self.webrtc.connect("pad-added", self._on_pad_added)
+        self.pipeline.add(self.webrtc)
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_watch(GLib.PRIORITY_DEFAULT, self._on_message)
+
+        ret = self.pipeline.set_state(Gst.State.PLAYING)
+        if ret == Gst.StateChangeReturn.FAILURE:
+            print("Unable to set the pipeline to the playing state.")
+            self._stop()
+            return False
+        return True
+
+    # A webrtcbin for a new call: the one of a previous call is replaced, the AMQP sender is kept
+    def _renew(self):
+        if self.pipeline is None:
+            return False
+        if not self._negotiated:
+            return True
+        print("Stream %s: new call, renewing the webrtcbin" % self.id)
+        self.bus.remove_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        return self._build()
+
+    def _stop(self):
+        self._closed = True
+        if self._ws is not None:
+            signalling.submit(self._ws.close())
+        super()._stop()
+
+    # Depayloader, parser and appsink for the incoming video
+    def _on_pad_added(self, element, pad):
+        if pad.direction != Gst.PadDirection.SRC:
+            return
+        depay = Gst.parse_bin_from_description(DEPAY, True)
+        element.get_parent().add(depay)
+        depay.sync_state_with_parent()
+        self.appsink = depay.get_by_name("appsink")
+        self.appsink.connect("new-sample", on_buffer, self)
+        pad.link(depay.get_static_pad("sink"))
+
+    async def _signalling(self):
+        delay = 1.0
+        while not self._closed:
+            try:
+                async with websockets.connect(self.server) as ws:
+                    self._ws = ws
+                    if self._closed:
+                        return
+                    await ws.send("HELLO " + self.peer_id)
+                    delay = 1.0
+                    async for message in ws:
+                        if self._closed:
+                            break
+                        self._on_signal(message)
+            except Exception as e:
+                print("Stream %s: signalling failed: %s" % (self.id, e))
+            finally:
+                self._ws = None
+            if not self._closed:
+                print("Stream %s: signalling lost, reconnecting in %.1f s" % (self.id, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+
+    def _send(self, message):
+        ws = self._ws
+        if ws is not None:
+            signalling.submit(ws.send(json.dumps(message)))
+
+    # On the signalling loop
+    def _on_signal(self, message):
+        if message == "HELLO":
+            print("Stream %s: registered as %s" % (self.id, self.peer_id))
+        elif message == "OFFER_REQUEST":
+            pipelines.call(self._create_offer)
+        elif message.startswith("ERROR"):
+            print("Stream %s: %s" % (self.id, message))
+        elif message.startswith("{"):
+            message = json.loads(message)
+            if "sdp" in message and message["sdp"]["type"] == "offer":
+                pipelines.call(self._on_offer, message["sdp"]["sdp"])
+            elif "sdp" in message and message["sdp"]["type"] == "answer":
+                pipelines.call(self._on_answer, message["sdp"]["sdp"])
+            elif "ice" in message:
+                ice = message["ice"]
+                pipelines.call(self._on_remote_candidate, ice["sdpMLineIndex"], ice["candidate"])
+
+    def _on_ice_candidate(self, element, mline, candidate):
+        # Not for a webrtcbin already replaced
+        if element is not self.webrtc:
+            return
+        self._send({"ice": {"candidate": candidate, "sdpMLineIndex": mline}})
+
+    def _on_remote_candidate(self, mline, candidate):
+        if self.pipeline is not None:
+            self.webrtc.emit("add-ice-candidate", mline, candidate)
+
+    # The vehicle calls with its offer
+    def _on_offer(self, text):
+        if not self._renew():
+            return
+        self._negotiated = True
+        res, sdp = GstSdp.SDPMessage.new_from_text(text)
+        offer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.OFFER, sdp)
+        self.webrtc.emit("set-remote-description", offer, None)
+        promise = Gst.Promise.new_with_change_func(self._on_description_created, "answer", None)
+        self.webrtc.emit("create-answer", None, promise)
+
+    # The vehicle asks for an offer: receive-only H.264
+    def _create_offer(self):
+        if not self._renew():
+            return
+        self._negotiated = True
+        self.webrtc.emit("add-transceiver", GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY,
+                         Gst.caps_from_string(H264_CAPS))
+        promise = Gst.Promise.new_with_change_func(self._on_description_created, "offer", None)
+        self.webrtc.emit("create-offer", None, promise)
+
+    def _on_answer(self, text):
+        if self.pipeline is None:
+            return
+        res, sdp = GstSdp.SDPMessage.new_from_text(text)
+        answer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.ANSWER, sdp)
+        self.webrtc.emit("set-remote-description", answer, None)
+
+    def _on_description_created(self, promise, kind, _):
+        promise.wait()
+        description = promise.get_reply().get_value(kind)
+        self.webrtc.emit("set-local-description", description, None)
+        self._send({"sdp": {"type": kind, "sdp": description.sdp.as_text()}})
@@ -11,6 +11,8 @@ amqp_ip=os.getenv("AMQP_IP")
 amqp_port=os.getenv('AMQP_PORT')
 username=os.getenv('AMQP_USER')
 password=os.getenv('AMQP_PASS')
+# Request/reply address of the last keyframes of the streams (empty: not served)
+keyframe_address=os.getenv('VIDEO_KEYFRAME_ADDRESS', "queue://video.keyframe")
 
 #Server URL to get the MEC information from 5GMETA Cloud Infrastructure
 server_url     = ""
@@ -27,11 +29,13 @@ def ip_generator():
 if __name__ == '__main__':
     # AMQP configuration
     server_url="amqp://"+username+":"+password+"@"+amqp_ip+":"+str(amqp_port)+"/topic://"
+    keyframe_url="amqp://"+username+":"+password+"@"+amqp_ip+":"+str(amqp_port)+"/"+keyframe_address if keyframe_address else None
 
     # Parameters to the AMQP system
     parameters = {
         'deviceType' : deviceType, 
-        'serverURL' : server_url
+        'serverURL' : server_url,
+        'keyframeURL' : keyframe_url
     }
 
     # Topics to be subscribed to. Get notified with new or terminated video streams